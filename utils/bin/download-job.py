@@ -23,11 +23,16 @@
 from utils.utils import get_args_parser, Session
 
 parser = get_args_parser('Download ZIP archive of verificaiton job.')
-parser.add_argument('job', help='Verification job identifier or its name.')
+parser.add_argument('job', nargs='+', help='Verification job identifier or its name. Several jobs are downloaded '
+                                           'concurrently to archives with default names.')
 parser.add_argument('-o', '--out', help='ZIP archive name.')
 args = parser.parse_args()
 
 with Session(args) as session:
-    arch = session.download_job(args.job, args.out)
+    if len(args.job) == 1:
+        archives = [session.download_job(args.job[0], args.out)]
+    else:
+        archives = session.download_jobs(args.job)
 
-print('ZIP archive with verification job "{0}" was successfully downloaded to "{1}"'.format(args.job, arch))
+for job, arch in zip(args.job, archives):
+    print('ZIP archive with verification job "{0}" was successfully downloaded to "{1}"'.format(job, arch))
@@ -20,15 +20,25 @@
 # limitations under the License.
 #
 
+import os
+
 from utils.utils import get_args_parser, Session
 
 parser = get_args_parser('Download JSON file with verification results of verificaiton job.')
-parser.add_argument('job', help='Verification job identifier or its name.')
+parser.add_argument('job', nargs='+', help='Verification job identifier or its name. Results of several jobs are '
+                                           'downloaded concurrently to files with job names as suffixes.')
 parser.add_argument('-o', '--out', help='JSON file name.', default='results.json')
 args = parser.parse_args()
 
+if len(args.job) == 1:
+    out_files = [args.out]
+else:
+    out_root, out_ext = os.path.splitext(args.out)
+    out_files = list('{0}-{1}{2}'.format(out_root, job, out_ext) for job in args.job)
+
 with Session(args) as session:
-    session.decision_results(args.job, args.out)
+    session.decision_results_batch(args.job, out_files)
 
-print('JSON file with verification results of verificaiton job "{0}" was successfully downloaded to "{1}"'
-      .format(args.job, args.out))
+for job, out in zip(args.job, out_files):
+    print('JSON file with verification results of verificaiton job "{0}" was successfully downloaded to "{1}"'
+          .format(job, out))
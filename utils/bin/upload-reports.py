@@ -31,6 +31,9 @@ parser.add_argument('--copy', action='store_true',
 parser.add_argument('--archive', help='ZIP archive name.', required=True)
 parser.add_argument('--name', help='Set it if you would like to set specific name when copying verification job.')
 parser.add_argument('--request-sleep', dest="sleep", help='Add sleep before sending requests.')
+parser.add_argument('--chunk-size', dest='chunk_size', type=int,
+                    help='Set it if you would like to upload ZIP archive by chunks of the specified size in MB. '
+                         'Run the command again to resume the interrupted upload of the same archive.')
 args = parser.parse_args()
 
 if not os.path.exists(args.archive):
@@ -41,7 +44,8 @@ with Session(args) as session:
     if args.copy:
         job_id_or_name = session.copy_job(args.job, name=args.name)
 
-    job_id = session.upload_reports(job_id_or_name, args.archive)
+    job_id = session.upload_reports(job_id_or_name, args.archive,
+                                    args.chunk_size * 1024 * 1024 if args.chunk_size else None)
 
     print('ZIP archive with reports "{}" was successfully uploaded on "{}/jobs/{}"'
           .format(args.archive, args.host, job_id))
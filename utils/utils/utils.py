@@ -21,6 +21,7 @@
 
 import argparse
 import getpass
+import hashlib
 import json
 import logging
 import os
@@ -29,12 +30,20 @@ import subprocess
 import sys
 import time
 import zipfile
+from concurrent.futures import ThreadPoolExecutor
 
 # TODO: this is non-standard dependency while it is not required for all users. So, let's create a separate library!
 import requests
 
 PROMPT = 'Password: '
 MAX_RETRIES = 32
+# Requests of batch operations are retried with exponential backoff
+BATCH_RETRIES = 5
+BACKOFF_FACTOR = 0.5
+# Default maximum number of concurrent requests of batch operations
+MAX_WORKERS = 8
+# Number of seconds between requests of the status of the background task on the server
+TASK_POLL_INTERVAL = 2
 
 
 class UnexpectedStatusCode(IOError):
@@ -57,10 +66,13 @@ class Session:
         self._password = get_password(args.password)
         if self._password is None:
             raise ValueError("Password wasn't got")
+        self._workers = getattr(args, 'workers', None) or MAX_WORKERS
 
     def __enter__(self):
+        # The session is shared between threads of batch operations, so the pool keeps a connection per thread.
+        # CSRF token is taken from the shared cookies.
         self.session = requests.Session()
-        adapter = requests.adapters.HTTPAdapter(max_retries=MAX_RETRIES)
+        adapter = requests.adapters.HTTPAdapter(max_retries=MAX_RETRIES, pool_maxsize=self._workers)
         self.session.mount('https://', adapter)
         self.session.mount('http://', adapter)
         # Get initial value of CSRF token via useless GET request
@@ -154,15 +166,80 @@ class Session:
             error = resp.json()['errors'][0]
             resp.close()
             raise BridgeError('Got error "{0}" while uploading job'.format(error))
-
-    def upload_reports(self, job, archive):
-        job_id = self.__get_job_id(job)
-        self.__request(
+        # The server uploads jobs in background tasks if it is configured so
+        for task_id in resp.json().get('tasks', []):
+            self.__wait_for_task(task_id)
+
+    def upload_reports(self, job, archive, chunk_size=None):
+        return self.__upload_reports(job, archive, chunk_size, True)
+
+    def __upload_reports(self, job, archive, chunk_size, concurrent_chunks):
+        job_id = self.__retry(self.__get_job_id, job)
+        if chunk_size:
+            self.__upload_reports_by_chunks(job_id, archive, chunk_size, concurrent_chunks)
+            return job_id
+        # The whole archive upload is not retried since the server could process it already
+        resp = self.__request(
             '/jobs/upload_reports/{0}/'.format(job_id), {},
             files=[('archive', open(archive, 'rb', buffering=(1024 * 1024)))], stream=True
         )
+        self.__wait_for_result(resp)
         return job_id
 
+    def __wait_for_result(self, resp):
+        # The server returns the task if reports are uploaded in background
+        task_id = resp.json().get('task')
+        if task_id is not None:
+            self.__wait_for_task(task_id)
+
+    def __wait_for_task(self, task_id):
+        while True:
+            # Status requests don't change anything, so they are retried
+            resp = self.__retry(self.__request, '/jobs/tasks/status/{0}/'.format(task_id), {})
+            status = resp.json()
+            if status['status'] == 'FINISHED':
+                return
+            if status['status'] in {'ERROR', 'CANCELLED'}:
+                raise BridgeError('Background task {0} has failed: {1}'.format(task_id, status['error']))
+            time.sleep(TASK_POLL_INTERVAL)
+
+    def __upload_reports_by_chunks(self, job_id, archive, chunk_size, concurrent_chunks):
+        # Chunks are identified by their hashes, so the server returns just chunks that were not uploaded before
+        # and the interrupted upload of the same archive is resumed.
+        chunks = []
+        with open(archive, mode='rb') as fp:
+            while True:
+                data = fp.read(chunk_size)
+                if not data:
+                    break
+                chunks.append(hashlib.sha256(data).hexdigest())
+        # Starting is retried since the server returns the same upload for the same chunks
+        resp = self.__retry(self.__request, '/jobs/upload_reports/{0}/start/'.format(job_id), {
+            'size': json.dumps(os.path.getsize(archive)), 'chunk_size': json.dumps(chunk_size),
+            'chunks': json.dumps(chunks)
+        })
+        upload_id = resp.json()['upload']
+        missing = resp.json()['missing']
+
+        # Chunks are uploaded sequentially inside batch operations, so there are no more threads than workers
+        args_list = list((upload_id, archive, chunk_size, i) for i in missing)
+        if concurrent_chunks:
+            self.run_concurrently(self.__upload_chunk, args_list)
+        else:
+            for args in args_list:
+                self.__retry(self.__upload_chunk, *args)
+        # Finishing is not retried since the server could start uploading of reports already
+        self.__wait_for_result(self.__request('/jobs/upload_reports/finish/{0}/'.format(upload_id), {}))
+
+    def __upload_chunk(self, upload_id, archive, chunk_size, index):
+        with open(archive, mode='rb') as fp:
+            fp.seek(index * chunk_size)
+            data = fp.read(chunk_size)
+        self.__request(
+            '/jobs/upload_reports/chunk/{0}/'.format(upload_id), {'index': index},
+            files=[('chunk', ('chunk', data))]
+        )
+
     def job_progress(self, job, filename):
         resp = self.__request('/jobs/get_job_progress_json/{0}/'.format(self.__get_job_id(job)))
         with open(filename, mode='w', encoding='utf8') as fp:
@@ -222,6 +299,46 @@ class Session:
     def download_all_marks(self, archive):
         return self.__download_archive('/marks/download-all/', None, archive)
 
+    def run_concurrently(self, func, args_list, retry=True):
+        # Calls func for each tuple of arguments with at most self._workers concurrent calls.
+        # Results are returned in the order of arguments. Failed calls are retried with backoff,
+        # so retry should be False if func changes data on the server and can't be safely repeated.
+        with ThreadPoolExecutor(max_workers=self._workers) as pool:
+            if retry:
+                return list(pool.map(lambda args: self.__retry(func, *args), args_list))
+            return list(pool.map(lambda args: func(*args), args_list))
+
+    def __retry(self, func, *args):
+        # Only idempotent requests are retried this way, connection errors of other requests
+        # are retried by the adapter before the request is sent
+        self.__is_not_used()
+        attempt = 0
+        while True:
+            try:
+                return func(*args)
+            except (requests.RequestException, UnexpectedStatusCode):
+                attempt += 1
+                if attempt >= BATCH_RETRIES:
+                    raise
+                time.sleep(BACKOFF_FACTOR * (2 ** attempt))
+
+    def download_jobs(self, jobs):
+        return self.run_concurrently(self.download_job, list((job, None) for job in jobs))
+
+    def upload_reports_batch(self, uploads, chunk_size=None):
+        # Uploads is the list of pairs of job and reports archive
+        return self.run_concurrently(self.__upload_reports, list(
+            (job, archive, chunk_size, False) for job, archive in uploads
+        ), retry=False)
+
+    def decision_results_batch(self, jobs, filenames):
+        self.run_concurrently(self.decision_results, list(zip(jobs, filenames)))
+
+    def get_comparison_data_batch(self, jobs, filenames=None):
+        if filenames is None:
+            filenames = [None] * len(jobs)
+        return self.run_concurrently(self.get_comparison_data, list(zip(jobs, filenames)))
+
     def __is_not_used(self):
         pass
 
@@ -265,6 +382,7 @@ def get_args_parser(desc):
     parser.add_argument('--host', required=True, help='Server host')
     parser.add_argument('--username', required=True, help='Your username')
     parser.add_argument('--password', help='Your password')
+    parser.add_argument('--workers', type=int, help='Maximum number of concurrent requests')
     return parser
 
 
@@ -19,35 +19,45 @@
 # limitations under the License.
 #
 
+import hashlib
 import json
 import os
 import re
 import tempfile
 import zipfile
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
 from io import BytesIO
 
 import pytz
 from django.conf import settings
 from django.core.exceptions import ObjectDoesNotExist
 from django.core.files import File
-from django.db import transaction
+from django.db import transaction, connection
+from django.utils.timezone import now
 from django.utils.translation import gettext_lazy as _
 
 from jobs.configuration import GetConfiguration
 from jobs.jobForm import LoadFilesTree, JobForm
-from jobs.models import Job, RunHistory, JobFile
+from jobs.models import Job, RunHistory, JobFile, ReportsUpload, ReportsUploadChunk, JobsTask, REPORTS_UPLOAD_DIR
 from jobs.utils import change_job_status, remove_jobs_by_id
-from reports.UploadReport import UploadReport
+import marks.SafeUtils as SafeUtils
+import marks.UnknownUtils as UnknownUtils
+import marks.UnsafeUtils as UnsafeUtils
+from marks.attributes import AttributesIndex
+from reports.coverage import FillCoverageCache
+from reports.UploadReport import UploadReportsBatch
 from reports.models import Report, ReportRoot, ReportSafe, ReportUnsafe, ReportUnknown, ReportComponent, \
-    Component, Computer, ReportAttr, ComponentResource, CoverageArchive, AttrFile, ErrorTraceSource
+    Component, Computer, ReportAttr, ComponentResource, CoverageArchive, AttrFile, ErrorTraceSource, \
+    ReportComponentLeaf, ComponentInstances
 from reports.utils import AttrData
 from service.models import SolvingProgress, JobProgress
 from service.utils import StartJobDecision
-from tools.utils import Recalculation
+from tools.profiling import unparallel_group
 from web.ZipGenerator import ZipStream, CHUNK_SIZE
-from web.utils import logger, file_get_or_create, unique_id, BridgeException, OpenFiles
-from web.vars import FORMAT, JOB_STATUS, REPORT_ARCHIVE, JOB_WEIGHT
+from web.utils import logger, file_get_or_create, unique_id, BridgeException, OpenFiles, file_checksum, \
+    iter_json_items, extract_archive
+from web.vars import FORMAT, JOB_STATUS, REPORT_ARCHIVE, JOB_WEIGHT, JOBS_TASK_TYPE, TASK_STATUS, UNKNOWN_ERROR
 
 ARCHIVE_FORMAT = 12
 
@@ -58,17 +68,18 @@ class AttrDataArchive:
         self.stream = ZipStream()
 
     def __iter__(self):
-        for afile in AttrFile.objects.filter(root__job=self._job):
-            file_name = os.path.join(settings.MEDIA_ROOT, afile.file.name)
-            arc_name = os.path.join('{0}{1}'.format(afile.id, os.path.splitext(afile.file.name)[-1]))
-            buf = b''
-            for data in self.stream.compress_file(file_name, arc_name):
-                buf += data
-                if len(buf) > CHUNK_SIZE:
-                    yield buf
-                    buf = b''
-            if len(buf) > 0:
+        files = list((
+            os.path.join(settings.MEDIA_ROOT, afile.file.name),
+            os.path.join('{0}{1}'.format(afile.id, os.path.splitext(afile.file.name)[-1]))
+        ) for afile in AttrFile.objects.filter(root__job=self._job))
+        buf = b''
+        for data in self.stream.compress_files(files, settings.ARCHIVE_COMPRESSION_THREADS):
+            buf += data
+            if len(buf) > CHUNK_SIZE:
                 yield buf
+                buf = b''
+        if len(buf) > 0:
+            yield buf
         yield self.stream.close_stream()
 
 
@@ -78,6 +89,8 @@ class JobArchiveGenerator:
         self.arcname = 'Job-%s.zip' % self.job.identifier[:10]
         self.files_to_add = []
         self.stream = ZipStream()
+        # Approximate progress of the archive generation in percents
+        self.progress = 0
 
     def __iter__(self):
         for job_v in self.job.versions.all():
@@ -86,10 +99,13 @@ class JobArchiveGenerator:
         for data in self.stream.compress_string('job.json', self.__job_data()):
             yield data
 
+        self.progress = 5
+
         reportsdata = ReportsData(self.job)
-        for data in self.stream.compress_string('reports.json', json.dumps(
-                reportsdata.reports, ensure_ascii=False, sort_keys=True, indent=4).encode('utf-8')):
+        # Computers are collected while reports are written, so reports should be written first
+        for data in self.stream.compress_stream('reports.json', reportsdata.reports_json()):
             yield data
+        self.progress = 40
         for data in self.stream.compress_string('computers.json', json.dumps(
                 reportsdata.computers, ensure_ascii=False, sort_keys=True, indent=4).encode('utf-8')):
             yield data
@@ -102,13 +118,19 @@ class JobArchiveGenerator:
 
         self.__add_reports_files()
         self.__add_coverage_files(reportsdata.coverage_arch_names)
-        for file_path, arcname in self.files_to_add:
-            for data in self.stream.compress_file(file_path, arcname):
-                yield data
+        for data in self.stream.compress_files(self.__files_with_progress(), settings.ARCHIVE_COMPRESSION_THREADS):
+            yield data
         if AttrFile.objects.filter(root__job=self.job).count() > 0:
-            for data in self.stream.compress_stream('AttrData.zip', AttrDataArchive(self.job)):
+            for data in self.stream.compress_stream('AttrData.zip', AttrDataArchive(self.job), zipfile.ZIP_STORED):
                 yield data
         yield self.stream.close_stream()
+        self.progress = 100
+
+    def __files_with_progress(self):
+        # Files are compressed ahead, so the progress is a bit bigger than the written part
+        for i in range(len(self.files_to_add)):
+            self.progress = 40 + 55 * i // len(self.files_to_add)
+            yield self.files_to_add[i]
 
     def __version_data(self, job_v):
         hash_sums = set(h for h, in job_v.filesystem_set.exclude(file=None).values_list('file__hash_sum'))
@@ -224,7 +246,7 @@ class JobsArchivesGen:
         for job in self.jobs:
             jobgen = JobArchiveGenerator(job)
             buf = b''
-            for data in self.stream.compress_stream(jobgen.arcname, jobgen):
+            for data in self.stream.compress_stream(jobgen.arcname, jobgen, zipfile.ZIP_STORED):
                 buf += data
                 if len(buf) > CHUNK_SIZE:
                     yield buf
@@ -244,7 +266,7 @@ class JobsTreesGen:
         for job in self.jobs:
             jobgen = JobArchiveGenerator(job)
             buf = b''
-            for data in self.stream.compress_stream(jobgen.arcname, jobgen):
+            for data in self.stream.compress_stream(jobgen.arcname, jobgen, zipfile.ZIP_STORED):
                 buf += data
                 if len(buf) > CHUNK_SIZE:
                     yield buf
@@ -273,6 +295,9 @@ class JobsTreesGen:
 
 
 class ReportsData:
+    # Reports are read from the database and written by chunks of this size
+    chunk_size = 1000
+
     def __init__(self, job):
         self.computers = {}
         self.coverage = []
@@ -281,19 +306,35 @@ class ReportsData:
         try:
             self.root = ReportRoot.objects.get(job=job)
         except ObjectDoesNotExist:
-            self.reports = []
+            self.root = None
             self.resources = []
         else:
-            self.reports = self.__reports_data()
             self.__get_coverage_data()
             self.resources = self.__get_resources_data()
 
+    def reports_json(self):
+        # Reports are written as JSON array with one report per line, so they can be read one by one
+        buf = [b'[']
+        buf_size = 0
+        separator = b'\n'
+        for report in self.__reports_data():
+            data = separator + json.dumps(report, ensure_ascii=False, sort_keys=True).encode('utf-8')
+            separator = b',\n'
+            buf.append(data)
+            buf_size += len(data)
+            if buf_size >= CHUNK_SIZE:
+                yield b''.join(buf)
+                buf = []
+                buf_size = 0
+        buf.append(b'\n]\n')
+        yield b''.join(buf)
+
     def __report_component_data(self, report):
         data = None
         if report.data:
             with report.data as fp:
                 data = fp.read().decode('utf8')
-        if report.computer_id not in self.computers:
+        if str(report.computer_id) not in self.computers:
             self.computers[str(report.computer_id)] = report.computer.description
         self._parents[report.id] = report.identifier
         return {
@@ -335,37 +376,41 @@ class ReportsData:
         return data
 
     def __reports_data(self):
+        if self.root is None:
+            return
+        yield from self.__chunks_data(
+            ReportComponent.objects.filter(root=self.root).select_related('component').order_by('id'),
+            self.__report_component_data
+        )
+        yield ReportSafe.__name__
+        yield from self.__chunks_data(ReportSafe.objects.filter(root=self.root).order_by('id'),
+                                      self.__report_leaf_data)
+        yield ReportUnsafe.__name__
+        yield from self.__chunks_data(ReportUnsafe.objects.filter(root=self.root).order_by('id'),
+                                      self.__report_leaf_data)
+        yield ReportUnknown.__name__
+        yield from self.__chunks_data(
+            ReportUnknown.objects.filter(root=self.root).select_related('component').order_by('id'),
+            self.__report_leaf_data
+        )
+
+    def __chunks_data(self, queryset, get_data):
         reports = []
-        report_index = {}
-        i = 0
-        for rc in ReportComponent.objects.filter(root=self.root).select_related('component').order_by('id'):
-            report_index[rc.pk] = i
-            reports.append(self.__report_component_data(rc))
-            i += 1
-        reports.append(ReportSafe.__name__)
-        i += 1
-        for safe in ReportSafe.objects.filter(root=self.root):
-            report_index[safe.pk] = i
-            reports.append(self.__report_leaf_data(safe))
-            i += 1
-        reports.append(ReportUnsafe.__name__)
-        i += 1
-        for unsafe in ReportUnsafe.objects.filter(root=self.root):
-            report_index[unsafe.pk] = i
-            reports.append(self.__report_leaf_data(unsafe))
-            i += 1
-        reports.append(ReportUnknown.__name__)
-        i += 1
-        for unknown in ReportUnknown.objects.filter(root=self.root).select_related('component'):
-            report_index[unknown.pk] = i
-            reports.append(self.__report_leaf_data(unknown))
-            i += 1
-        for ra in ReportAttr.objects.filter(report__root=self.root).select_related('attr', 'attr__name', 'data') \
-                .order_by('id'):
+        for report in queryset.iterator(chunk_size=self.chunk_size):
+            reports.append(get_data(report))
+            if len(reports) >= self.chunk_size:
+                yield from self.__add_attrs(reports)
+                reports = []
+        yield from self.__add_attrs(reports)
+
+    def __add_attrs(self, reports):
+        reports_by_pk = dict((report['pk'], report) for report in reports)
+        for ra in ReportAttr.objects.filter(report_id__in=list(reports_by_pk))\
+                .select_related('attr', 'attr__name', 'data').order_by('id'):
             ra_data = None
             if ra.data is not None:
                 ra_data = os.path.join('{0}{1}'.format(ra.data_id, os.path.splitext(ra.data.file.name)[-1]))
-            reports[report_index[ra.report_id]]['attrs'].append([
+            reports_by_pk[ra.report_id]['attrs'].append([
                 ra.attr.name.name, ra.attr.value, ra.compare, ra.associate, ra_data
             ])
         return reports
@@ -386,10 +431,12 @@ class ReportsData:
 
 
 class UploadTree:
-    def __init__(self, parent_id, user, jobs_dir):
+    def __init__(self, parent_id, user, jobs_dir, progress=None):
         self._parent_id = parent_id
         self._user = user
         self._jobsdir = jobs_dir
+        # Function which gets percent of uploaded jobs
+        self._progress = progress
 
         self._uploaded = set()
         self._tree = self.__get_tree()
@@ -423,7 +470,8 @@ class UploadTree:
         return jobs
 
     def __upload_tree(self):
-        for j_id in self.__get_jobs_order():
+        jobs_order = self.__get_jobs_order()
+        for j_id in jobs_order:
             jobzip_name = os.path.join(self._jobsdir, 'Job-%s.zip' % j_id[:10])
             if not os.path.exists(jobzip_name):
                 raise BridgeException(_('One of the job archives was not found'))
@@ -435,6 +483,8 @@ class UploadTree:
                 logger.error('The parent was not uploaded before the child')
                 raise BridgeException()
             self.__upload_job(jobzip_name, parent_id)
+            if self._progress is not None:
+                self._progress(100 * len(self._uploaded) // len(jobs_order))
 
     def __upload_job(self, jobarch, parent_id):
         try:
@@ -490,6 +540,12 @@ class UploadJob:
                 return json.load(fp)
         return None
 
+    def __read_reports_file(self, rel_path):
+        full_path = os.path.join(self._jobdir, rel_path)
+        if os.path.exists(full_path):
+            return iter_json_items(full_path)
+        return None
+
     def __upload_job_files(self):
         # If 'JobFiles' doesn't exist then the job doiesn't have files or archive is corrupted.
         # It'll be checked while files tree is uploading.
@@ -632,7 +688,7 @@ class UploadJob:
         ReportRoot.objects.create(user=self._user, job=self.job)
         try:
             UploadReports(
-                self.job, self.__read_json_file('reports.json'), self.__get_reports_files(),
+                self.job, self.__read_reports_file('reports.json'), self.__get_reports_files(),
                 self.__read_json_file('computers.json'), self.__read_json_file('Resources.json'),
                 self.__read_json_file('coverage_archives.json'), self.__get_coverage_files(), self.__attr_data()
             )
@@ -676,40 +732,50 @@ class UploadJob:
 
 
 class UploadReports:
+    # Leaf reports are uploaded by chunks of this size
+    chunk_size = 1000
+
     def __init__(self, job, data, files, computers, resources, coverage, cov_archives, attr_data):
+        # Data is iterated just once, so it can be read from the file by chunks
         self.data = data
         self._job = job
         self._files = files
         self._computers = self.__upload_computers(computers)
         self._parents = {None: None}
-        self._indexes = {}
+        self._reports_data = {}
         self._tree = []
-        self._safes = []
-        self._unsafes = []
-        self._unknowns = []
+        self._levels = {}
         self._components = {}
+        self._sources = {}
         self._rc_id_map = {}
+        # Caches of uploaded reports are computed while they are uploaded instead of recalculating them after
+        self._branches = {None: []}
+        self._instances = {}
 
-        if isinstance(self.data, list):
+        if self.data is not None:
+            self._attrs = AttrData(self._job.reportroot.id, attr_data)
             self.__upload_reports()
-            self.__upload_attrs(attr_data)
             # TODO: fix this
             # self.__upload_coverage(coverage, cov_archives)
             self.__upload_resources_cache(resources)
-            Recalculation('for_uploaded', json.dumps([self._job.pk], ensure_ascii=False))
-
-    def __fix_identifer(self, i):
-        m = re.match('.*?(/.*)', self.data[i]['identifier'])
+            # Caches of components are filled once after all leaves are uploaded
+            SafeUtils.RecalculateTags(ReportSafe.objects.filter(root=self._job.reportroot).only('id'), leaves=False)
+            UnsafeUtils.RecalculateTags(ReportUnsafe.objects.filter(root=self._job.reportroot).only('id'),
+                                        leaves=False)
+            UnknownUtils.update_unknowns_cache(ReportUnknown.objects.filter(root=self._job.reportroot))
+
+    def __fix_identifer(self, report):
+        m = re.match('.*?(/.*)', report['identifier'])
         if m is None:
-            self.data[i]['identifier'] = self._job.identifier
+            report['identifier'] = self._job.identifier
         else:
-            self.data[i]['identifier'] = self._job.identifier + m.group(1)
-        if self.data[i]['parent'] is not None:
-            m = re.match('.*?(/.*)', self.data[i]['parent'])
+            report['identifier'] = self._job.identifier + m.group(1)
+        if report['parent'] is not None:
+            m = re.match('.*?(/.*)', report['parent'])
             if m is None:
-                self.data[i]['parent'] = self._job.identifier
+                report['parent'] = self._job.identifier
             else:
-                self.data[i]['parent'] = self._job.identifier + m.group(1)
+                report['parent'] = self._job.identifier + m.group(1)
 
     def __upload_computers(self, computers):
         db_computers = {}
@@ -719,164 +785,243 @@ class UploadReports:
                 db_computers[c_id] = computer.id
         return db_computers
 
-    def __upload_attrs(self, attr_data):
-        attrs = AttrData(self._job.reportroot.id, attr_data)
-        for report in Report.objects.filter(root=self._job.reportroot).only('id', 'identifier'):
-            i = self._indexes[report.identifier]
-            for attr in self.data[i]['attrs']:
-                attrs.add(report.id, *attr)
-        attrs.upload()
-
     def __upload_reports(self):
-        curr_func = self.__add_report_component
-        for i in range(len(self.data)):
-            if isinstance(self.data[i], dict):
-                self.__fix_identifer(i)
-                curr_func(i)
-            elif isinstance(self.data[i], str) and self.data[i] == ReportSafe.__name__:
-                def curr_func(x):
-                    self._safes.append(x)
-                    self._indexes[self.data[x]['identifier']] = x
-            elif isinstance(self.data[i], str) and self.data[i] == ReportUnsafe.__name__:
-                def curr_func(x):
-                    self._unsafes.append(x)
-                    self._indexes[self.data[x]['identifier']] = x
-            elif isinstance(self.data[i], str) and self.data[i] == ReportUnknown.__name__:
-                def curr_func(x):
-                    self._unknowns.append(x)
-                    self._indexes[self.data[x]['identifier']] = x
+        # Components are followed by the lists of leaves, each list starts with the name of the leaves model.
+        # Components are kept in memory to be uploaded level by level, and leaves are uploaded by chunks.
+        upload_leaves = {
+            ReportSafe.__name__: self.__upload_safe_reports,
+            ReportUnsafe.__name__: self.__upload_unsafe_reports,
+            ReportUnknown.__name__: self.__upload_unknown_reports
+        }
+        leaves_type = None
+        leaves = []
+        for report in self.data:
+            if isinstance(report, dict):
+                self.__fix_identifer(report)
+                if leaves_type is None:
+                    self.__add_report_component(report)
+                    continue
+                leaves.append(report)
+                if len(leaves) >= self.chunk_size:
+                    upload_leaves[leaves_type](leaves)
+                    leaves = []
+            elif isinstance(report, str) and report in upload_leaves:
+                if leaves_type is None:
+                    self.__upload_components()
+                elif len(leaves) > 0:
+                    upload_leaves[leaves_type](leaves)
+                    leaves = []
+                leaves_type = report
+        if leaves_type is None:
+            self.__upload_components()
+        elif len(leaves) > 0:
+            upload_leaves[leaves_type](leaves)
+
+    def __upload_components(self):
         for lvl in range(len(self._tree)):
             self.__upload_report_components(lvl)
-            for report in ReportComponent.objects.filter(root=self._job.reportroot):
-                self._parents[report.identifier] = report.id
-        self.__upload_safe_reports()
-        self.__upload_unsafe_reports()
-        self.__upload_unknown_reports()
+        ComponentInstances.objects.bulk_create(list(
+            ComponentInstances(report_id=report_id, component_id=component_id, total=total)
+            for (report_id, component_id), total in self._instances.items()
+        ))
+        self._reports_data = {}
+        self._attrs.upload()
 
     @transaction.atomic
     def __upload_report_components(self, lvl):
+        reports = []
         for identifier in self._tree[lvl]:
-            i = self._indexes[identifier]
+            data = self._reports_data[identifier]
             report = ReportComponent(
-                identifier=identifier, root=self._job.reportroot, covnum=self.data[i]['covnum'],
-                parent_id=self._parents[self.data[i].get('parent')],
-                computer_id=self._computers[self.data[i]['computer']],
-                component_id=self.__get_component(self.data[i]['component']),
-                verification=self.data[i]['verification'],
-                start_date=datetime.fromtimestamp(self.data[i]['start_date'], pytz.timezone('UTC')),
-                finish_date=datetime.fromtimestamp(self.data[i]['finish_date'], pytz.timezone('UTC'))
-                if self.data[i]['finish_date'] is not None else None
+                identifier=identifier, root=self._job.reportroot, covnum=data['covnum'],
+                parent_id=self._parents[data.get('parent')],
+                computer_id=self._computers[data['computer']],
+                component=self.__get_component(data['component']),
+                verification=data['verification'],
+                start_date=datetime.fromtimestamp(data['start_date'], pytz.timezone('UTC')),
+                finish_date=datetime.fromtimestamp(data['finish_date'], pytz.timezone('UTC'))
+                if data['finish_date'] is not None else None
             )
-            if self.data[i]['resource'] is not None:
-                report.cpu_time = self.data[i]['resource']['cpu_time']
-                report.wall_time = self.data[i]['resource']['wall_time']
-                report.memory = self.data[i]['resource']['memory']
-
-            log_id = (ReportComponent.__name__, 'log', self.data[i]['pk'])
-            if log_id in self._files:
-                with open(self._files[log_id], mode='rb') as fp:
-                    report.add_log(REPORT_ARCHIVE['log'], fp)
-
-            verifier_input_id = (ReportComponent.__name__, 'verifier_input', self.data[i]['pk'])
-            if verifier_input_id in self._files:
-                with open(self._files[verifier_input_id], mode='rb') as fp:
-                    report.add_verifier_input(REPORT_ARCHIVE['verifier input'], fp)
+            if data['resource'] is not None:
+                report.cpu_time = data['resource']['cpu_time']
+                report.wall_time = data['resource']['wall_time']
+                report.memory = data['resource']['memory']
+            reports.append(report)
+
+        # Files don't depend on each other, so they are stored before the reports are created
+        with ThreadPoolExecutor(max_workers=settings.REPORTS_UPLOAD_THREADS) as pool:
+            for _ in pool.map(self.__add_component_files, reports):
+                pass
+        self.__create_components(reports)
+
+        for report in reports:
+            data = self._reports_data[report.identifier]
+            self._parents[report.identifier] = report.id
+            self._rc_id_map[data['pk']] = report.id
+            self._branches[report.id] = [report.id] + self._branches[report.parent_id]
+            for p_id in self._branches[report.id]:
+                self._instances[(p_id, report.component_id)] = self._instances.get((p_id, report.component_id), 0) + 1
+            self.__add_attrs(report.id, data)
+
+    def __add_component_files(self, report):
+        # Is called in threads, so it must not query the database
+        data = self._reports_data[report.identifier]
+        log_id = (ReportComponent.__name__, 'log', data['pk'])
+        if log_id in self._files:
+            with open(self._files[log_id], mode='rb') as fp:
+                report.add_log(REPORT_ARCHIVE['log'], fp)
+
+        verifier_input_id = (ReportComponent.__name__, 'verifier_input', data['pk'])
+        if verifier_input_id in self._files:
+            with open(self._files[verifier_input_id], mode='rb') as fp:
+                report.add_verifier_input(REPORT_ARCHIVE['verifier input'], fp)
+
+        if data['data'] is not None:
+            report.new_data('report-data.json', BytesIO(data['data'].encode('utf8')))
+
+    def __create_components(self, reports):
+        # Django can't bulk create multi-table inherited models,
+        # so base reports are bulk created first and then component rows are inserted with their report_ptr_id.
+        base_reports = Report.objects.bulk_create(list(
+            Report(root_id=r.root_id, parent_id=r.parent_id, identifier=r.identifier) for r in reports
+        ))
+        if all(r.id is not None for r in base_reports):
+            reports_ids = dict((r.identifier, r.id) for r in base_reports)
+        else:
+            # The database doesn't return ids of bulk created rows (MySQL)
+            reports_ids = dict(Report.objects.filter(identifier__in=list(r.identifier for r in reports))
+                               .values_list('identifier', 'id'))
+        for report in reports:
+            report.id = report.report_ptr_id = reports_ids[report.identifier]
+
+        fields = getattr(ReportComponent, '_meta').local_concrete_fields
+        sql = 'INSERT INTO {0} ({1}) VALUES ({2})'.format(
+            connection.ops.quote_name(getattr(ReportComponent, '_meta').db_table),
+            ', '.join(connection.ops.quote_name(f.column) for f in fields), ', '.join(['%s'] * len(fields))
+        )
+        with connection.cursor() as cursor:
+            cursor.executemany(sql, list(
+                list(f.get_db_prep_save(f.pre_save(report, True), connection) for f in fields) for report in reports
+            ))
 
-            if self.data[i]['data'] is not None:
-                report.new_data('report-data.json', BytesIO(self.data[i]['data'].encode('utf8')))
-
-            report.save()
-            self._rc_id_map[self.data[i]['pk']] = report.id
+    def __get_source(self, source_id):
+        # Upload error trace sources if it was not uploaded for already created leaves
+        if source_id is None:
+            # Safes can be without sources
+            return None
+        if source_id not in self._sources:
+            source_arch_id = (ErrorTraceSource.__name__, 'source', source_id)
+            new_source = ErrorTraceSource(root=self._job.reportroot)
+            with open(self._files[source_arch_id], mode='rb') as fp:
+                new_source.add_sources(REPORT_ARCHIVE['sources'], fp, True)
+            self._sources[source_id] = new_source.id
+        return self._sources[source_id]
 
     @transaction.atomic
-    def __upload_safe_reports(self):
-        sources = {}
-        for i in self._safes:
-            if self.data[i]['source'] not in sources:
-                source_arch_id = (ErrorTraceSource.__name__, 'source', self.data[i]['source'])
-                new_source = ErrorTraceSource(root=self._job.reportroot)
-                with open(self._files[source_arch_id], mode='rb') as fp:
-                    new_source.add_sources(REPORT_ARCHIVE['sources'], fp, True)
-                sources[self.data[i]['source']] = new_source.id
+    def __upload_safe_reports(self, reports):
+        new_leaves = []
+        for data in reports:
             report = ReportSafe(
-                root=self._job.reportroot, identifier=self.data[i]['identifier'],
-                parent_id=self._parents[self.data[i]['parent']], source_id=sources[self.data[i]['source']],
-                cpu_time=self.data[i]['cpu_time'], wall_time=self.data[i]['wall_time'], memory=self.data[i]['memory']
+                root=self._job.reportroot, identifier=data['identifier'],
+                parent_id=self._parents[data['parent']], source_id=self.__get_source(data.get('source')),
+                cpu_time=data['cpu_time'], wall_time=data['wall_time'], memory=data['memory']
             )
-            proof_id = (ReportSafe.__name__, 'proof', self.data[i]['pk'])
+            proof_id = (ReportSafe.__name__, 'proof', data['pk'])
             if proof_id in self._files:
                 with open(self._files[proof_id], mode='rb') as fp:
                     report.add_proof(REPORT_ARCHIVE['proof'], fp)
             report.save()
+            self.__add_attrs(report.id, data)
+            new_leaves.append(report)
+        self.__upload_leaves('safe', new_leaves)
+        index = AttributesIndex('safe', {'report__in': new_leaves})
+        for safe in new_leaves:
+            SafeUtils.ConnectReport(safe, index)
+        SafeUtils.RecalculateTags(new_leaves, components=False)
 
     @transaction.atomic
-    def __upload_unsafe_reports(self):
-        sources = {}
-        for i in self._unsafes:
-            # Upload error trace sources if it was not uploaded for already created error traces
-            if self.data[i]['source'] not in sources:
-                source_arch_id = (ErrorTraceSource.__name__, 'source', self.data[i]['source'])
-                new_source = ErrorTraceSource(root=self._job.reportroot)
-                with open(self._files[source_arch_id], mode='rb') as fp:
-                    new_source.add_sources(REPORT_ARCHIVE['sources'], fp, True)
-                sources[self.data[i]['source']] = new_source.id
-
+    def __upload_unsafe_reports(self, reports):
+        new_leaves = []
+        for data in reports:
             # Check if error trace identifier exists and is unique
-            if 'trace_id' not in self.data[i] or \
-                    ReportUnsafe.objects.filter(trace_id=self.data[i]['trace_id']).count() > 0:
-                self.data[i]['trace_id'] = unique_id()
+            if 'trace_id' not in data or ReportUnsafe.objects.filter(trace_id=data['trace_id']).count() > 0:
+                data['trace_id'] = unique_id()
 
             report = ReportUnsafe(
-                root=self._job.reportroot, identifier=self.data[i]['identifier'], trace_id=self.data[i]['trace_id'],
-                source_id=sources[self.data[i]['source']], parent_id=self._parents[self.data[i]['parent']],
-                cpu_time=self.data[i]['cpu_time'], wall_time=self.data[i]['wall_time'], memory=self.data[i]['memory']
+                root=self._job.reportroot, identifier=data['identifier'], trace_id=data['trace_id'],
+                source_id=self.__get_source(data['source']), parent_id=self._parents[data['parent']],
+                cpu_time=data['cpu_time'], wall_time=data['wall_time'], memory=data['memory']
             )
-            trace_id = (ReportUnsafe.__name__, 'trace', self.data[i]['pk'])
+            trace_id = (ReportUnsafe.__name__, 'trace', data['pk'])
             with open(self._files[trace_id], mode='rb') as fp:
                 report.add_trace(REPORT_ARCHIVE['error trace'], fp, True)
+            self.__add_attrs(report.id, data)
+            new_leaves.append(report)
+        self.__upload_leaves('unsafe', new_leaves)
+        index = AttributesIndex('unsafe', {'report__in': new_leaves})
+        for unsafe in new_leaves:
+            UnsafeUtils.ConnectReport(unsafe, index)
+        UnsafeUtils.RecalculateTags(new_leaves, components=False)
 
     @transaction.atomic
-    def __upload_unknown_reports(self):
-        for i in self._unknowns:
+    def __upload_unknown_reports(self, reports):
+        new_leaves = []
+        for data in reports:
             report = ReportUnknown(
-                root=self._job.reportroot, identifier=self.data[i]['identifier'],
-                parent_id=self._parents[self.data[i]['parent']],
-                component_id=self.__get_component(self.data[i]['component']),
-                cpu_time=self.data[i]['cpu_time'], wall_time=self.data[i]['wall_time'], memory=self.data[i]['memory']
+                root=self._job.reportroot, identifier=data['identifier'],
+                parent_id=self._parents[data['parent']],
+                component=self.__get_component(data['component']),
+                cpu_time=data['cpu_time'], wall_time=data['wall_time'], memory=data['memory']
             )
-            problem_id = (ReportUnknown.__name__, 'problem', self.data[i]['pk'])
+            problem_id = (ReportUnknown.__name__, 'problem', data['pk'])
             with open(self._files[problem_id], mode='rb') as fp:
                 report.add_problem_desc(REPORT_ARCHIVE['problem desc'], fp)
             report.save()
+            self.__add_attrs(report.id, data)
+            new_leaves.append(report)
+        self.__upload_leaves('unknown', new_leaves)
+        # Unknowns cache is updated once after all reports are uploaded
+        index = AttributesIndex('unknown', {'report__in': new_leaves})
+        for unknown in new_leaves:
+            UnknownUtils.ConnectReport(unknown, False, index)
+
+    def __upload_leaves(self, leaf_type, reports):
+        self._attrs.upload()
+        ReportComponentLeaf.objects.bulk_create(list(
+            ReportComponentLeaf(report_id=p_id, **{leaf_type: report})
+            for report in reports for p_id in self._branches[report.parent_id]
+        ))
+
+    def __add_attrs(self, report_id, data):
+        for attr in data['attrs']:
+            self._attrs.add(report_id, *attr)
 
     def __get_component(self, name):
         if name not in self._components:
-            component = Component.objects.get_or_create(name=name)[0]
-            self._components[name] = component.id
+            self._components[name] = Component.objects.get_or_create(name=name)[0]
         return self._components[name]
 
-    def __add_report_component(self, i):
-        p_id = self.data[i].get('parent')
+    def __add_report_component(self, report):
+        p_id = report.get('parent')
         if p_id is None:
-            self.__add_to_tree(0, i)
+            self.__add_to_tree(0, report)
+        elif p_id in self._levels:
+            self.__add_to_tree(self._levels[p_id] + 1, report)
         else:
-            for j in range(len(self._tree)):
-                if p_id in self._tree[j]:
-                    self.__add_to_tree(j + 1, i)
-                    break
-            else:
-                raise ValueError('The report parent was not found in data')
+            raise ValueError('The report parent was not found in data')
 
-    def __add_to_tree(self, lvl, i):
+    def __add_to_tree(self, lvl, report):
         while len(self._tree) <= lvl:
             self._tree.append(set())
-        self._tree[lvl].add(self.data[i]['identifier'])
-        self._indexes[self.data[i]['identifier']] = i
+        self._tree[lvl].add(report['identifier'])
+        self._levels[report['identifier']] = lvl
+        self._reports_data[report['identifier']] = report
 
     @transaction.atomic
     def __upload_coverage(self, coverage, archives):
         if not isinstance(coverage, list):
             return
+        new_archives = []
         for i in range(len(coverage)):
             if i not in archives:
                 raise FileNotFoundError('Coverage archive was not found')
@@ -885,6 +1030,10 @@ class UploadReports:
             carch = CoverageArchive(report_id=self._rc_id_map[coverage[i][0]], identifier=coverage[i][1])
             with open(archives[i], mode='rb') as fp:
                 carch.save_archive(REPORT_ARCHIVE['coverage'], fp)
+            new_archives.append(carch)
+        FillCoverageCache(archives=list(CoverageArchive.objects.filter(
+            id__in=list(carch.id for carch in new_archives), report__covnum__gt=0
+        )))
 
     def __upload_resources_cache(self, resources):
         if not isinstance(resources, list):
@@ -908,6 +1057,8 @@ class UploadReports:
 
 
 class UploadReportsWithoutDecision:
+    # Reports have the format of reports of the job decision, so unlike exported reports in UploadReports
+    # they aren't ready database rows. They are validated and converted by UploadReport in batches.
     reports_file = 'reports.json'
     fields = {
         'start': ['id', 'parent id', 'name', 'attrs', 'attr data', 'comp', 'config'],
@@ -929,85 +1080,377 @@ class UploadReportsWithoutDecision:
         'proof', 'sources', 'error traces', 'problem desc', 'coverage sources'
     ]
 
-    def __init__(self, job, user, reports_dir):
+    # Reports are uploaded by batches, each batch is limited by number of reports and number of opened files
+    batch_size = 1000
+    batch_files = 500
+
+    def __init__(self, job, user, reports_dir, progress=None):
         self._job = job
         self._user = user
         self._reports_dir = reports_dir
-        self._data = self.__read_reports_data()
-        self.source_archives = dict()
-        self.__prepare_job()
-        try:
-            self.__upload_children(None)
-        except Exception:
-            ReportRoot.objects.get(job=self._job).delete()
-            self._job.status = JOB_STATUS[4][0]
-            self._job.save()
-            raise
+        # Function which gets percent of uploaded reports
+        self._progress = progress
+        self._total = self._uploaded = 0
+        # Reports are spilled to the temporary file, only their positions and tree fields are kept in memory
+        with tempfile.TemporaryFile() as self._data_file:
+            self._children = self.__get_children(self.__read_reports_data())
+            self.source_archives = dict()
+            self._sources_by_checksum = dict()
+            self._sources_names = dict()
+            self.__prepare_job()
+            try:
+                self.__upload_tree()
+            except Exception:
+                ReportRoot.objects.get(job=self._job).delete()
+                self._job.status = JOB_STATUS[4][0]
+                self._job.save()
+                raise
         change_job_status(self._job, JOB_STATUS[3][0])
 
     def __read_reports_data(self):
+        # Returns list of (id, parent id, type, offset, size) of reports in the temporary file
         reports_file = os.path.join(self._reports_dir, self.reports_file)
         if not os.path.isfile(reports_file):
             raise BridgeException(_("The archive doesn't contain main reports file"))
-        with open(reports_file, encoding='utf8') as fp:
-            data = json.load(fp)
-        if not isinstance(data, list) or len(data) == 0:
+        index = []
+        try:
+            # Both JSON array and JSON Lines are supported
+            for report in iter_json_items(reports_file):
+                if not isinstance(report, dict):
+                    raise BridgeException(_('Wrong format of main reports file'))
+                data = json.dumps(report).encode('utf8')
+                index.append((report['id'], report['parent id'], report['type'], self._data_file.tell(), len(data)))
+                self._data_file.write(data)
+        except ValueError:
             raise BridgeException(_('Wrong format of main reports file'))
-        return data
+        if len(index) == 0:
+            raise BridgeException(_('Wrong format of main reports file'))
+        return index
+
+    def __get_children(self, index):
+        children = {}
+        for report in index:
+            children.setdefault(report[1], []).append(report)
+        return children
+
+    def __get_report_data(self, report):
+        self._data_file.seek(report[3])
+        return json.loads(self._data_file.read(report[4]).decode('utf8'))
 
     def __prepare_job(self):
         StartJobDecision(self._user, self._job.id, GetConfiguration().configuration, fake=True)
         change_job_status(self._job, JOB_STATUS[2][0])
         self._job = Job.objects.get(id=self._job.id)
 
-    def __upload_children(self, parent_id):
-        actions = {
-            'component': self.__upload_component, 'verification': self.__upload_verification,
-            'safe': self.__upload_leaf, 'unsafe': self.__upload_leaf, 'unknown': self.__upload_leaf,
-            'job coverage': self.__upload_leaf
-        }
-        for report in self._data:
-            if report['parent id'] == parent_id:
-                actions[report['type']](report)
-
-    def __upload_component(self, data):
-        self.__upload(data, 'start')
-        self.__upload_children(data['id'])
-        self.__upload(data, 'finish')
-
-    def __upload_verification(self, data):
-        self.__upload(data, 'verification')
-        self.__upload_children(data['id'])
-        self.__upload(data, 'verification finish')
-
-    def __upload_leaf(self, data):
-        self.__upload(data, data['type'])
-
-    def __upload(self, data, report_type):
+    def __upload_tree(self):
+        # Components and verification reports are started level by level, then leaves are uploaded,
+        # and then all reports are finished from the deepest level. So each report is uploaded after its parent
+        # and finished after all its children just like in the depth-first order.
+        levels = []
+        leaves = []
+        level = self._children.get(None, [])
+        while len(level) > 0:
+            levels.append([])
+            next_level = []
+            for report in level:
+                if report[2] in {'component', 'verification'}:
+                    levels[-1].append(report)
+                    next_level.extend(self._children.get(report[0], []))
+                else:
+                    leaves.append(report)
+            level = next_level
+
+        # Components and verification reports are uploaded twice: on start and on finish
+        self._total = 2 * sum(len(level) for level in levels) + len(leaves)
+        start_types = {'component': 'start', 'verification': 'verification'}
+        finish_types = {'component': 'finish', 'verification': 'verification finish'}
+        self.__upload_reports(list(
+            (report, start_types[report[2]]) for level in levels for report in level
+        ))
+        self.__upload_reports(list((report, report[2]) for report in leaves))
+        self.__upload_reports(list(
+            (report, finish_types[report[2]]) for level in reversed(levels) for report in level
+        ))
+
+    def __upload_reports(self, reports):
+        batch = []
+        batch_files = set()
+        for index_data, report_type in reports:
+            report, files = self.__collect_report(self.__get_report_data(index_data), report_type)
+            missed = list(f for f in files if not os.path.isfile(f))
+            if len(missed) > 0:
+                logger.error('Files {} were not found'.format(missed))
+                continue
+            batch.append(report)
+            batch_files |= files
+            if len(batch) >= self.batch_size or len(batch_files) >= self.batch_files:
+                self.__upload_batch(batch, batch_files)
+                batch = []
+                batch_files = set()
+        if len(batch) > 0:
+            self.__upload_batch(batch, batch_files)
+
+    def __collect_report(self, data, report_type):
         # Collecting report data
-        report = data.copy()
+        report = data
         if 'resources' in self.fields[report_type] and 'resources' not in report:
             report['resources'] = {'CPU time': 0, 'wall time': 0, 'memory size': 0}
         if report_type == 'start' and report['id'] == '/':
             del report['parent id']
         report['type'] = report_type
+        if isinstance(report.get('sources'), str):
+            report['sources'] = self.__get_sources_name(report['sources'])
 
         # Collecting report files
-        files = []
+        files = set()
         for f in self.files_fields:
             if f in report:
                 if isinstance(report[f], str):
-                    files.append(os.path.join(self._reports_dir, report[f]))
+                    files.add(os.path.join(self._reports_dir, report[f]))
                 elif isinstance(report[f], list):
-                    files.extend(list(os.path.join(self._reports_dir, p) for p in report[f]))
+                    files.update(os.path.join(self._reports_dir, p) for p in report[f])
                 elif isinstance(report[f], dict):
-                    files.extend(list(os.path.join(self._reports_dir, p) for p in report[f].values()))
+                    files.update(os.path.join(self._reports_dir, p) for p in report[f].values())
+        return report, files
+
+    def __get_sources_name(self, name):
+        # Source archives with the same content are saved just once
+        if name not in self._sources_names:
+            path = os.path.join(self._reports_dir, name)
+            if not os.path.isfile(path):
+                return name
+            with open(path, mode='rb') as fp:
+                checksum = file_checksum(fp)
+            self._sources_names[name] = self._sources_by_checksum.setdefault(checksum, name)
+        return self._sources_names[name]
+
+    def __upload_batch(self, reports, files):
+        with OpenFiles(*files, rel_path=self._reports_dir) as archives:
+            res = UploadReportsBatch(self._job, reports, archives=archives, source_archives=self.source_archives)
+        if res.error is not None:
+            raise ValueError(res.error)
+        self._uploaded += len(reports)
+        if self._progress is not None:
+            self._progress(100 * self._uploaded // self._total)
+
+
+def start_reports_upload(job, user, size, chunk_size, chunks):
+    # Chunks are identified by their SHA-256 hashes. Returns the upload and indexes of chunks that were not received.
+    if not isinstance(size, int) or not isinstance(chunk_size, int) or not isinstance(chunks, list) \
+            or size <= 0 or not 0 < chunk_size <= settings.MAX_FILE_SIZE \
+            or len(chunks) != (size + chunk_size - 1) // chunk_size \
+            or any(not isinstance(c, str) or re.fullmatch('[0-9a-f]{64}', c) is None for c in chunks):
+        raise BridgeException(_('Wrong format of chunked upload data'))
+
+    # Remove uploads that were not finished for a long time
+    ReportsUpload.objects.filter(date__lt=now() - timedelta(days=settings.REPORTS_UPLOAD_LIFETIME)).delete()
+
+    identifier = hashlib.sha256(json.dumps([size, chunk_size, chunks]).encode('utf8')).hexdigest()
+    archive_name = os.path.join(REPORTS_UPLOAD_DIR, '{0}-{1}.zip'.format(job.id, identifier))
+    upload, created = ReportsUpload.objects.get_or_create(job=job, identifier=identifier, defaults={
+        'user': user, 'size': size, 'chunk_size': chunk_size, 'chunks': json.dumps(chunks), 'archive': archive_name
+    })
+    if created:
+        # Chunks are written directly into the archive file at their offsets
+        os.makedirs(os.path.join(settings.MEDIA_ROOT, REPORTS_UPLOAD_DIR), exist_ok=True)
+        with open(upload.archive.path, mode='wb') as fp:
+            fp.truncate(size)
+    received = set(upload.received.values_list('index', flat=True))
+    return upload, list(i for i in range(len(chunks)) if i not in received)
+
+
+def upload_reports_chunk(upload, index, chunk):
+    chunks = json.loads(upload.chunks)
+    if not 0 <= index < len(chunks):
+        raise BridgeException(_('Wrong index of the chunk'))
+    if upload.received.filter(index=index).exists():
+        return
+
+    # The chunk is checked before it is written, so already received data can't be spoiled
+    chunk_hash = hashlib.sha256()
+    chunk_size = 0
+    for data in chunk.chunks():
+        chunk_hash.update(data)
+        chunk_size += len(data)
+    if chunk_size != min(upload.chunk_size, upload.size - index * upload.chunk_size) \
+            or chunk_hash.hexdigest() != chunks[index]:
+        raise BridgeException(_("The chunk doesn't match its hash"))
+
+    with open(upload.archive.path, mode='r+b') as fp:
+        fp.seek(index * upload.chunk_size)
+        for data in chunk.chunks():
+            fp.write(data)
+    ReportsUploadChunk.objects.bulk_create([ReportsUploadChunk(upload=upload, index=index)], ignore_conflicts=True)
+
+
+def finish_reports_upload(upload, user):
+    # Returns the task if reports are uploaded in background
+    if upload.received.count() != len(json.loads(upload.chunks)):
+        raise BridgeException(_('Not all chunks of the archive were uploaded'))
+    job = upload.job
+    if settings.JOBS_TASKS_IN_BACKGROUND:
+        task = create_jobs_task(user, JOBS_TASK_TYPE[2][0], job=job)
+        # The assembled archive is passed to the task, so it is not removed with the upload
+        task.archive = upload.archive.name
+        task.save()
+        upload.archive = None
+        upload.delete()
+        return task
+    try:
+        with zipfile.ZipFile(upload.archive.path, mode='r') as zfp:
+            reports_dir = tempfile.TemporaryDirectory()
+            zfp.extractall(reports_dir.name)
+    except Exception as e:
+        logger.exception(e)
+        # Damaged chunks can be uploaded again. If all chunks are right, the uploaded archive itself is wrong.
+        if reset_damaged_chunks(upload) == 0:
+            upload.delete()
+        raise BridgeException(_('Extraction of the archive has failed'))
+    # The archive is not needed anymore, so it is removed before reports are uploaded
+    upload.delete()
+    UploadReportsWithoutDecision(job, user, reports_dir.name)
+    return None
+
+
+def reset_damaged_chunks(upload):
+    # Chunks which content in the archive doesn't match their hashes are marked as not received.
+    # Returns the number of such chunks.
+    damaged = []
+    with open(upload.archive.path, mode='rb') as fp:
+        for index, chunk_hash in enumerate(json.loads(upload.chunks)):
+            fp.seek(index * upload.chunk_size)
+            if hashlib.sha256(fp.read(upload.chunk_size)).hexdigest() != chunk_hash:
+                damaged.append(index)
+    upload.received.filter(index__in=damaged).delete()
+    return len(damaged)
+
+
+def create_jobs_task(user, task_type, archive=None, job=None, parent=None):
+    # Remove processed tasks and archives of downloaded jobs after some time
+    JobsTask.objects.filter(date__lt=now() - timedelta(days=settings.JOBS_TASKS_LIFETIME)) \
+        .exclude(status__in=[TASK_STATUS[0][0], TASK_STATUS[1][0]]).delete()
+
+    task = JobsTask(user=user, type=task_type, job=job, parent=parent, date=now())
+    if archive is not None:
+        task.archive.save(archive.name, archive, False)
+    task.save()
+    return task
+
+
+class ProcessJobsTasks:
+    def __init__(self, limit):
+        self.processed = 0
+        for task in self.__get_tasks(limit):
+            self.__process(task)
+            self.processed += 1
+
+    @transaction.atomic
+    def __get_tasks(self, limit):
+        self.__fail_abandoned()
+        # Locked rows are skipped, so several workers can process the queue at the same time
+        tasks = list(JobsTask.objects.select_for_update(skip_locked=True)
+                     .filter(status=TASK_STATUS[0][0]).order_by('date')[:limit])
+        started = now()
+        JobsTask.objects.filter(id__in=list(t.id for t in tasks)).update(status=TASK_STATUS[1][0], started=started)
+        for task in tasks:
+            task.started = started
+        return tasks
+
+    def __fail_abandoned(self):
+        self.__is_not_used()
+        # Tasks of crashed workers could be partially processed, so they are not processed again.
+        # Running tasks refresh their start time on progress, so only tasks without progress are failed.
+        for task in JobsTask.objects.select_for_update(skip_locked=True).filter(
+                status=TASK_STATUS[1][0], started__lt=now() - timedelta(minutes=settings.JOBS_TASKS_TIMEOUT)):
+            if task.archive:
+                task.archive.delete(False)
+            task.status = TASK_STATUS[3][0]
+            task.error = str(_('The task was interrupted'))
+            task.save()
+
+    def __process(self, task):
+        actions = {
+            JOBS_TASK_TYPE[0][0]: self.__upload_job,
+            JOBS_TASK_TYPE[1][0]: self.__upload_tree,
+            JOBS_TASK_TYPE[2][0]: self.__upload_reports,
+            JOBS_TASK_TYPE[3][0]: self.__download_job
+        }
+        try:
+            actions[task.type](task)
+        except BridgeException as e:
+            task.status = TASK_STATUS[3][0]
+            task.error = str(e)[:1024]
+        except Exception as e:
+            logger.exception(e)
+            task.status = TASK_STATUS[3][0]
+            task.error = UNKNOWN_ERROR
+        else:
+            task.status = TASK_STATUS[2][0]
+            task.progress = 100
+
+        # Uploaded archives are not needed anymore
+        if task.type != JOBS_TASK_TYPE[3][0] and task.archive:
+            task.archive.delete(False)
+        task.save()
 
-        # Uploading report
+    def __set_progress(self, task, progress):
+        self.__is_not_used()
+        # Progress is saved only if it was changed or the start time was refreshed long ago, so it can be set often
+        if progress != task.progress or task.started is None or task.started < now() - timedelta(minutes=1):
+            task.progress = progress
+            task.started = now()
+            JobsTask.objects.filter(id=task.id).update(progress=progress, started=task.started)
+
+    def __extract_archive(self, task):
+        self.__is_not_used()
+        try:
+            with task.archive as fp:
+                return extract_archive(fp)
+        except Exception as e:
+            logger.exception(e)
+            raise BridgeException(_('Extraction of the archive "%(arcname)s" has failed') % {
+                'arcname': os.path.basename(task.archive.name)
+            })
+
+    @unparallel_group([Job, 'AttrName'])
+    def __upload_job(self, task):
+        job_dir = self.__extract_archive(task)
+        self.__set_progress(task, 10)
         try:
-            with OpenFiles(*files, rel_path=self._reports_dir) as archives:
-                res = UploadReport(self._job, report, archives=archives, source_archives=self.source_archives)
-            if res.error is not None:
-                raise ValueError(res.error)
-        except FileNotFoundError:
-            logger.error('Files {} were not found'.format(files))
+            UploadJob(task.parent, task.user, job_dir.name)
+        except BridgeException as e:
+            raise BridgeException(_('Creating the job from archive "%(arcname)s" failed: %(message)s') % {
+                'arcname': os.path.basename(task.archive.name), 'message': str(e)
+            })
+        except Exception as e:
+            logger.exception(e)
+            raise BridgeException(_('Creating the job from archive "%(arcname)s" failed: %(message)s') % {
+                'arcname': os.path.basename(task.archive.name), 'message': _('The job archive is corrupted')
+            })
+
+    @unparallel_group([Job, 'AttrName'])
+    def __upload_tree(self, task):
+        if Job.objects.filter(status__in=[JOB_STATUS[1][0], JOB_STATUS[2][0]]).count() > 0:
+            raise BridgeException(_("There are jobs in progress right now, uploading may corrupt it results. "
+                                    "Please wait until it will be finished."))
+        jobs_dir = self.__extract_archive(task)
+        UploadTree(task.parent, task.user, jobs_dir.name, lambda progress: self.__set_progress(task, progress))
+
+    @unparallel_group([Job])
+    def __upload_reports(self, task):
+        reports_dir = self.__extract_archive(task)
+        UploadReportsWithoutDecision(
+            task.job, task.user, reports_dir.name, lambda progress: self.__set_progress(task, progress)
+        )
+
+    def __download_job(self, task):
+        generator = JobArchiveGenerator(task.job)
+        with tempfile.TemporaryFile() as fp:
+            for data in generator:
+                fp.write(data)
+                self.__set_progress(task, generator.progress)
+            fp.seek(0)
+            task.archive.save(generator.arcname, File(fp), False)
+
+    def __is_not_used(self):
+        pass
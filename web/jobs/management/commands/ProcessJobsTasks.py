@@ -0,0 +1,45 @@
+#
+# CVV is a continuous verification visualizer.
+# Copyright (c) 2023 ISP RAS (http://www.ispras.ru)
+# Ivannikov Institute for System Programming of the Russian Academy of Sciences
+#
+# Copyright (c) 2018 ISP RAS (http://www.ispras.ru)
+# Ivannikov Institute for System Programming of the Russian Academy of Sciences
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import time
+
+from django.core.management.base import BaseCommand
+
+from jobs.Download import ProcessJobsTasks
+
+
+class Command(BaseCommand):
+    help = 'Uploads jobs and reports and downloads jobs in background.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help='Process pending tasks and exit.')
+        parser.add_argument('--limit', type=int, default=1, help='Maximum number of tasks processed at a time.')
+        parser.add_argument('--sleep', type=float, default=5, help='Seconds to wait if there are no pending tasks.')
+
+    def handle(self, *args, **options):
+        while True:
+            res = ProcessJobsTasks(options['limit'])
+            if res.processed > 0:
+                self.stdout.write('{} jobs tasks were processed'.format(res.processed))
+            elif options['once']:
+                break
+            else:
+                time.sleep(options['sleep'])
@@ -24,9 +24,11 @@ from django.db import models
 from django.db.models.signals import pre_delete
 from django.dispatch.dispatcher import receiver
 
-from web.vars import FORMAT, JOB_ROLES, JOB_STATUS, JOB_WEIGHT
+from web.vars import FORMAT, JOB_ROLES, JOB_STATUS, JOB_WEIGHT, JOBS_TASK_TYPE, TASK_STATUS
 
 JOBFILE_DIR = 'Job'
+REPORTS_UPLOAD_DIR = 'ReportsUploads'
+JOBS_TASKS_DIR = 'JobsTasks'
 
 
 class JobFile(models.Model):
@@ -113,3 +115,69 @@ class UserRole(models.Model):
 
     class Meta:
         db_table = 'user_job_role'
+
+
+class ReportsUpload(models.Model):
+    job = models.ForeignKey(Job, models.CASCADE)
+    user = models.ForeignKey(User, models.CASCADE, related_name='+')
+    # Hash of the archive size, the chunk size and hashes of all chunks, so the same upload can be resumed
+    identifier = models.CharField(max_length=64)
+    size = models.BigIntegerField()
+    chunk_size = models.PositiveIntegerField()
+    chunks = models.TextField()
+    archive = models.FileField(upload_to=REPORTS_UPLOAD_DIR)
+    date = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        db_table = 'job_reports_upload'
+        unique_together = ['job', 'identifier']
+
+
+class ReportsUploadChunk(models.Model):
+    upload = models.ForeignKey(ReportsUpload, models.CASCADE, related_name='received')
+    index = models.PositiveIntegerField()
+
+    class Meta:
+        db_table = 'job_reports_upload_chunk'
+        unique_together = ['upload', 'index']
+
+
+@receiver(pre_delete, sender=ReportsUpload)
+def reports_upload_delete_signal(**kwargs):
+    upload = kwargs['instance']
+    if upload.archive:
+        storage, path = upload.archive.storage, upload.archive.path
+        try:
+            storage.delete(path)
+        except PermissionError:
+            pass
+
+
+class JobsTask(models.Model):
+    user = models.ForeignKey(User, models.CASCADE, related_name='+')
+    type = models.CharField(max_length=15, choices=JOBS_TASK_TYPE)
+    status = models.CharField(max_length=10, choices=TASK_STATUS, default='PENDING')
+    progress = models.PositiveSmallIntegerField(default=0)
+    # The downloaded job or the job of uploaded reports
+    job = models.ForeignKey(Job, models.CASCADE, null=True, related_name='+')
+    # Identifier of the parent of uploaded jobs
+    parent = models.CharField(max_length=255, null=True)
+    # Uploaded archive or the archive of the downloaded job
+    archive = models.FileField(upload_to=JOBS_TASKS_DIR, null=True)
+    error = models.CharField(max_length=1024, null=True)
+    date = models.DateTimeField()
+    started = models.DateTimeField(null=True)
+
+    class Meta:
+        db_table = 'jobs_task'
+
+
+@receiver(pre_delete, sender=JobsTask)
+def jobs_task_delete_signal(**kwargs):
+    task = kwargs['instance']
+    if task.archive:
+        storage, path = task.archive.storage, task.archive.path
+        try:
+            storage.delete(path)
+        except PermissionError:
+            pass
@@ -21,17 +21,20 @@
 
 import json
 import os
+from datetime import timedelta
 
 from django.conf import settings
 from django.core.exceptions import ObjectDoesNotExist, MultipleObjectsReturned
 from django.urls import reverse
+from django.utils.timezone import now
 
+from jobs.Download import ProcessJobsTasks
 from jobs.jobForm import LoadFilesTree
-from jobs.models import Job, JobHistory, JobFile, FileSystem, RunHistory
+from jobs.models import Job, JobHistory, JobFile, FileSystem, RunHistory, JobsTask
 from users.models import User, View, PreferableView
 from web.populate import populate_users
 from web.utils import CVTestCase
-from web.vars import JOB_ROLES, JOB_STATUS
+from web.vars import JOB_ROLES, JOB_STATUS, TASK_STATUS
 
 
 class TestJobs(CVTestCase):
@@ -405,6 +408,51 @@ class TestJobs(CVTestCase):
         self.assertIn('content', res)
         self.assertEqual(res['content'], 'My test text')
 
+    def test_jobs_tasks(self):
+        job_template = Job.objects.all().first()
+        response = self.client.post(reverse('jobs:form', args=[job_template.pk, 'copy']), {
+            'name': 'New job title', 'description': 'Description of new job', 'parent': job_template.identifier,
+            'global_role': JOB_ROLES[0][0], 'user_roles': '[]',
+            'file_data': json.dumps([{"type": "root", "text": "Files", "children": []}])
+        })
+        newjob_pk = int(json.loads(str(response.content, encoding='utf8'))['job_id'])
+
+        # Download the job in background
+        response = self.client.post('/jobs/download_task/%s/' % newjob_pk)
+        self.assertEqual(response.status_code, 200)
+        task_id = json.loads(str(response.content, encoding='utf8'))['task']
+        response = self.client.get('/jobs/tasks/result/%s/' % task_id)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(ProcessJobsTasks(10).processed, 1)
+        response = self.client.post('/jobs/tasks/status/%s/' % task_id)
+        self.assertEqual(json.loads(str(response.content, encoding='utf8')), {
+            'status': TASK_STATUS[2][0], 'progress': 100, 'error': None
+        })
+        response = self.client.get('/jobs/tasks/result/%s/' % task_id)
+        self.assertEqual(response.status_code, 200)
+        with open(os.path.join(settings.MEDIA_ROOT, self.test_archive), mode='wb') as fp:
+            for content in response.streaming_content:
+                fp.write(content)
+
+        # Upload the downloaded job in background
+        self.client.post('/jobs/remove/', {'jobs': json.dumps([newjob_pk])})
+        with self.settings(JOBS_TASKS_IN_BACKGROUND=True):
+            with open(os.path.join(settings.MEDIA_ROOT, self.test_archive), mode='rb') as fp:
+                response = self.client.post('/jobs/upload_jobs/%s/' % job_template.identifier, {'file': fp})
+        self.assertEqual(response.status_code, 200)
+        task_id = json.loads(str(response.content, encoding='utf8'))['tasks'][0]
+        self.assertEqual(Job.objects.filter(parent=job_template, name='New job title').count(), 0)
+        self.assertEqual(ProcessJobsTasks(10).processed, 1)
+        self.assertEqual(JobsTask.objects.get(id=task_id).status, TASK_STATUS[2][0])
+        self.assertEqual(Job.objects.filter(parent=job_template, name='New job title').count(), 1)
+
+        # Tasks abandoned by crashed workers are failed
+        JobsTask.objects.filter(id=task_id).update(
+            status=TASK_STATUS[1][0], started=now() - timedelta(minutes=settings.JOBS_TASKS_TIMEOUT + 1)
+        )
+        self.assertEqual(ProcessJobsTasks(10).processed, 0)
+        self.assertEqual(JobsTask.objects.get(id=task_id).status, TASK_STATUS[3][0])
+
     def test_run_decision(self):
         file_data = [{"type": "root", "text": "Files", "children": []}]
         job_template = Job.objects.all().first()
@@ -60,6 +60,9 @@ urlpatterns = [
     path('downloadtrees/', views.DownloadJobsTreeView.as_view()),
     path('upload_jobs/<slug:parent_id>/', views.UploadJobsView.as_view()),
     path('upload_jobs_tree/', views.UploadJobsTreeView.as_view()),
+    path('download_task/<int:pk>/', views.DownloadJobTaskView.as_view()),
+    path('tasks/status/<int:pk>/', views.JobsTaskStatusView.as_view()),
+    path('tasks/result/<int:pk>/', views.DownloadJobsTaskResultView.as_view()),
 
     # Actions with job solving
     path('run_decision/<int:job_id>/', views.StartDecision.as_view()),
@@ -72,4 +75,7 @@ urlpatterns = [
 
     # Actions with reports
     path('upload_reports/<int:pk>/', views.UploadReportsView.as_view()),
+    path('upload_reports/<int:pk>/start/', views.StartReportsUploadView.as_view()),
+    path('upload_reports/chunk/<int:pk>/', views.UploadReportsChunkView.as_view()),
+    path('upload_reports/finish/<int:pk>/', views.FinishReportsUploadView.as_view()),
 ]
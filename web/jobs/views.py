@@ -20,10 +20,12 @@
 #
 
 import json
+import os
 from difflib import unified_diff
 from urllib.parse import unquote
 from wsgiref.util import FileWrapper
 
+from django.conf import settings
 from django.contrib.auth.decorators import login_required
 from django.core.exceptions import ObjectDoesNotExist
 from django.http import JsonResponse
@@ -37,19 +39,20 @@ from django.views.generic.detail import SingleObjectMixin, DetailView
 import jobs.utils
 import web.CustomViews as Bview
 from jobs.Download import UploadJob, JobArchiveGenerator, JobsArchivesGen, \
-    UploadReportsWithoutDecision, JobsTreesGen, UploadTree
+    UploadReportsWithoutDecision, JobsTreesGen, UploadTree, start_reports_upload, upload_reports_chunk, \
+    finish_reports_upload, create_jobs_task
 from jobs.JobTableProperties import TableTree
 from jobs.ViewJobData import ViewJobData, update_job_view_attrs
 from jobs.configuration import GetConfiguration
 from jobs.jobForm import JobForm, role_info, LoadFilesTree, UserRolesForm
-from jobs.models import Job, RunHistory, JobHistory, JobFile, FileSystem
+from jobs.models import Job, RunHistory, JobHistory, JobFile, FileSystem, ReportsUpload, JobsTask
 from reports.models import ReportComponent, ReportAttr
 from reports.utils import FilesForCompetitionArchive
 from service.utils import StartJobDecision, StopDecision
 from tools.profiling import LoggedCallMixin
 from users.models import User
 from web.utils import logger, file_get_or_create, extract_archive, BridgeException
-from web.vars import VIEW_TYPES, JOB_STATUS, PRIORITY, JOB_WEIGHT, USER_ROLES
+from web.vars import VIEW_TYPES, JOB_STATUS, PRIORITY, JOB_WEIGHT, USER_ROLES, JOBS_TASK_TYPE, TASK_STATUS
 
 
 @register.filter
@@ -415,6 +418,10 @@ class UploadJobsView(LoggedCallMixin, Bview.JsonView):
     def get_context_data(self, **kwargs):
         if not jobs.utils.JobAccess(self.request.user).can_create():
             raise BridgeException(_("You don't have an access to upload jobs"))
+        if settings.JOBS_TASKS_IN_BACKGROUND:
+            return {'tasks': list(create_jobs_task(
+                self.request.user, JOBS_TASK_TYPE[0][0], archive=f, parent=self.kwargs['parent_id']
+            ).id for f in self.request.FILES.getlist('file'))}
         for f in self.request.FILES.getlist('file'):
             try:
                 job_dir = extract_archive(f)
@@ -444,6 +451,11 @@ class UploadJobsTreeView(LoggedCallMixin, Bview.JsonView):
         if Job.objects.filter(status__in=[JOB_STATUS[1][0], JOB_STATUS[2][0]]).count() > 0:
             raise BridgeException(_("There are jobs in progress right now, uploading may corrupt it results. "
                                     "Please wait until it will be finished."))
+        if settings.JOBS_TASKS_IN_BACKGROUND:
+            return {'task': create_jobs_task(
+                self.request.user, JOBS_TASK_TYPE[1][0], archive=self.request.FILES['file'],
+                parent=self.request.POST['parent_id']
+            ).id}
 
         jobs_dir = extract_archive(self.request.FILES['file'])
         UploadTree(self.request.POST['parent_id'], self.request.user, jobs_dir.name)
@@ -525,6 +537,10 @@ class UploadReportsView(LoggedCallMixin, Bview.JsonDetailPostView):
     def get_context_data(self, **kwargs):
         if not jobs.utils.JobAccess(self.request.user, self.object).can_decide():
             raise BridgeException(_("You don't have an access to upload reports for this job"))
+        if settings.JOBS_TASKS_IN_BACKGROUND:
+            return {'task': create_jobs_task(
+                self.request.user, JOBS_TASK_TYPE[2][0], archive=self.request.FILES['archive'], job=self.object
+            ).id}
 
         try:
             reports_dir = extract_archive(self.request.FILES['archive'])
@@ -534,3 +550,72 @@ class UploadReportsView(LoggedCallMixin, Bview.JsonDetailPostView):
 
         UploadReportsWithoutDecision(self.object, self.request.user, reports_dir.name)
         return {}
+
+
+class StartReportsUploadView(LoggedCallMixin, Bview.JsonDetailPostView):
+    model = Job
+
+    def get_context_data(self, **kwargs):
+        if not jobs.utils.JobAccess(self.request.user, self.object).can_decide():
+            raise BridgeException(_("You don't have an access to upload reports for this job"))
+        upload, missing = start_reports_upload(
+            self.object, self.request.user, json.loads(self.request.POST['size']),
+            json.loads(self.request.POST['chunk_size']), json.loads(self.request.POST['chunks'])
+        )
+        return {'upload': upload.id, 'missing': missing}
+
+
+class UploadReportsChunkView(LoggedCallMixin, Bview.JsonDetailPostView):
+    model = ReportsUpload
+
+    def get_context_data(self, **kwargs):
+        if not jobs.utils.JobAccess(self.request.user, self.object.job).can_decide():
+            raise BridgeException(_("You don't have an access to upload reports for this job"))
+        upload_reports_chunk(self.object, int(self.request.POST['index']), self.request.FILES['chunk'])
+        return {}
+
+
+class FinishReportsUploadView(LoggedCallMixin, Bview.JsonDetailPostView):
+    model = ReportsUpload
+    unparallel = [Job]
+
+    def get_context_data(self, **kwargs):
+        if not jobs.utils.JobAccess(self.request.user, self.object.job).can_decide():
+            raise BridgeException(_("You don't have an access to upload reports for this job"))
+        task = finish_reports_upload(self.object, self.request.user)
+        if task is not None:
+            return {'task': task.id}
+        return {}
+
+
+class DownloadJobTaskView(LoggedCallMixin, Bview.JsonDetailPostView):
+    model = Job
+
+    def get_context_data(self, **kwargs):
+        if not jobs.utils.JobAccess(self.request.user, self.object).can_download():
+            raise BridgeException(code=400)
+        return {'task': create_jobs_task(self.request.user, JOBS_TASK_TYPE[3][0], job=self.object).id}
+
+
+class JobsTaskStatusView(LoggedCallMixin, Bview.JsonDetailPostView):
+    model = JobsTask
+
+    def get_context_data(self, **kwargs):
+        if self.object.user != self.request.user:
+            raise BridgeException(code=400)
+        return {'status': self.object.status, 'progress': self.object.progress, 'error': self.object.error}
+
+
+@method_decorator(login_required, name='dispatch')
+class DownloadJobsTaskResultView(LoggedCallMixin, SingleObjectMixin, Bview.StreamingResponseView):
+    model = JobsTask
+
+    def get_generator(self):
+        self.object = self.get_object()
+        if self.object.user != self.request.user or self.object.type != JOBS_TASK_TYPE[3][0]:
+            raise BridgeException(code=400)
+        if self.object.status != TASK_STATUS[2][0] or not self.object.archive:
+            raise BridgeException(_('The job archive is not ready yet'))
+        self.file_name = os.path.basename(self.object.archive.name)
+        self.file_size = self.object.archive.size
+        return FileWrapper(self.object.archive, 8192)
@@ -162,7 +162,7 @@ class AllMarksGen(object):
             for mark in table.objects.filter(~Q(version=0)):
                 markgen = MarkArchiveGenerator(mark)
                 buf = b''
-                for data in self.stream.compress_stream(markgen.name, markgen):
+                for data in self.stream.compress_stream(markgen.name, markgen, zipfile.ZIP_STORED):
                     buf += data
                     if len(buf) > CHUNK_SIZE:
                         yield buf
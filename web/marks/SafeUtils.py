@@ -29,7 +29,7 @@ from django.db.models import F, Q
 from django.utils.timezone import now
 from django.utils.translation import gettext_lazy as _
 
-from marks.attributes import create_attributes, get_marks_attributes, get_reports_by_attributes
+from marks.attributes import create_attributes, get_marks_attributes, get_reports_by_attributes, AttributesIndex
 from marks.models import MarkSafe, MarkSafeHistory, MarkSafeReport, MarkSafeAttr, \
     SafeTag, MarkSafeTag, SafeReportTag, ReportSafeTag
 from reports.models import ReportComponentLeaf, ReportSafe, Attr, AttrName
@@ -286,8 +286,9 @@ class ConnectMarks:
 
 
 class ConnectReport:
-    def __init__(self, safe):
+    def __init__(self, safe, index=None):
         self.report = safe
+        self._index = index
         self.__connect()
         RecalculateTags([self.report])
 
@@ -303,7 +304,10 @@ class ConnectReport:
                 verdicts[mark_id] = set()
             verdicts[mark_id].add(verdict)
             marks_attrs[mark_id].add((name, value, op))
-        marks_reports = get_reports_by_attributes('safe', marks_attrs, {'report': self.report})
+        if self._index is None:
+            marks_reports = get_reports_by_attributes('safe', marks_attrs, {'report': self.report})
+        else:
+            marks_reports = self._index.get_reports(marks_attrs, {self.report.id})
 
         new_markreports = []
         verdicts_set = set()
@@ -326,12 +330,15 @@ class ConnectReport:
 
 
 class RecalculateTags:
-    def __init__(self, reports):
+    # Caches of components can be filled once for all leaves after caches of leaves are filled by parts
+    def __init__(self, reports, leaves=True, components=True):
         self.reports = reports
         self.changes = {}
         if len(self.reports) > 0:
-            self.__fill_leaves_cache()
-            self.__fill_reports_cache()
+            if leaves:
+                self.__fill_leaves_cache()
+            if components:
+                self.__fill_reports_cache()
 
     def __fill_leaves_cache(self):
         old_numbers = {}
@@ -468,8 +475,9 @@ class RecalculateConnections:
         MarkSafeReport.objects.filter(report__root__in=self._roots).delete()
         ReportSafe.objects.filter(root__in=self._roots).update(verdict=SAFE_VERDICTS[4][0], has_confirmed=False)
         safes = []
+        index = AttributesIndex('safe', {'report__root__in': self._roots})
         for safe in ReportSafe.objects.filter(root__in=self._roots):
-            ConnectReport(safe)
+            ConnectReport(safe, index)
             safes.append(safe)
         RecalculateTags(safes)
 
@@ -29,7 +29,7 @@ from django.db.models import ProtectedError, F
 from django.utils.timezone import now
 from django.utils.translation import gettext_lazy as _
 
-from marks.attributes import create_attributes, get_marks_attributes, get_reports_by_attributes
+from marks.attributes import create_attributes, get_marks_attributes, get_reports_by_attributes, AttributesIndex
 from marks.models import MarkUnknown, MarkUnknownHistory, MarkUnknownAttr, MarkUnknownReport, UnknownProblem
 from reports.models import ReportUnknown, ReportComponentLeaf, Component, Attr, AttrName
 from users.models import User
@@ -278,11 +278,14 @@ class ConnectMark:
 
 
 class ConnectReport:
-    def __init__(self, report, update_cache=True):
+    def __init__(self, report, update_cache=True, index=None):
         self._update_cache = update_cache
         self.report = report
         self._marks_attrs = self.__get_marks_attrs()
-        self.marks_reports = get_reports_by_attributes('unknown', self._marks_attrs, {'report': self.report})
+        if index is None:
+            self.marks_reports = get_reports_by_attributes('unknown', self._marks_attrs, {'report': self.report})
+        else:
+            self.marks_reports = index.get_reports(self._marks_attrs, {self.report.id})
         self.__connect()
 
     def __get_marks_attrs(self):
@@ -332,8 +335,9 @@ class RecalculateConnections:
 
     def __recalc(self):
         MarkUnknownReport.objects.filter(report__root__in=self._roots).delete()
+        index = AttributesIndex('unknown', {'report__root__in': self._roots})
         for unknown in ReportUnknown.objects.filter(root__in=self._roots):
-            ConnectReport(unknown, False)
+            ConnectReport(unknown, False, index)
         update_unknowns_cache(ReportUnknown.objects.filter(root__in=self._roots))
 
 
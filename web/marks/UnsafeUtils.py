@@ -20,20 +20,26 @@
 #
 
 import json
+import multiprocessing
+import os
 import time
+from concurrent.futures import ProcessPoolExecutor
 
+from django.conf import settings
 from django.db import transaction
 from django.db.models import F
 from django.utils.timezone import now
 from django.utils.translation import gettext_lazy as _
 
 from marks.attributes import create_attributes, get_marks_attributes, get_reports_by_attributes, get_user_attrs, \
-    get_basic_attributes
+    get_basic_attributes, AttributesIndex
 from marks.models import ConvertedTraces, MarkUnsafe, MarkUnsafeHistory, MarkUnsafeReport, MarkUnsafeAttr, \
-    MarkUnsafeTag, UnsafeTag, UnsafeReportTag, ReportUnsafeTag
+    MarkUnsafeTag, UnsafeTag, UnsafeReportTag, ReportUnsafeTag, ErrorTraceConvertionCache
 from reports.mea.wrapper import error_trace_pretty_parse, TAG_CONVERSION_FUNCTION, TAG_COMPARISON_FUNCTION, \
     TAG_EDITED_ERROR_TRACE, get_or_convert_error_trace, dump_converted_error_trace, DEFAULT_CONVERSION_FUNCTION, \
-    DEFAULT_COMPARISON_FUNCTION, is_trace_equal, automatic_error_trace_editing
+    DEFAULT_COMPARISON_FUNCTION, is_trace_equal, automatic_error_trace_editing, process_args, \
+    init_traces_comparison, compare_unsafes_with_marks, DISABLE_CACHE, get_edited_fingerprint, \
+    get_compared_fingerprint
 from reports.models import ReportComponentLeaf, ReportUnsafe
 from users.models import User
 from web.utils import logger, BridgeException, unique_id
@@ -42,6 +48,9 @@ from web.vars import UNKNOWN_ERROR, UNSAFE_VERDICTS, USER_ROLES, MARK_STATUS, MA
 
 UNSAFE_MARK_TIME_THRESHOLD = 1  # sec
 
+# Number of unsafes which are compared with marks by one task of the worker process
+MARKS_COMPARISON_CHUNK = 50
+
 OPTIMIZATION_APPLY_FOR_CURRENT = 'apply_for_current'
 OPTIMIZATION_DO_NOT_RECALC = 'do_not_recalc'
 OPTIMIZATIONS = [OPTIMIZATION_APPLY_FOR_CURRENT, OPTIMIZATION_DO_NOT_RECALC]
@@ -391,6 +400,42 @@ class ConnectMarks:
             time_previous = time.time()
         return time_previous
 
+    def __get_comparison_tasks(self, unsafes, args_str):
+        cached = {}
+        if not DISABLE_CACHE:
+            for unsafe_id, function, converted_id, path, fingerprint in ErrorTraceConvertionCache.objects \
+                    .filter(unsafe__in=unsafes, function__in=set(self.conversion_functions.values()),
+                            args=args_str).order_by('id') \
+                    .values_list('unsafe_id', 'function', 'converted_id', 'converted__file', 'converted__fingerprint'):
+                cached.setdefault(unsafe_id, {})[function] = (
+                    converted_id, os.path.join(settings.MEDIA_ROOT, path), fingerprint
+                )
+
+        tasks = []
+        for unsafe in unsafes:
+            mark_ids = list(m_id for m_id in self.edited_error_trace if unsafe.id in self.marks_reports[m_id])
+            if mark_ids:
+                tasks.append((unsafe.id, unsafe.error_trace.path, cached.get(unsafe.id, {}), mark_ids))
+        return tasks
+
+    def __compare(self, unsafes, args, args_str):
+        tasks = self.__get_comparison_tasks(unsafes, args_str)
+        marks = dict((m_id, (self.edited_error_trace[m_id], get_edited_fingerprint(self.edited_error_trace[m_id]),
+                             self.conversion_functions[m_id], self.comparison_functions[m_id]))
+                     for m_id in self.edited_error_trace)
+        chunks = list(tasks[i:i + MARKS_COMPARISON_CHUNK] for i in range(0, len(tasks), MARKS_COMPARISON_CHUNK))
+        processes = min(settings.MARKS_COMPARISON_PROCESSES, len(chunks))
+        if processes <= 1:
+            init_traces_comparison(marks, self.similarity_threshold, args)
+            for chunk in chunks:
+                yield compare_unsafes_with_marks(chunk)
+            return
+        with ProcessPoolExecutor(max_workers=processes, mp_context=multiprocessing.get_context('fork'),
+                                 initializer=init_traces_comparison,
+                                 initargs=(marks, self.similarity_threshold, args)) as pool:
+            # Results of chunks are processed as soon as they are ready
+            yield from pool.map(compare_unsafes_with_marks, chunks)
+
     def __connect(self):
         unsafes_ids = set()
         for mark_id, report_ids in self.marks_reports.items():
@@ -428,52 +473,53 @@ class ConnectMarks:
         else:
             target_unsafes = ReportUnsafe.objects.filter(id__in=unsafes_ids)
 
-        number_of_target_unsafes = target_unsafes.count()
-
-        for unsafe in target_unsafes:
-            for mark_id in self.edited_error_trace:
-                if unsafe.id not in self.marks_reports[mark_id]:
-                    continue
-                compare_error = None
-                compare_result = 0
-                try:
-                    converted_error_trace = get_or_convert_error_trace(unsafe, self.conversion_functions[mark_id],
-                                                                       self.conversion_function_args)
-                    is_equal, compare_result = is_trace_equal(self.edited_error_trace[mark_id], converted_error_trace,
-                                                              self.comparison_functions[mark_id],
-                                                              self.similarity_threshold)
-                    counter_all += 1
-
-                    time_previous = self.__update_progress(marks[mark_id], counter_all, counter_applied,
-                                                           number_of_target_unsafes, time_previous)
-                    if not is_equal:
-                        continue
-                    counter_applied += 1
-                    time_previous = self.__update_progress(marks[mark_id], counter_all, counter_applied,
-                                                           number_of_target_unsafes, time_previous)
-
-                except BridgeException as e:
-                    compare_error = str(e)
-                except Exception as e:
-                    logger.exception("Error traces comparison failed: %s" % e, exc_info=e)
-                    compare_error = str(UNKNOWN_ERROR)
-
-                ass_type = ASSOCIATION_TYPE[0][0]
-                if self._prime_id == unsafe.id:
-                    ass_type = ASSOCIATION_TYPE[1][0]
-                new_markreports.append(MarkUnsafeReport(
-                    mark_id=mark_id, report=unsafe, result=compare_result, error=compare_error,
-                    type=ass_type, author=self._author[mark_id]
-                ))
-                if mark_id not in self.changes:
-                    self.changes[mark_id] = {}
-                if unsafe in self.changes[mark_id]:
-                    self.changes[mark_id][unsafe]['kind'] = '='
-                    self.changes[mark_id][unsafe]['result2'] = compare_result
-                else:
-                    self.changes[mark_id][unsafe] = {
-                        'kind': '+', 'result2': compare_result, 'verdict1': unsafe.verdict
-                    }
+        target_unsafes = list(target_unsafes)
+        number_of_target_unsafes = len(target_unsafes)
+        unsafes = dict((unsafe.id, unsafe) for unsafe in target_unsafes)
+        args = dict(self.conversion_function_args or {})
+        process_args(args)
+        args_str = json.dumps(args, sort_keys=True)
+
+        for chunk_results in self.__compare(target_unsafes, args, args_str):
+            new_cache = []
+            for unsafe_id, results, converted, fingerprints in chunk_results:
+                unsafe = unsafes[unsafe_id]
+                if not DISABLE_CACHE:
+                    for conversion_function, (converted_error_trace, fingerprint) in converted.items():
+                        new_cache.append(ErrorTraceConvertionCache(
+                            unsafe=unsafe, function=conversion_function, args=args_str,
+                            converted=dump_converted_error_trace(converted_error_trace, fingerprint)
+                        ))
+                for converted_id, fingerprint in fingerprints.items():
+                    ConvertedTraces.objects.filter(id=converted_id).update(fingerprint=json.dumps(fingerprint))
+                for mark_id, is_equal, compare_result, compare_error in results:
+                    if compare_error is None:
+                        counter_all += 1
+                        time_previous = self.__update_progress(marks[mark_id], counter_all, counter_applied,
+                                                               number_of_target_unsafes, time_previous)
+                        if not is_equal:
+                            continue
+                        counter_applied += 1
+                        time_previous = self.__update_progress(marks[mark_id], counter_all, counter_applied,
+                                                               number_of_target_unsafes, time_previous)
+
+                    ass_type = ASSOCIATION_TYPE[0][0]
+                    if self._prime_id == unsafe.id:
+                        ass_type = ASSOCIATION_TYPE[1][0]
+                    new_markreports.append(MarkUnsafeReport(
+                        mark_id=mark_id, report=unsafe, result=compare_result, error=compare_error,
+                        type=ass_type, author=self._author[mark_id]
+                    ))
+                    if mark_id not in self.changes:
+                        self.changes[mark_id] = {}
+                    if unsafe in self.changes[mark_id]:
+                        self.changes[mark_id][unsafe]['kind'] = '='
+                        self.changes[mark_id][unsafe]['result2'] = compare_result
+                    else:
+                        self.changes[mark_id][unsafe] = {
+                            'kind': '+', 'result2': compare_result, 'verdict1': unsafe.verdict
+                        }
+            ErrorTraceConvertionCache.objects.bulk_create(new_cache)
         MarkUnsafeReport.objects.bulk_create(new_markreports)
         for mark_id in marks:
             marks[mark_id].format = 1
@@ -521,13 +567,16 @@ class ConnectMarks:
 
 
 class ConnectReport:
-    def __init__(self, unsafe):
+    def __init__(self, unsafe, index=None):
         self._unsafe = unsafe
         self._marks = {}
 
         MarkUnsafeReport.objects.filter(report=self._unsafe).delete()
         self._marks_attrs = self.__get_marks_attrs()
-        self.marks_reports = get_reports_by_attributes('unsafe', self._marks_attrs, {'report': unsafe})
+        if index is None:
+            self.marks_reports = get_reports_by_attributes('unsafe', self._marks_attrs, {'report': unsafe})
+        else:
+            self.marks_reports = index.get_reports(self._marks_attrs, {unsafe.id})
         self.__connect()
 
     def __get_marks_attrs(self):
@@ -551,21 +600,27 @@ class ConnectReport:
         for converted in ConvertedTraces.objects.filter(
                 id__in=set(self._marks[mid]['edited_error_trace'] for mid in self._marks)):
             with converted.file as fp:
-                patterns[converted.id] = fp.read().decode('utf8')
+                pattern = fp.read().decode('utf8')
+                patterns[converted.id] = (pattern, get_edited_fingerprint(pattern))
         for m_id in self._marks:
-            self._marks[m_id]['edited_error_trace'] = patterns[self._marks[m_id]['edited_error_trace']]
+            self._marks[m_id]['edited_error_trace'], self._marks[m_id]['fingerprint'] = \
+                patterns[self._marks[m_id]['edited_error_trace']]
 
+        converted = {}
         for mark_id in self._marks:
             compare_result = 0
             compare_error = None
             try:
-                converted_error_trace = get_or_convert_error_trace(self._unsafe,
-                                                                   self._marks[mark_id]['conversion_functions'],
-                                                                   json.loads(self._marks[mark_id]['args'] or "{}"))
+                key = (self._marks[mark_id]['conversion_functions'], self._marks[mark_id]['args'])
+                if key not in converted:
+                    converted_error_trace = get_or_convert_error_trace(self._unsafe, key[0],
+                                                                       json.loads(key[1] or "{}"))
+                    converted[key] = (converted_error_trace, get_compared_fingerprint(converted_error_trace))
                 is_equal, compare_result = is_trace_equal(self._marks[mark_id]['edited_error_trace'],
-                                                          converted_error_trace,
+                                                          converted[key][0],
                                                           self._marks[mark_id]['comparison_functions'],
-                                                          self._marks[mark_id]['similarity_threshold'])
+                                                          self._marks[mark_id]['similarity_threshold'],
+                                                          self._marks[mark_id]['fingerprint'], converted[key][1])
                 if not is_equal:
                     continue
             except BridgeException as e:
@@ -593,11 +648,14 @@ class ConnectReport:
 
 
 class RecalculateTags:
-    def __init__(self, reports):
+    # Caches of components can be filled once for all leaves after caches of leaves are filled by parts
+    def __init__(self, reports, leaves=True, components=True):
         self.reports = reports
         self.changes = {}
-        self.__fill_leaves_cache()
-        self.__fill_reports_cache()
+        if leaves:
+            self.__fill_leaves_cache()
+        if components:
+            self.__fill_reports_cache()
 
     def __fill_leaves_cache(self):
         old_numbers = {}
@@ -722,8 +780,9 @@ class RecalculateConnections:
         MarkUnsafeReport.objects.filter(report__root__in=self._roots).delete()
         ReportUnsafe.objects.filter(root__in=self._roots).update(verdict=UNSAFE_VERDICTS[5][0], has_confirmed=False)
         unsafes = []
+        index = AttributesIndex('unsafe', {'report__root__in': self._roots})
         for unsafe in ReportUnsafe.objects.filter(root__in=self._roots):
-            ConnectReport(unsafe)
+            ConnectReport(unsafe, index)
             unsafes.append(unsafe)
         RecalculateTags(unsafes)
 
@@ -16,8 +16,9 @@
 # limitations under the License.
 #
 
-from django.db.models import FloatField
-from django.db.models import Q, F
+import re
+
+from django.db.models import F, Case, When, FloatField
 from django.db.models.functions import Cast
 
 from marks.models import MarkUnsafeHistory, MarkSafeHistory, MarkUnknownHistory
@@ -28,6 +29,19 @@ from web.vars import ATTRIBUTES_OPERATOR_EQ, ATTRIBUTES_OPERATOR_RE, ATTRIBUTES_
 
 VALUES_SEPARATOR = ","
 
+# Maximum number of attribute values in one query
+ATTR_VALUES_CHUNK = 1000
+
+# Numbers which are compared by numeric operators. Their length is limited, so they fit into the floating point type.
+NUMBER_RE = r'^[-+]?([0-9]{1,200}(\.[0-9]{0,100})?|\.[0-9]{1,100})([eE][-+]?[0-9]{1,2})?$'
+
+NUMBER_LOOKUPS = {
+    ATTRIBUTES_OPERATOR_LE: 'lte',
+    ATTRIBUTES_OPERATOR_LT: 'lt',
+    ATTRIBUTES_OPERATOR_GE: 'gte',
+    ATTRIBUTES_OPERATOR_GT: 'gt'
+}
+
 
 def get_basic_attributes(mark_unsafe) -> list:
     attrs = []
@@ -148,79 +162,178 @@ def get_user_attrs(args: dict) -> dict:
     return marks_attrs
 
 
-def get_reports_by_attributes(mark_type: str, marks_attrs: dict, attr_filters: dict = None):
-    marks_reports = dict()
+def get_reports_by_attributes(mark_type: str, marks_attrs: dict, attr_filters: dict = None, index=None):
+    if index is None:
+        index = AttributesIndex(mark_type, attr_filters)
+    return index.get_reports(marks_attrs)
 
-    for m_id, attrs_desc in marks_attrs.items():
-        attrs = dict()
-        for attr_desc in attrs_desc:
-            name = attr_desc[0]
-            value = str(attr_desc[1])
-            op = attr_desc[2]
-
-            if op == ATTRIBUTES_OPERATOR_EQ and VALUES_SEPARATOR not in value:
-                tmp_attrs = Attr.objects.filter(name__name=name, value=value).values_list('id')
-                if tmp_attrs:
-                    attrs[name] = {value}
-            else:
-                values = value.split(VALUES_SEPARATOR)
-                tmp_attrs = tuple()
-                if op == ATTRIBUTES_OPERATOR_EQ:
-                    tmp_attrs = Attr.objects.filter(name__name=name, value__in=values).values_list('id', 'value')
-                elif op == ATTRIBUTES_OPERATOR_RE:
-                    for val in values:
-                        tmp_attrs += tuple(Attr.objects.filter(name__name=name, value__regex=val).
-                                           values_list('id', 'value'))
-                elif op == ATTRIBUTES_OPERATOR_NE:
-                    tmp_attrs = Attr.objects.filter(~Q(value__in=values), name__name=name).values_list('id', 'value')
-                else:  # numbers
-                    if len(values) == 1:
-                        try:
-                            number = float(values[0])
-                            if op == ATTRIBUTES_OPERATOR_LE:
-                                tmp_attrs = Attr.objects.annotate(value_float=Cast('value', FloatField())). \
-                                    filter(name__name=name, value_float__lte=number). \
-                                    values_list('id', 'value')
-                            elif op == ATTRIBUTES_OPERATOR_LT:
-                                tmp_attrs = Attr.objects.annotate(value_float=Cast('value', FloatField())). \
-                                    filter(name__name=name, value_float__lt=number). \
-                                    values_list('id', 'value')
-                            elif op == ATTRIBUTES_OPERATOR_GE:
-                                tmp_attrs = Attr.objects.annotate(value_float=Cast('value', FloatField())). \
-                                    filter(name__name=name, value_float__gte=number). \
-                                    values_list('id', 'value')
-                            elif op == ATTRIBUTES_OPERATOR_GT:
-                                tmp_attrs = Attr.objects.annotate(value_float=Cast('value', FloatField())). \
-                                    filter(name__name=name, value_float__gt=number). \
-                                    values_list('id', 'value')
-                        except Exception as e:
-                            logger.warning("Cannot parse number {}: {}".format(values[0], e))
-                    else:
-                        logger.warning("Only one number can be specified {}".format(values))
-                for attr_id, attr_value in tmp_attrs:
-                    if name not in attrs:
-                        attrs[name] = set()
-                    attrs[name].add(attr_value)
 
+class AttributesIndex:
+    # Inverted index from attributes to reports and marks.
+    # Attribute values, their reports and matched values of mark attributes are loaded on demand,
+    # so the same index can be used for several marks or reports without additional queries.
+    def __init__(self, mark_type: str, attr_filters: dict = None):
         if mark_type == 'unsafe':
-            report_attrs = ReportAttr.objects.exclude(report__reportunsafe=None)
+            self._report_attrs = ReportAttr.objects.exclude(report__reportunsafe=None)
         elif mark_type == 'safe':
-            report_attrs = ReportAttr.objects.exclude(report__reportsafe=None)
+            self._report_attrs = ReportAttr.objects.exclude(report__reportsafe=None)
         else:
-            report_attrs = ReportAttr.objects.exclude(report__reportunknown=None)
+            self._report_attrs = ReportAttr.objects.exclude(report__reportunknown=None)
         if attr_filters:
-            report_attrs = report_attrs.filter(**attr_filters)
-        report_ids = set()
-        for a_name, a_val in attrs.items():
-            cur_ids = set(x[0] for x in report_attrs.filter(attr__name__name=a_name, attr__value__in=a_val).
-                          values_list('report_id'))
-            if not report_ids:
-                report_ids = cur_ids
+            self._report_attrs = self._report_attrs.filter(**attr_filters)
+
+        # Attribute name -> values of existing attributes
+        self._values = {}
+        # Names of attributes with all values loaded for regular expressions;
+        # otherwise only values checked by equality operators are known
+        self._all_values = set()
+        # Attribute name -> values which existence was checked
+        self._checked = {}
+        # (attribute name, value) -> reports ids
+        self._reports = {}
+        # (attribute name, report id) -> values
+        self._report_values = {}
+        # (attribute name, value, operator) -> matched values
+        self._matched = {}
+
+    def get_reports(self, marks_attrs: dict, report_ids: set = None) -> dict:
+        # (attribute name, value, operator) -> marks ids
+        marks = {}
+        for m_id, attrs_desc in marks_attrs.items():
+            for name, value, op in attrs_desc:
+                marks.setdefault((name, str(value), op), set()).add(m_id)
+        self.__load_values(marks)
+        self.__load_reports(marks)
+
+        # Reports are calculated once for each mark attribute
+        attr_reports = {}
+        for desc in marks:
+            if report_ids is None:
+                attr_reports[desc] = set()
+                for value in self._matched[desc]:
+                    attr_reports[desc] |= self._reports[(desc[0], value)]
             else:
-                report_ids = report_ids.intersection(cur_ids)
-            if not report_ids:
-                break
-        if report_ids:
-            marks_reports[m_id] = report_ids
+                # Only values of the given reports are checked
+                attr_reports[desc] = set(r_id for r_id in report_ids if not self._matched[desc].isdisjoint(
+                    self._report_values.get((desc[0], r_id), ())
+                ))
+
+        marks_reports = {}
+        for m_id, attrs_desc in marks_attrs.items():
+            attrs = {}
+            for name, value, op in attrs_desc:
+                desc = (name, str(value), op)
+                if self._matched[desc]:
+                    attrs.setdefault(name, set()).update(attr_reports[desc])
+            reports = set()
+            for cur_ids in attrs.values():
+                if not reports:
+                    reports = cur_ids
+                else:
+                    reports = reports & cur_ids
+                if not reports:
+                    break
+            if reports:
+                marks_reports[m_id] = reports
+        return marks_reports
+
+    def __load_values(self, attrs_desc):
+        # Only values of equality operators are checked and regular expressions need all values of the attribute.
+        # Other operators are checked by the database.
+        all_names = set()
+        eq_values = {}
+        for name, value, op in attrs_desc:
+            if name in self._all_values:
+                continue
+            if op == ATTRIBUTES_OPERATOR_EQ:
+                eq_values.setdefault(name, set()).update(value.split(VALUES_SEPARATOR))
+            elif op == ATTRIBUTES_OPERATOR_RE:
+                all_names.add(name)
+        for name in all_names:
+            self._values[name] = set()
+            self._all_values.add(name)
+        if all_names:
+            for name, value in Attr.objects.filter(name__name__in=all_names).values_list('name__name', 'value'):
+                self._values[name].add(value)
+        for name, values in eq_values.items():
+            if name in all_names:
+                continue
+            checked = self._checked.setdefault(name, set())
+            values -= checked
+            if not values:
+                continue
+            checked |= values
+            values = list(values)
+            self._values.setdefault(name, set())
+            for i in range(0, len(values), ATTR_VALUES_CHUNK):
+                self._values[name].update(Attr.objects.filter(
+                    name__name=name, value__in=values[i:i + ATTR_VALUES_CHUNK]
+                ).values_list('value', flat=True))
+
+    def __load_reports(self, attrs_desc):
+        new_values = {}
+        for desc in attrs_desc:
+            if desc in self._matched:
+                continue
+            name, value, op = desc
+            if op in {ATTRIBUTES_OPERATOR_EQ, ATTRIBUTES_OPERATOR_RE}:
+                self._matched[desc] = self.__get_matched_values(name, value, op)
+                for matched_value in self._matched[desc]:
+                    if (name, matched_value) not in self._reports:
+                        self._reports[(name, matched_value)] = set()
+                        new_values.setdefault(name, set()).add(matched_value)
+                continue
+            # Reports are selected by the database, all reports of each matched value are got at once
+            self._matched[desc] = set()
+            report_attrs = self.__filter_values(name, value, op)
+            if report_attrs is None:
+                continue
+            for matched_value, report_id in report_attrs.values_list('attr__value', 'report_id'):
+                self._matched[desc].add(matched_value)
+                self.__add_report(name, matched_value, report_id)
+        for name, values in new_values.items():
+            values = list(values)
+            for i in range(0, len(values), ATTR_VALUES_CHUNK):
+                for value, report_id in self._report_attrs.filter(
+                        attr__name__name=name, attr__value__in=values[i:i + ATTR_VALUES_CHUNK]
+                ).values_list('attr__value', 'report_id'):
+                    self.__add_report(name, value, report_id)
+
+    def __add_report(self, name, value, report_id):
+        self._reports.setdefault((name, value), set()).add(report_id)
+        self._report_values.setdefault((name, report_id), set()).add(value)
+
+    def __get_matched_values(self, name, value, op) -> set:
+        existing = self._values[name]
+        if op == ATTRIBUTES_OPERATOR_EQ and VALUES_SEPARATOR not in value:
+            return {value} & existing
+        values = value.split(VALUES_SEPARATOR)
+        if op == ATTRIBUTES_OPERATOR_EQ:
+            return set(values) & existing
+        matched = set()
+        for val in values:
+            try:
+                matched |= set(x for x in existing if re.search(val, x))
+            except re.error as e:
+                logger.warning("Cannot parse regular expression {}: {}".format(val, e))
+        return matched
 
-    return marks_reports
+    def __filter_values(self, name, value, op):
+        # Returns attributes of reports which values match the operator or None if the operator can't be applied
+        values = value.split(VALUES_SEPARATOR)
+        report_attrs = self._report_attrs.filter(attr__name__name=name)
+        if op == ATTRIBUTES_OPERATOR_NE:
+            return report_attrs.exclude(attr__value__in=values)
+        if op not in NUMBER_LOOKUPS:
+            return None
+        if len(values) != 1:
+            logger.warning("Only one number can be specified {}".format(values))
+            return None
+        if re.match(NUMBER_RE, values[0]) is None:
+            logger.warning("Cannot parse number {}".format(values[0]))
+            return None
+        number = float(values[0])
+        # Values which are not numbers are not casted, so they don't match any number
+        return report_attrs.annotate(number=Case(
+            When(attr__value__regex=NUMBER_RE, then=Cast('attr__value', FloatField())), default=None
+        )).filter(**{'number__' + NUMBER_LOOKUPS[op]: number})
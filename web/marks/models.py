@@ -34,6 +34,8 @@ CONVERTED_DIR = 'Error-traces'
 class ConvertedTraces(models.Model):
     hash_sum = models.CharField(max_length=255, db_index=True)
     file = models.FileField(upload_to=CONVERTED_DIR, null=False)
+    # Hashes of elements of the converted error trace for quick comparison (see mea.core)
+    fingerprint = models.TextField(null=True)
 
     class Meta:
         db_table = 'file'
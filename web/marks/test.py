@@ -23,16 +23,19 @@ from django.core.exceptions import ObjectDoesNotExist
 from django.urls import reverse
 
 from jobs.models import Job
+from marks.attributes import AttributesIndex
 from marks.models import MarkSafe, MarkUnsafe, MarkUnknown, MarkSafeHistory, MarkUnsafeHistory, MarkUnknownHistory, \
     SafeTag, UnsafeTag, ReportSafeTag, ReportUnsafeTag, MarkSafeTag, MarkUnsafeTag, SafeReportTag, UnsafeReportTag, \
     MarkSafeReport, MarkUnsafeReport, MarkUnknownReport, MarkUnsafeCompare, UnknownProblem
-from reports.models import ReportSafe, ReportUnsafe, ReportUnknown, ReportComponent
+from reports.models import ReportSafe, ReportUnsafe, ReportUnknown, ReportComponent, ReportRoot, ReportAttr, Attr, \
+    AttrName
 from reports.test import DecideJobs, SJC_1
 from users.models import User
 from web.populate import populate_users
 from web.utils import CVTestCase, ArchiveFileContent
 from web.vars import JOB_STATUS, SAFE_VERDICTS, UNSAFE_VERDICTS, MARK_SAFE, MARK_UNSAFE, MARK_STATUS, MARK_TYPE, \
-    PROBLEM_DESC_FILE, ASSOCIATION_TYPE
+    PROBLEM_DESC_FILE, ASSOCIATION_TYPE, ATTRIBUTES_OPERATOR_EQ, ATTRIBUTES_OPERATOR_RE, ATTRIBUTES_OPERATOR_NE, \
+    ATTRIBUTES_OPERATOR_LE, ATTRIBUTES_OPERATOR_LT, ATTRIBUTES_OPERATOR_GE, ATTRIBUTES_OPERATOR_GT
 
 REPORT_ARCHIVES = os.path.join(settings.BASE_DIR, 'reports', 'test_files')
 
@@ -1221,3 +1224,59 @@ class TestMarks(CVTestCase):
         if os.path.exists(os.path.join(settings.MEDIA_ROOT, self.all_marks_arch)):
             os.remove(os.path.join(settings.MEDIA_ROOT, self.all_marks_arch))
         super(TestMarks, self).tearDown()
+
+
+class TestAttributesIndex(CVTestCase):
+    def setUp(self):
+        super(TestAttributesIndex, self).setUp()
+        User.objects.create_superuser('superuser', '', 'top_secret')
+        populate_users(
+            manager={'username': 'manager', 'password': 'manager'},
+            service={'username': 'service', 'password': 'service'}
+        )
+        self.client.post(reverse('users:login'), {'username': 'manager', 'password': 'manager'})
+        self.client.post(reverse('population'))
+        job = Job.objects.all().first()
+        self.assertIsNotNone(job)
+        root = ReportRoot.objects.create(user=User.objects.get(username='manager'), job=job)
+
+        # Report id -> value of the attribute
+        self.values = {}
+        name = AttrName.objects.create(name='Test')
+        other = Attr.objects.create(name=AttrName.objects.create(name='Other'), value='1')
+        for i, value in enumerate(['1', '2.5', '10', '-3', '1e2', 'abc', '10a', '']):
+            report = ReportSafe.objects.create(root=root, identifier='safe%s' % i, memory=0, cpu_time=0, wall_time=0)
+            ReportAttr.objects.create(report=report, attr=Attr.objects.get_or_create(name=name, value=value)[0])
+            ReportAttr.objects.create(report=report, attr=other)
+            self.values[report.id] = value
+
+    def test_operators(self):
+        operators = [
+            (ATTRIBUTES_OPERATOR_EQ, '10', lambda x: x == '10'),
+            (ATTRIBUTES_OPERATOR_EQ, '1,abc,missed', lambda x: x in {'1', 'abc'}),
+            (ATTRIBUTES_OPERATOR_RE, '^1', lambda x: x.startswith('1')),
+            (ATTRIBUTES_OPERATOR_NE, '1,abc', lambda x: x not in {'1', 'abc'}),
+            (ATTRIBUTES_OPERATOR_LE, '2.5', lambda x: x in {'1', '2.5', '-3'}),
+            (ATTRIBUTES_OPERATOR_LT, '2.5', lambda x: x in {'1', '-3'}),
+            (ATTRIBUTES_OPERATOR_GE, '10', lambda x: x in {'10', '1e2'}),
+            (ATTRIBUTES_OPERATOR_GT, '-3', lambda x: x in {'1', '2.5', '10', '1e2'}),
+            (ATTRIBUTES_OPERATOR_GT, 'nan', lambda x: False),
+            (ATTRIBUTES_OPERATOR_GT, '1,2', lambda x: False)
+        ]
+        index = AttributesIndex('safe')
+        for op, value, check in operators:
+            expected = set(r_id for r_id, r_value in self.values.items() if check(r_value))
+            res = index.get_reports({1: {('Test', value, op)}})
+            self.assertEqual(res.get(1, set()), expected, (op, value))
+
+            # Reports of the given set are checked by values loaded by the index
+            res = AttributesIndex('safe').get_reports({1: {('Test', value, op)}}, set(self.values))
+            self.assertEqual(res.get(1, set()), expected, (op, value))
+
+        # All attributes of the mark should match, but any condition of the same attribute is enough
+        res = index.get_reports({1: {('Test', '10', ATTRIBUTES_OPERATOR_GE), ('Other', '1', ATTRIBUTES_OPERATOR_EQ)},
+                                 2: {('Test', '10', ATTRIBUTES_OPERATOR_GE), ('Test', '1', ATTRIBUTES_OPERATOR_EQ)}})
+        self.assertEqual(res, {
+            1: set(r_id for r_id, r_value in self.values.items() if r_value in {'10', '1e2'}),
+            2: set(r_id for r_id, r_value in self.values.items() if r_value in {'1', '10', '1e2'})
+        })
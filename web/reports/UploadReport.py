@@ -26,15 +26,17 @@ from io import BytesIO
 
 from django.conf import settings
 from django.core.exceptions import ObjectDoesNotExist
+from django.db import transaction
 from django.db.models import Q, F
 from django.utils.timezone import now
 
 import marks.SafeUtils as SafeUtils
 import marks.UnknownUtils as UnknownUtils
 import marks.UnsafeUtils as UnsafeUtils
+from marks.attributes import AttributesIndex
 from marks.models import ErrorTraceConvertionCache
-from reports.coverage import FillCoverageCache
-from reports.etv import GetETV
+from reports.coverage import fill_coverage_cache
+from reports.etv import CheckErrorTraceStructure
 from reports.mea.wrapper import dump_converted_error_trace
 from reports.models import Report, ReportRoot, ReportComponent, ReportSafe, ReportUnsafe, ReportUnknown, \
     Component, ComponentResource, ReportAttr, ReportComponentLeaf, Computer, ComponentInstances, \
@@ -43,9 +45,8 @@ from reports.utils import AttrData
 from service.models import Task
 from service.utils import CoreStartDecision
 from tools.utils import RecalculateLeaves
-from users.models import Extended
 from web.utils import logger, unique_id, ArchiveFileContent
-from web.vars import REPORT_ARCHIVE, JOB_WEIGHT, JOB_STATUS, USER_ROLES, CONVERTED_ERROR_TRACES_FILE, COVERAGE_FILE
+from web.vars import REPORT_ARCHIVE, JOB_WEIGHT, JOB_STATUS, CONVERTED_ERROR_TRACES_FILE, COVERAGE_FILE
 
 AVTG_TOTAL_NAME = 'total number of abstract verification task descriptions to be generated in ideal'
 AVTG_FAIL_NAME = 'faulty generated abstract verification task descriptions'
@@ -54,13 +55,19 @@ BT_TOTAL_NAME = 'the number of verification tasks prepared for abstract verifica
 
 TAG_PERCENT = "percent"
 
+LEAF_REPORT_TYPES = {'safe', 'unsafe', 'unknown'}
+
 
 class CheckArchiveError(Exception):
     pass
 
 
+class BatchUploadError(Exception):
+    pass
+
+
 class UploadReport:
-    def __init__(self, job, data, archives=None, attempt=0, source_archives={}):
+    def __init__(self, job, data, archives=None, attempt=0, source_archives={}, batch=None):
         self.error = None
         self.job = job
         self.archives = archives
@@ -68,6 +75,7 @@ class UploadReport:
         self.data = {}
         self.ordered_attrs = []
         self.source_archives = source_archives
+        self._batch = batch
         try:
             self.__check_data(data)
             self.__check_archives(self.data['id'])
@@ -291,6 +299,11 @@ class UploadReport:
 
     def __get_parent(self):
         if 'parent id' in self.data:
+            if self._batch is not None:
+                try:
+                    return self._batch.get_component(self.job.identifier + self.data['parent id'])
+                except ObjectDoesNotExist:
+                    raise ValueError('report parent was not found')
             try:
                 return ReportComponent.objects.get(
                     root=self.job.reportroot,
@@ -302,8 +315,8 @@ class UploadReport:
             return None
         else:
             try:
-                curr_report = ReportComponent.objects.get(identifier=self.job.identifier + self.data['id'])
-                return ReportComponent.objects.get(id=curr_report.parent_id)
+                curr_report = self.__get_report_component(self.job.identifier + self.data['id'])
+                return self.__get_report_component_by_id(curr_report.parent_id)
             except ObjectDoesNotExist:
                 raise ValueError('report or its parent was not found')
 
@@ -313,11 +326,21 @@ class UploadReport:
         while parent is not None:
             branch.insert(0, parent)
             if parent.parent_id is not None:
-                parent = ReportComponent.objects.get(id=parent.parent_id)
+                parent = self.__get_report_component_by_id(parent.parent_id)
             else:
                 parent = None
         return branch
 
+    def __get_report_component(self, identifier):
+        if self._batch is not None:
+            return self._batch.get_component(identifier)
+        return ReportComponent.objects.get(identifier=identifier)
+
+    def __get_report_component_by_id(self, report_id):
+        if self._batch is not None:
+            return self._batch.get_component_by_id(report_id)
+        return ReportComponent.objects.get(id=report_id)
+
     def __upload(self):
         actions = {
             'start': self.__create_report_component,
@@ -339,7 +362,7 @@ class UploadReport:
 
     def __create_report_component(self, identifier):
         try:
-            report = ReportComponent.objects.get(identifier=identifier)
+            report = self.__get_report_component(identifier)
             if self.attempt > 0:
                 report.start_date = now()
                 report.save()
@@ -352,7 +375,7 @@ class UploadReport:
                 component=Component.objects.get_or_create(name=self.data['name'] if 'name' in self.data else 'Core')[0]
             )
 
-        save_add_data = (self.job.weight == JOB_WEIGHT[0][0] or self.parent is None or self.parent.parent is None)
+        save_add_data = (self.job.weight == JOB_WEIGHT[0][0] or self.parent is None or self.parent.parent_id is None)
 
         if save_add_data and 'data' in self.data:
             report.new_data('report-data.json', BytesIO(
@@ -360,13 +383,15 @@ class UploadReport:
             ))
 
         if 'comp' in self.data:
-            report.computer = Computer.objects.get_or_create(
-                description=json.dumps(self.data['comp'], ensure_ascii=False, sort_keys=True, indent=4)
-            )[0]
+            report.computer = self.__get_computer(
+                json.dumps(self.data['comp'], ensure_ascii=False, sort_keys=True, indent=4)
+            )
         else:
             report.computer = self.parent.computer
 
         report.save()
+        if self._batch is not None:
+            self._batch.remember(report)
         if 'config' in self.data:
             verifier_configs = list()
             for c_name, c_val in self.data['config'].items():
@@ -379,15 +404,7 @@ class UploadReport:
 
         if self.job.weight == JOB_WEIGHT[1][0]:
             self.__cut_parents_branch()
-
-        for parent in self._parents_branch:
-            try:
-                comp_inst = ComponentInstances.objects.get(report=parent, component=report.component)
-            except ObjectDoesNotExist:
-                comp_inst = ComponentInstances(report=parent, component=report.component)
-            comp_inst.in_progress += 1
-            comp_inst.total += 1
-            comp_inst.save()
+        self.__add_component_instances(report.component_id)
 
         # Reports for other components will be deleted for lightweight job
         if save_add_data:
@@ -395,7 +412,7 @@ class UploadReport:
 
     def __create_verification_report(self, identifier):
         try:
-            ReportComponent.objects.get(identifier=identifier)
+            self.__get_report_component(identifier)
             raise ValueError('the report with specified identifier already exists')
         except ObjectDoesNotExist:
             report = ReportComponent(
@@ -409,9 +426,9 @@ class UploadReport:
             ).encode('utf8')))
 
         if 'comp' in self.data:
-            report.computer = Computer.objects.get_or_create(
-                description=json.dumps(self.data['comp'], ensure_ascii=False, sort_keys=True, indent=4)
-            )[0]
+            report.computer = self.__get_computer(
+                json.dumps(self.data['comp'], ensure_ascii=False, sort_keys=True, indent=4)
+            )
         else:
             report.computer = self.parent.computer
 
@@ -452,33 +469,27 @@ class UploadReport:
                 report.delete()
                 raise CheckArchiveError('Report archive "%s" was not saved' % field_name)
 
+        if self._batch is not None:
+            self._batch.remember(report)
         self.ordered_attrs = self.__save_attrs(report.id, self.data['attrs'])
 
         if self.job.weight == JOB_WEIGHT[1][0]:
             self.__cut_parents_branch()
         self.__update_parent_resources(report)
-
-        for parent in self._parents_branch:
-            try:
-                comp_inst = ComponentInstances.objects.get(report=parent, component=report.component)
-            except ObjectDoesNotExist:
-                comp_inst = ComponentInstances(report=parent, component=report.component)
-            comp_inst.in_progress += 1
-            comp_inst.total += 1
-            comp_inst.save()
+        self.__add_component_instances(report.component_id)
 
         # Other verification reports will be deleted
         if self.job.weight == JOB_WEIGHT[0][0] or report.covnum > 0 or report.verifier_input:
             ComponentInstances.objects.create(report=report, component=report.component, in_progress=1, total=1)
         if report.covnum > 0:
-            FillCoverageCache(report)
+            fill_coverage_cache(report)
 
     def __upload_job_coverage(self, identifier):
         try:
-            report = ReportComponent.objects.get(identifier=identifier)
+            report = self.__get_report_component(identifier)
         except ObjectDoesNotExist:
             raise ValueError('updated report does not exist')
-        if self.parent is None or self.parent.parent is None:
+        if self.parent is None or self.parent.parent_id is None:
             report.covnum = len(self.data['coverage'])
             for cov_id in self.data['coverage']:
                 uploaded_arch = self.archives[self.data['coverage'][cov_id]]
@@ -494,20 +505,20 @@ class UploadReport:
                                         lines_percent=lines_percent)
                 carch.save_archive(REPORT_ARCHIVE['coverage'], uploaded_arch)
             report.save()
-            FillCoverageCache(report)
+            fill_coverage_cache(report)
         else:
             raise ValueError('coverage can be uploaded only for Core and first-level reports')
 
     def __update_attrs(self, identifier):
         try:
-            report = ReportComponent.objects.get(identifier=identifier)
+            report = self.__get_report_component(identifier)
         except ObjectDoesNotExist:
             raise ValueError('updated report does not exist')
         self.ordered_attrs = self.__save_attrs(report.id, self.data['attrs'])
 
     def __update_report_data(self, identifier):
         try:
-            report = ReportComponent.objects.get(identifier=identifier)
+            report = self.__get_report_component(identifier)
         except ObjectDoesNotExist:
             raise ValueError('updated report does not exist')
 
@@ -529,7 +540,7 @@ class UploadReport:
 
     def __finish_report_component(self, identifier):
         try:
-            report = ReportComponent.objects.get(identifier=identifier)
+            report = self.__get_report_component(identifier)
         except ObjectDoesNotExist:
             raise ValueError('updated report does not exist')
         if report.finish_date is not None:
@@ -539,7 +550,7 @@ class UploadReport:
         report.memory = int(self.data['resources']['memory size'])
         report.wall_time = int(self.data['resources']['wall time'])
 
-        save_add_data = (self.job.weight == JOB_WEIGHT[0][0] or self.parent is None or self.parent.parent is None)
+        save_add_data = (self.job.weight == JOB_WEIGHT[0][0] or self.parent is None or self.parent.parent_id is None)
         if save_add_data and 'log' in self.data:
             report.add_log(REPORT_ARCHIVE['log'], self.archives[self.data['log']])
 
@@ -552,7 +563,7 @@ class UploadReport:
             report.save()
 
         if report.log.name and not os.path.exists(os.path.join(settings.MEDIA_ROOT, report.log.name)):
-            report.delete()
+            self.__delete_report_component(report)
             raise CheckArchiveError('Report archive "log" was not saved')
 
         if 'attrs' in self.data:
@@ -566,7 +577,7 @@ class UploadReport:
         component_id = report.component_id
 
         if not save_add_data and ReportComponent.objects.filter(parent=report).count() == 0:
-            report.delete()
+            self.__delete_report_component(report)
         else:
             report_ids.add(report.id)
         ComponentInstances.objects.filter(report_id__in=report_ids, component_id=component_id, in_progress__gt=0) \
@@ -574,7 +585,7 @@ class UploadReport:
 
     def __finish_verification_report(self, identifier):
         try:
-            report = ReportComponent.objects.get(identifier=identifier)
+            report = self.__get_report_component(identifier)
         except ObjectDoesNotExist:
             raise ValueError('verification report does not exist')
 
@@ -587,7 +598,7 @@ class UploadReport:
 
         # I hope that verification reports can't have component reports as its children
         if self.job.weight == JOB_WEIGHT[1][0] and Report.objects.filter(parent=report).count() == 0:
-            report.delete()
+            self.__delete_report_component(report)
         else:
             report.finish_date = now()
             report.save()
@@ -696,12 +707,15 @@ class UploadReport:
         self.ordered_attrs = []
         parent_attrs = []
         for p in self._parents_branch:
-            for ra in p.attrs.order_by('id').select_related('attr__name'):
-                self.ordered_attrs.append(ra.attr.name.name)
+            for attr_id, name, compare, associate, data_id in self.__get_report_attrs(p):
+                self.ordered_attrs.append(name)
                 parent_attrs.append(ReportAttr(
-                    attr_id=ra.attr_id, report=leaf, compare=ra.compare, associate=ra.associate, data_id=ra.data_id
+                    attr_id=attr_id, report=leaf, compare=compare, associate=associate, data_id=data_id
                 ))
-        ReportAttr.objects.bulk_create(parent_attrs)
+        if self._batch is not None:
+            self._batch.report_attrs.extend(parent_attrs)
+        else:
+            ReportAttr.objects.bulk_create(parent_attrs)
 
         if 'attrs' in self.data:
             self.ordered_attrs += self.__save_attrs(leaf.id, self.data['attrs'])
@@ -720,7 +734,6 @@ class UploadReport:
         leaves = []
         for p in self._parents_branch:
             leaves.extend(list(ReportComponentLeaf(report=p, unsafe=unsafe) for unsafe in reports))
-        ReportComponentLeaf.objects.bulk_create(leaves)
         cache = []
         for leaf in reports:
             try:
@@ -733,6 +746,12 @@ class UploadReport:
             except:
                 # Old format.
                 pass
+        if self._batch is not None:
+            self._batch.leaves.extend(leaves)
+            self._batch.conversion_cache.extend(cache)
+            self._batch.new_leaves['unsafe'].extend(reports)
+            return
+        ReportComponentLeaf.objects.bulk_create(leaves)
         if cache:
             ErrorTraceConvertionCache.objects.bulk_create(cache)
 
@@ -750,11 +769,16 @@ class UploadReport:
                 leaf.parent = self._parents_branch[-1]
                 leaf.save()
 
+        leaves = list(ReportComponentLeaf(report=p, **{self.data['type']: leaf}) for p in self._parents_branch)
+        if self._batch is not None:
+            self._batch.leaves.extend(leaves)
+            self._batch.new_leaves[self.data['type']].append(leaf)
+            return
+        ReportComponentLeaf.objects.bulk_create(leaves)
+
         if self.data['type'] == 'unknown':
-            self.__fill_unknown_cache(leaf)
             UnknownUtils.ConnectReport(leaf)
         elif self.data['type'] == 'safe':
-            self.__fill_safe_cache(leaf)
             SafeUtils.ConnectReport(leaf)
             SafeUtils.RecalculateTags([leaf])
 
@@ -766,13 +790,27 @@ class UploadReport:
             # Just Core report
             self._parents_branch = self._parents_branch[:1]
 
-    def __fill_unknown_cache(self, unknown):
-        for p in self._parents_branch:
-            ReportComponentLeaf.objects.create(report=p, unknown=unknown)
-
-    def __fill_safe_cache(self, safe):
-        for p in self._parents_branch:
-            ReportComponentLeaf.objects.create(report=p, safe=safe)
+    def __add_component_instances(self, component_id):
+        parents_ids = set(p.id for p in self._parents_branch)
+        existing = set(x[0] for x in ComponentInstances.objects.filter(
+            report_id__in=parents_ids, component_id=component_id
+        ).values_list('report_id'))
+        ComponentInstances.objects.filter(report_id__in=existing, component_id=component_id) \
+            .update(in_progress=(F('in_progress') + 1), total=(F('total') + 1))
+        ComponentInstances.objects.bulk_create(list(ComponentInstances(
+            report_id=r_id, component_id=component_id, in_progress=1, total=1
+        ) for r_id in parents_ids - existing))
+
+    def __delete_report_component(self, report):
+        if self._batch is not None:
+            self._batch.forget(report)
+        report.delete()
+
+    def __get_report_attrs(self, report):
+        if self._batch is not None:
+            return self._batch.get_attrs(report.id)
+        return report.attrs.order_by('id') \
+            .values_list('attr_id', 'attr__name__name', 'compare', 'associate', 'data_id')
 
     def __update_parent_resources(self, report):
 
@@ -827,12 +865,21 @@ class UploadReport:
         attr_archive = None
         if 'attr data' in self.data:
             attr_archive = self.archives[self.data['attr data']]
-        attrdata = AttrData(self.root.id, attr_archive)
+        # Attributes of leaf reports are uploaded together at the end of the batch
+        deferred = self._batch is not None and self.data['type'] in LEAF_REPORT_TYPES
+        if deferred:
+            attrdata = self._batch.get_attrdata(self.root.id)
+            attrdata.set_archive(attr_archive)
+        else:
+            attrdata = AttrData(self.root.id, attr_archive)
         attrorder = []
         for attr, value, compare, associate, data in self.__attr_children('', attrs):
             attrorder.append(attr)
             attrdata.add(report_id, attr, value, compare, associate, data)
-        attrdata.upload()
+        if not deferred:
+            attrdata.upload()
+            if self._batch is not None:
+                self._batch.forget_attrs(report_id)
         if isinstance(self.parent, ReportComponent) and self.data['type'] in {'start', 'attrs', 'verification'}:
             names = set(x[0] for x in ReportAttr.objects.filter(report_id=report_id).values_list('attr__name_id'))
             for parent in self._parents_branch:
@@ -847,10 +894,136 @@ class UploadReport:
             if not zipfile.is_zipfile(arch) or zipfile.ZipFile(arch).testzip():
                 raise CheckArchiveError('The archive "%s" of report "%s" is not a ZIP file' % (arch.name, report_id))
 
+    def __get_computer(self, description):
+        self.__is_not_used()
+        # Computers are not unique, so reports of different jobs can create them at the same time
+        computer = Computer.objects.filter(description=description).order_by('id').first()
+        if computer is None:
+            computer = Computer.objects.create(description=description)
+        return computer
+
     def __is_not_used(self):
         pass
 
 
+class UploadReportsBatch:
+    def __init__(self, job, reports, archives=None, source_archives=None):
+        self.error = None
+        self.job = job
+        self._reports = reports
+        self._archives = archives
+        self._source_archives = source_archives if source_archives is not None else {}
+        self._components = {}
+        self._components_by_id = {}
+        self._attrs = {}
+        self._prefetched = False
+        self._attrdata = None
+
+        # Leaves data which is uploaded at the end of the batch
+        self.report_attrs = []
+        self.leaves = []
+        self.conversion_cache = []
+        self.new_leaves = {'safe': [], 'unsafe': [], 'unknown': []}
+
+        try:
+            with transaction.atomic():
+                self.__upload()
+        except BatchUploadError as e:
+            self.error = str(e)
+        except Exception as e:
+            logger.exception(e)
+            self.error = str(e)
+
+    def __upload(self):
+        for data in self._reports:
+            error = UploadReport(self.job, data, self._archives, source_archives=self._source_archives,
+                                 batch=self).error
+            if error is not None:
+                # Rollback the whole batch
+                raise BatchUploadError(error)
+        self.__upload_leaves()
+
+    def get_component(self, identifier):
+        if not self._prefetched:
+            self.__prefetch_components()
+        if identifier not in self._components:
+            self.remember(ReportComponent.objects.get(identifier=identifier))
+        return self._components[identifier]
+
+    def get_component_by_id(self, report_id):
+        if report_id not in self._components_by_id:
+            self.remember(ReportComponent.objects.get(id=report_id))
+        return self._components_by_id[report_id]
+
+    def remember(self, report):
+        self._components[report.identifier] = report
+        self._components_by_id[report.id] = report
+
+    def forget(self, report):
+        self._components.pop(report.identifier, None)
+        self._components_by_id.pop(report.id, None)
+        self._attrs.pop(report.id, None)
+
+    def get_attrs(self, report_id):
+        if report_id not in self._attrs:
+            self._attrs[report_id] = list(ReportAttr.objects.filter(report_id=report_id).order_by('id')
+                                          .values_list('attr_id', 'attr__name__name', 'compare', 'associate',
+                                                       'data_id'))
+        return self._attrs[report_id]
+
+    def forget_attrs(self, report_id):
+        self._attrs.pop(report_id, None)
+
+    def get_attrdata(self, root_id):
+        if self._attrdata is None:
+            self._attrdata = AttrData(root_id, None)
+        return self._attrdata
+
+    def __prefetch_components(self):
+        # Get all parents of the batch reports by one query and then their ancestors level by level
+        self._prefetched = True
+        identifiers = set()
+        for data in self._reports:
+            if not isinstance(data, dict) or not isinstance(data.get('id'), str):
+                continue
+            if isinstance(data.get('parent id'), str):
+                identifiers.add(self.job.identifier + data['parent id'])
+            elif data['id'] != '/':
+                identifiers.add(self.job.identifier + data['id'])
+        reports = list(ReportComponent.objects.filter(root__job=self.job, identifier__in=identifiers))
+        while len(reports) > 0:
+            for report in reports:
+                if report.id not in self._components_by_id:
+                    self.remember(report)
+            ancestors = set(r.parent_id for r in reports if r.parent_id is not None) - set(self._components_by_id)
+            if not ancestors:
+                break
+            reports = list(ReportComponent.objects.filter(id__in=ancestors))
+
+    def __upload_leaves(self):
+        ReportAttr.objects.bulk_create(self.report_attrs)
+        if self._attrdata is not None:
+            self._attrdata.upload()
+        ReportComponentLeaf.objects.bulk_create(self.leaves)
+        if self.conversion_cache:
+            ErrorTraceConvertionCache.objects.bulk_create(self.conversion_cache)
+
+        if self.new_leaves['unsafe']:
+            index = AttributesIndex('unsafe', {'report__in': self.new_leaves['unsafe']})
+            for unsafe in self.new_leaves['unsafe']:
+                UnsafeUtils.ConnectReport(unsafe, index)
+            UnsafeUtils.RecalculateTags(self.new_leaves['unsafe'])
+        if self.new_leaves['safe']:
+            index = AttributesIndex('safe', {'report__in': self.new_leaves['safe']})
+            for safe in self.new_leaves['safe']:
+                SafeUtils.ConnectReport(safe, index)
+            SafeUtils.RecalculateTags(self.new_leaves['safe'])
+        if self.new_leaves['unknown']:
+            index = AttributesIndex('unknown', {'report__in': self.new_leaves['unknown']})
+            for unknown in self.new_leaves['unknown']:
+                UnknownUtils.ConnectReport(unknown, index=index)
+
+
 class CollapseReports:
     def __init__(self, job):
         self.job = job
@@ -915,17 +1088,12 @@ class CheckErrorTraces:
         self.__exit()
 
     def __check_traces(self):
-        manager = Extended.objects.filter(role=USER_ROLES[2][0]).first()
-        if not manager:
-            raise ValueError("Can't check error traces without manager in the system")
-
         for tr_name in self._traces:
-            res = GetETV(self.__read_trace(tr_name), manager.user)
+            data = json.loads(self.__read_trace(tr_name))
+            CheckErrorTraceStructure(data)
 
-            if 'attrs' in res.data:
-                self.add_attrs[tr_name] = res.data['attrs']
-            if 'files' not in res.data:
-                raise ValueError('Wrong format of error trace')
+            if 'attrs' in data:
+                self.add_attrs[tr_name] = data['attrs']
 
     def __read_trace(self, trace_name):
         with zipfile.ZipFile(self._traces[trace_name], mode='r') as zfp:
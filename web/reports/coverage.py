@@ -22,21 +22,27 @@
 import hashlib
 import json
 import logging
+import multiprocessing
 import os
 import re
 import zipfile
+from concurrent.futures import ProcessPoolExecutor
+from datetime import timedelta
 from io import StringIO
 
+from django.conf import settings
 from django.core.exceptions import ObjectDoesNotExist
 from django.core.files import File as NewFile
 from django.db import transaction
 from django.template import loader
+from django.utils.timezone import now
 from django.utils.translation import gettext as _
 
 from reports.etv import TAB_LENGTH, KEY1_WORDS, KEY2_WORDS
 from reports.models import CoverageFile, CoverageData, CoverageDataValue, CoverageDataStatistics, CoverageArchive, \
-    ErrorTraceSource
+    ErrorTraceSource, CoverageCacheTask
 from reports.utils import get_parents
+from web.utils import logger
 from web.vars import COVERAGE_FILE
 
 SOURCE_CLASSES = {
@@ -55,6 +61,11 @@ COLOR = {
 
 TABLE_STAT_COLOR = ['#f18fa6', '#f1c0b2', '#f9e19b', '#e4f495', '#acf1a8']
 
+# Maximum number of hash sums in one "IN" lookup of coverage data values
+DATA_VALUES_CHUNK = 1000
+# Maximum number of archives which caches are built and saved in one transaction
+ARCHIVES_CACHE_CHUNK = 100
+
 
 def coverage_color(curr_cov, max_cov=0, delta=0):
     if curr_cov == 0:
@@ -142,6 +153,25 @@ def json_to_html(data):
     return data_html
 
 
+def get_coverage_data(covfile_id, first_line=None, last_line=None):
+    # Returns sorted list of (line, data id, data name) for lines of the file from the given window
+    qs_filter = {'covfile_id': covfile_id}
+    if first_line is not None:
+        qs_filter['end_line__gte'] = first_line
+    if last_line is not None:
+        qs_filter['start_line__lte'] = last_line
+    lines_data = []
+    for data_id, dataname, start, end in CoverageData.objects.filter(**qs_filter) \
+            .values_list('data_id', 'data__name', 'start_line', 'end_line'):
+        if first_line is not None:
+            start = max(start, first_line)
+        if last_line is not None:
+            end = min(end, last_line)
+        for line in range(start, end + 1):
+            lines_data.append((line, data_id, dataname))
+    return sorted(lines_data, key=lambda x: (x[0], x[2]))
+
+
 class GetCoverage:
     def __init__(self, report, args: dict, with_data):
         self.report = report
@@ -161,6 +191,13 @@ class GetCoverage:
                                                                                              'max']).
                                                order_by('identifier').values_list('id', 'identifier'))
         self.job = self.report.root.job
+        self.in_progress = False
+        self.cache_error = None
+        task = CoverageCacheTask.objects.filter(archive=self.cov_arch).values_list('status', 'error').first()
+        if task is not None:
+            self.in_progress = task[0] in {'PENDING', 'PROCESSING'}
+            if task[0] == 'ERROR':
+                self.cache_error = task[1] or _('Unknown error')
 
         self.parents = get_parents(self.report)
         self._statistic = CoverageStatistics(self.cov_arch, cur_page)
@@ -260,8 +297,7 @@ class GetCoverageSrcHTML:
         data_ids = set()
         last_i = -1
         if self._covfile is not None:
-            for data_id, dataname, line in CoverageData.objects.filter(covfile=self._covfile) \
-                    .values_list('data_id', 'data__name', 'line').order_by('line', 'data__name'):
+            for line, data_id, dataname in get_coverage_data(self._covfile.id):
                 self._lines_with_data.add(line)
                 if last_i >= 0 and data_map[last_i]['line'] == line:
                     data_map[last_i]['content'].append([dataname, data_id, False])
@@ -585,16 +621,52 @@ class DataStatistic:
         pass
 
 
+# Deduplicated coverage data values of one archive, just these values are searched in the DB
+class CoverageDataValues:
+    def __init__(self):
+        self._values = {}
+        self._ids = {}
+
+    def add(self, name, value):
+        key = (name, hashlib.md5(value.encode('utf8')).hexdigest())
+        self._values[key] = value
+        return key
+
+    def get_id(self, key):
+        return self._ids[key]
+
+    def update(self, other):
+        self._values.update(other._values)
+
+    def upload(self):
+        self.__get_existing()
+        new_values = set(self._values) - set(self._ids)
+        if new_values:
+            # Values could be created by concurrent upload, unique (name, hashsum) index resolves such conflicts
+            CoverageDataValue.objects.bulk_create(list(CoverageDataValue(
+                name=name, hashsum=hashsum, value=self._values[(name, hashsum)]
+            ) for name, hashsum in new_values), ignore_conflicts=True)
+            self.__get_existing()
+
+    def __get_existing(self):
+        hashsums = list(set(key[1] for key in self._values if key not in self._ids))
+        for i in range(0, len(hashsums), DATA_VALUES_CHUNK):
+            for v_id, name, hashsum in CoverageDataValue.objects \
+                    .filter(hashsum__in=hashsums[i:i + DATA_VALUES_CHUNK]).values_list('id', 'name', 'hashsum'):
+                if (name, hashsum) in self._values:
+                    self._ids[(name, hashsum)] = v_id
+
+
 class CreateCoverageFiles:
-    def __init__(self, cov_arch, coverage):
-        self._cov_arch = cov_arch
+    def __init__(self, cov_arch_id, coverage):
+        self._cov_arch_id = cov_arch_id
         self._coverage = coverage
         self._line_coverage = {}
         self._func_coverage = {}
         self._coverage_stat = {}
+        self.files = []
         self.__get_coverage_data()
         self.__create_files()
-        self.files = self.__get_saved_files()
 
     def __get_coverage_data(self):
         for data in self._coverage['line coverage']:
@@ -617,18 +689,19 @@ class CreateCoverageFiles:
                     self._coverage_stat[fname][2] += self.__num_of_lines(data[1][fname])
                 self._coverage_stat[fname][3] += self.__num_of_lines(data[1][fname])
 
-    @transaction.atomic
     def __create_files(self):
+        # Just files are saved here, the objects are saved to DB by FillCoverageCache
         for fname in set(self._line_coverage) | set(self._func_coverage):
             file_coverage = StringIO(json.dumps(
                 [self._line_coverage.get(fname, []), self._func_coverage.get(fname, [])]
             ))
             covfile = CoverageFile(
-                archive=self._cov_arch, name=fname,
+                archive_id=self._cov_arch_id, name=fname,
                 covered_lines=self._coverage_stat[fname][0], total_lines=self._coverage_stat[fname][1],
                 covered_funcs=self._coverage_stat[fname][2], total_funcs=self._coverage_stat[fname][3]
             )
-            covfile.file.save(COVERAGE_FILE, NewFile(file_coverage))
+            covfile.file.save(COVERAGE_FILE, NewFile(file_coverage), False)
+            self.files.append(covfile)
 
     def __num_of_lines(self, lines):
         self.__is_not_used()
@@ -641,65 +714,199 @@ class CreateCoverageFiles:
                 num += l[1] - l[0] + 1
         return num
 
-    def __get_saved_files(self):
-        files = {}
-        for f_id, fname in CoverageFile.objects.filter(archive=self._cov_arch).values_list('id', 'name'):
-            files[fname] = f_id
-        return files
-
     def __is_not_used(self):
         pass
 
 
-class FillCoverageCache:
-    def __init__(self, report):
-        for cov_arch, data in self.__get_coverage_data(report):
-            self._data = data
-            self._cov_arch = cov_arch
-            self._files = CreateCoverageFiles(self._cov_arch, self._data).files
-            del self._data['line coverage'], self._data['function coverage']
-            try:
-                self.__fill_data()
-            except Exception as e:
-                logging.warning("Error during filling cached coverage data: ", str(e), exc_info=True)
-
-    def __get_coverage_data(self, report):
-        self.__is_not_used()
-        for cov_arch in report.coverages.all():
-            with cov_arch.archive as fp:
-                with zipfile.ZipFile(fp, 'r') as zfp:
-                    yield cov_arch, json.loads(zfp.read(COVERAGE_FILE).decode('utf8', errors='ignore'))
-
-    def __fill_data(self):
-        covdata = []
-        data_values = {}
-        for vid, dataname, hashsum in CoverageDataValue.objects.values_list('id', 'name', 'hashsum'):
-            data_values[(dataname, hashsum)] = vid
+class CollectCoverageData:
+    def __init__(self, cov_arch_id, data):
+        self._cov_arch_id = cov_arch_id
+        self._data = data
+        self.statistics = []
+        self.values = CoverageDataValues()
+        self.lines = []
+        self.__collect()
 
+    def __collect(self):
         for dataname in self._data:
-            covdatastat = CoverageDataStatistics(archive=self._cov_arch, name=dataname)
+            covdatastat = CoverageDataStatistics(archive_id=self._cov_arch_id, name=dataname)
             covdatastat.data.save('CoverageData.html', NewFile(StringIO(
                 json_to_html(self._data[dataname]['statistics'])
-            )))
+            )), False)
+            self.statistics.append(covdatastat)
             for data in self._data[dataname]['values']:
-                dataval = json_to_html(data[0])
-                hashsum = hashlib.md5(dataval.encode('utf8')).hexdigest()
-                if (dataname, hashsum) not in data_values:
-                    data_values[(dataname, hashsum)] = CoverageDataValue.objects \
-                        .create(hashsum=hashsum, name=dataname, value=dataval).id
-                data_id = data_values[(dataname, hashsum)]
+                value_key = self.values.add(dataname, json_to_html(data[0]))
                 for fname in data[1]:
-                    if fname not in self._files:
-                        self._files[fname] = CoverageFile.objects.create(archive=self._cov_arch, name=fname).id
-                    for line in data[1][fname]:
-                        if isinstance(line, int):
-                            covdata.append(CoverageData(covfile_id=self._files[fname], line=line, data_id=data_id))
-                        elif isinstance(line, list) and len(line) == 2:
-                            for i in range(*line):
-                                covdata.append(CoverageData(covfile_id=self._files[fname], line=i, data_id=data_id))
-                            covdata.append(CoverageData(covfile_id=self._files[fname], line=line[1], data_id=data_id))
+                    self.lines.append((fname, value_key, self.__get_ranges(data[1][fname])))
+
+    def __get_ranges(self, lines):
+        # Consecutive lines are joined, so each range is stored as one row
+        self.__is_not_used()
+        ranges = []
+        for line in lines:
+            if isinstance(line, int):
+                start = end = line
+            elif isinstance(line, list) and len(line) == 2:
+                start, end = line
+                if start > end:
+                    start = end
+            else:
+                continue
+            if ranges and ranges[-1][0] <= start <= ranges[-1][1] + 1:
+                ranges[-1][1] = max(ranges[-1][1], end)
+            else:
+                ranges.append([start, end])
+        return ranges
+
+    def __is_not_used(self):
+        pass
+
+
+def build_coverage_cache(cov_arch_id, arch_path):
+    # Executed in the worker process, so DB must not be used here
+    with zipfile.ZipFile(arch_path, 'r') as zfp:
+        coverage = json.loads(zfp.read(COVERAGE_FILE).decode('utf8', errors='ignore'))
+    files = CreateCoverageFiles(cov_arch_id, coverage).files
+    del coverage['line coverage'], coverage['function coverage']
+    try:
+        data = CollectCoverageData(cov_arch_id, coverage)
+    except Exception as e:
+        logger.exception("Error during filling cached coverage data: %s", e)
+        return files, [], CoverageDataValues(), []
+
+    # Files which have just coverage data
+    files_names = set(covfile.name for covfile in files)
+    for fname in set(x[0] for x in data.lines) - files_names:
+        files.append(CoverageFile(archive_id=cov_arch_id, name=fname))
+    return files, data.statistics, data.values, data.lines
+
+
+def try_build_coverage_cache(cov_arch_id, arch_path):
+    # Errors are returned instead of raising, so caches of other archives are built anyway
+    try:
+        return build_coverage_cache(cov_arch_id, arch_path), None
+    except Exception as e:
+        logger.exception("Error during filling cached coverage data: %s", e)
+        return None, str(e)
+
+
+class FillCoverageCache:
+    def __init__(self, report=None, archives=None, errors=None):
+        # If errors dictionary is given, each archive is saved in its own transaction
+        # and errors of failed archives are collected there by archive identifiers.
+        if archives is None:
+            archives = list(report.coverages.all())
+        for i in range(0, len(archives), ARCHIVES_CACHE_CHUNK):
+            chunk = archives[i:i + ARCHIVES_CACHE_CHUNK]
+            if errors is None:
+                self.__save_caches(chunk, self.__build_caches(build_coverage_cache, chunk))
+                continue
+            for cov_arch, (cache, error) in zip(chunk, self.__build_caches(try_build_coverage_cache, chunk)):
+                if error is None:
+                    try:
+                        self.__save_caches([cov_arch], [cache])
+                    except Exception as e:
+                        logger.exception("Error during saving cached coverage data: %s", e)
+                        error = str(e)
+                if error is not None:
+                    errors[cov_arch.id] = error
+
+    def __build_caches(self, build_func, archives):
+        self.__is_not_used()
+        tasks = list((cov_arch.id, cov_arch.archive.path) for cov_arch in archives)
+        processes = min(settings.COVERAGE_CACHE_PROCESSES, len(tasks))
+        if processes <= 1:
+            return list(build_func(*task) for task in tasks)
+        with ProcessPoolExecutor(max_workers=processes, mp_context=multiprocessing.get_context('fork')) as pool:
+            return list(pool.map(build_func, *zip(*tasks)))
+
+    @transaction.atomic
+    def __save_caches(self, archives, caches):
+        self.__is_not_used()
+        data_values = CoverageDataValues()
+        covfiles = []
+        statistics = []
+        for files, arch_statistics, arch_values, arch_lines in caches:
+            covfiles.extend(files)
+            statistics.extend(arch_statistics)
+            data_values.update(arch_values)
+        CoverageFile.objects.bulk_create(covfiles)
+        CoverageDataStatistics.objects.bulk_create(statistics)
+        data_values.upload()
 
+        files = {}
+        for f_id, arch_id, fname in CoverageFile.objects.filter(archive__in=archives) \
+                .values_list('id', 'archive_id', 'name'):
+            files[(arch_id, fname)] = f_id
+        covdata = []
+        for cov_arch, (arch_files, arch_statistics, arch_values, arch_lines) in zip(archives, caches):
+            for fname, value_key, ranges in arch_lines:
+                covfile_id = files[(cov_arch.id, fname)]
+                data_id = data_values.get_id(value_key)
+                for start, end in ranges:
+                    covdata.append(CoverageData(
+                        covfile_id=covfile_id, start_line=start, end_line=end, data_id=data_id
+                    ))
         CoverageData.objects.bulk_create(covdata)
 
     def __is_not_used(self):
         pass
+
+
+def fill_coverage_cache(report):
+    if not settings.COVERAGE_CACHE_IN_BACKGROUND:
+        FillCoverageCache(report)
+        return
+    # Failed tasks of the report are queued again
+    CoverageCacheTask.objects.filter(archive__report=report, status='ERROR')\
+        .update(status='PENDING', error=None, started=None, date=now())
+    CoverageCacheTask.objects.bulk_create(list(
+        CoverageCacheTask(archive=cov_arch, date=now())
+        for cov_arch in report.coverages.filter(cache_task=None, coveragefile=None)
+    ))
+
+
+def retry_coverage_tasks():
+    # Queues failed tasks again, returns the number of queued tasks
+    return CoverageCacheTask.objects.filter(status='ERROR').update(status='PENDING', error=None, started=None)
+
+
+class ProcessCoverageTasks:
+    def __init__(self, limit):
+        self.processed = 0
+        self._tasks = self.__get_tasks(limit)
+        if len(self._tasks) > 0:
+            self.__process()
+
+    @transaction.atomic
+    def __get_tasks(self, limit):
+        self.__is_not_used()
+        # Tasks of crashed workers could be partially processed, so they are not processed again.
+        # Workers refresh the start time of their tasks after each saved chunk of archives.
+        CoverageCacheTask.objects.filter(
+            status='PROCESSING', started__lt=now() - timedelta(minutes=settings.COVERAGE_CACHE_TASK_TIMEOUT)
+        ).update(status='ERROR', error=_('The task was interrupted'))
+        # Locked rows are skipped, so several workers can process the queue at the same time
+        tasks = list(CoverageCacheTask.objects.select_for_update(skip_locked=True)
+                     .filter(status='PENDING').order_by('date')[:limit])
+        CoverageCacheTask.objects.filter(id__in=list(t.id for t in tasks)).update(status='PROCESSING', started=now())
+        return tasks
+
+    def __process(self):
+        archives = list(CoverageArchive.objects.filter(cache_task__in=self._tasks))
+        tasks_ids = dict((t.archive_id, t.id) for t in self._tasks)
+        for i in range(0, len(archives), ARCHIVES_CACHE_CHUNK):
+            chunk = archives[i:i + ARCHIVES_CACHE_CHUNK]
+            errors = {}
+            FillCoverageCache(archives=chunk, errors=errors)
+            for arch_id, error in errors.items():
+                CoverageCacheTask.objects.filter(id=tasks_ids[arch_id]).update(status='ERROR', error=error[:1024])
+            CoverageCacheTask.objects.filter(
+                id__in=list(tasks_ids[cov_arch.id] for cov_arch in chunk if cov_arch.id not in errors)
+            ).delete()
+            CoverageCacheTask.objects.filter(id__in=list(tasks_ids.values()), status='PROCESSING')\
+                .update(started=now())
+            self.processed += len(chunk) - len(errors)
+
+    def __is_not_used(self):
+        pass
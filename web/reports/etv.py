@@ -19,18 +19,25 @@
 # limitations under the License.
 #
 
+import glob
+import hashlib
 import json
 import os
+import pickle
 import re
 import tempfile
 import uuid
 import zipfile
 
+from django.conf import settings
 from django.template.loader import render_to_string
 from pycparser import c_parser, c_generator, c_ast
 from sympy import sympify, symbols
 from sympy.logic import boolalg
 
+from reports.models import SOURCES_CACHE_DIR, ETV_CACHE_DIR
+from web.utils import ArchiveFileContent
+
 TAB_LENGTH = 2
 MAX_CODE_LINE = 256
 SOURCE_CLASSES = {
@@ -53,6 +60,11 @@ KEY2_WORDS = [
     'long', 'goto', 'volatile', 'return', 'signed', 'register', 'while', 'char'
 ]
 
+# The version of rendered error traces in ETV_CACHE_DIR, it should be increased if rendering is changed
+ETV_CACHE_VERSION = 1
+# Version of highlighted sources in SOURCES_CACHE_DIR, it should be increased if highlighting is changed
+SOURCES_CACHE_VERSION = 1
+
 THREAD_COLORS = [
     '#5f54cb', '#85ff47', '#69c8ff', '#ff5de5', '#dfa720', '#0b67bf', '#fa92ff', '#57bfa8', '#bf425a', '#7d909e'
 ]
@@ -528,14 +540,154 @@ class ParseErrorTrace:
         pass
 
 
+class CheckErrorTraceStructure:
+    # Checks invariants which ParseErrorTrace enforces by one pass through the edges without generating lines.
+    # Scopes of each thread are kept the same way as ParseErrorTrace does it: (index, is_action, double_return).
+    def __init__(self, data):
+        if 'files' not in data or 'edges' not in data:
+            raise ValueError('Wrong format of error trace')
+        self._files = len(data['files'])
+        self._functions = len(data.get('funcs', []))
+        self._actions = len(data.get('actions', []))
+        self._edges = data['edges']
+        if data.get('type') == 'correctness':
+            # Edges of correctness witnesses are regrouped before parsing, so only their positions are checked
+            self.__check_positions()
+        else:
+            self.__check_scopes()
+
+    def __check_positions(self):
+        for edge in self._edges:
+            if 'thread' not in edge:
+                raise ValueError('All error trace edges should have thread')
+            if 'start line' not in edge:
+                raise ValueError('All correctness witness edges should have start line')
+            self.__check_index(edge, 'file', self._files)
+
+    def __get_threads(self):
+        threads = {}
+        has_global = True
+        for edge in self._edges:
+            if 'thread' not in edge:
+                raise ValueError('All error trace edges should have thread')
+            if edge['thread'] not in threads:
+                threads[edge['thread']] = len(threads)
+            if threads[edge['thread']] == 0 and 'enter' in edge:
+                has_global = False
+        return threads, has_global
+
+    def __check_scopes(self):
+        threads, has_global = self.__get_threads()
+        # Stack of parsed threads: (thread index, scopes stack)
+        parsed = [(0, None if has_global else [])]
+        for edge in self._edges:
+            thread = threads[edge['thread']]
+            while parsed[-1][0] > thread:
+                parsed.pop()
+            if parsed[-1][0] < thread:
+                parsed.append((thread, []))
+            self.__check_index(edge, 'file', self._files)
+            self.__check_index(edge, 'original file', self._files)
+            stack = parsed[-1][1]
+            if stack is None:
+                # Global initialization edge, it doesn't contain enter
+                continue
+
+            curr_action = stack[-1][0] if stack and stack[-1][1] else None
+            new_action = edge.get('action')
+            if curr_action != new_action:
+                if curr_action is not None:
+                    stack.pop()
+                if new_action is not None:
+                    self.__check_index(edge, 'action', self._actions)
+                    stack.append([new_action, True, False])
+
+            if 'enter' in edge:
+                self.__check_index(edge, 'enter', self._functions)
+                stack.append([edge['enter'], False, False])
+                if 'return' in edge:
+                    self.__check_index(edge, 'return', self._functions)
+                    if edge['enter'] == edge['return']:
+                        self.__return(stack)
+                    elif self.__is_double_return_correct(stack, edge['return']):
+                        stack[-1][2] = True
+                    else:
+                        raise ValueError('Double return from function %s is not allowed while entering %s' % (
+                            edge['return'], edge['enter']
+                        ))
+            elif 'return' in edge:
+                self.__check_index(edge, 'return', self._functions)
+                self.__return(stack, edge['return'])
+
+    def __return(self, stack, func_id=None):
+        self.__is_not_used()
+        while True:
+            if stack and stack[-1][1]:
+                # Return from action first
+                stack.pop()
+            if not stack or stack[-1][1] or func_id is not None and stack[-1][0] != func_id:
+                return
+            if not stack.pop()[2]:
+                return
+            func_id = None
+
+    def __is_double_return_correct(self, stack, func_id):
+        self.__is_not_used()
+        if len(stack) < 2:
+            return False
+        if stack[-2][1]:
+            return len(stack) >= 3 and stack[-3][0] == func_id
+        return stack[-2][0] == func_id
+
+    def __check_index(self, edge, key, size):
+        self.__is_not_used()
+        if key in edge and not (isinstance(edge[key], int) and 0 <= edge[key] < size):
+            raise ValueError('Wrong %s index in error trace: %s' % (key, edge[key]))
+
+    def __is_not_used(self):
+        pass
+
+
+def get_etv_cache_prefix(error_trace, root_id):
+    # Cache is identified by the error trace content and by user options which affect rendering
+    trace_hash = hashlib.sha256(error_trace.encode('utf8')).hexdigest()
+    return os.path.join(settings.MEDIA_ROOT, ETV_CACHE_DIR, str(root_id), trace_hash[:2], trace_hash)
+
+
+def remove_etv_cache(error_trace, root_id):
+    # Removes rendered error trace for all user options
+    for cache_name in glob.glob(get_etv_cache_prefix(error_trace, root_id) + '-*.pickle'):
+        try:
+            os.remove(cache_name)
+        except FileNotFoundError:
+            pass
+
+
+def save_cache_file(cache_name, content):
+    os.makedirs(os.path.dirname(cache_name), exist_ok=True)
+    # The cache is written to the temporary file first, so parallel requests don't read incomplete cache
+    fd, tmp_name = tempfile.mkstemp(dir=os.path.dirname(cache_name))
+    with os.fdopen(fd, mode='wb') as fp:
+        fp.write(content)
+    os.replace(tmp_name, cache_name)
+
+
 class GetETV:
-    def __init__(self, error_trace, user=None):
+    def __init__(self, error_trace, user=None, cache_root=None):
         if user:
             self.include_assumptions = user.extended.assumptions
             self.triangles = user.extended.triangles
         else:
             self.include_assumptions = False
             self.triangles = False
+        cache_name = None
+        if cache_root is not None:
+            cache_name = '{0}-{1}-{2:d}{3:d}.pickle'.format(
+                get_etv_cache_prefix(error_trace, cache_root), ETV_CACHE_VERSION,
+                self.include_assumptions, self.triangles
+            )
+        if cache_name is not None and self.__load_cache(cache_name):
+            return
         self.data = json.loads(error_trace)
 
         self.type = self.data.get('type')
@@ -548,6 +700,20 @@ class GetETV:
         self._has_global = True
         self.html_trace, self.assumes = self.__html_trace()
         self.attributes = []
+        if cache_name is not None:
+            self.__save_cache(cache_name)
+
+    def __load_cache(self, cache_name):
+        try:
+            with open(cache_name, mode='rb') as fp:
+                self.__dict__.update(pickle.load(fp))
+        except Exception:
+            # The cache doesn't exist or it is corrupted
+            return False
+        return True
+
+    def __save_cache(self, cache_name):
+        save_cache_file(cache_name, pickle.dumps(self.__dict__, protocol=pickle.HIGHEST_PROTOCOL))
 
     @staticmethod
     def __get_invariants(inv_str):
@@ -1053,20 +1219,83 @@ class GetETV:
         )
 
 
-class ArchiveFileContent:
-    def __init__(self, report, field_name, file_name):
-        self._report = report
-        self._field = field_name
-        self._name = file_name
-        self.content = self.__extract_file_content()
+class SourceHighlighter:
+    # Tokens of the source line, strings and block comments can be continued on the next lines
+    tokens = re.compile(
+        r'(?P<comment>//.*)|(?P<block>/\*)|(?P<text>["\'])|(?P<number>(?<!\w)\d+(?!\w))|(?P<word>[A-Za-z_#][\w#]*)'
+    )
+    block_end = re.compile(r'\*/')
+    text_end = {'"': re.compile(r'(?:[^"\\]|\\.)*"'), "'": re.compile(r"(?:[^'\\]|\\.)*'")}
+    key1_words = set(KEY1_WORDS)
+    key2_words = set(KEY2_WORDS)
+
+    def __init__(self):
+        self._is_comment = False
+        self._text_quote = None
+
+    def highlight(self, line):
+        # Returns HTML of the source line (tabs should be already replaced)
+        data = []
+        pos = 0
+        if self._is_comment:
+            pos = self.__block_comment(line, 0, data)
+        elif self._text_quote is not None:
+            pos = self.__text(line, 0, self._text_quote, data)
+        while pos < len(line):
+            m = self.tokens.search(line, pos)
+            if m is None:
+                data.append(escape_source(line[pos:]))
+                break
+            data.append(escape_source(line[pos:m.start()]))
+            if m.lastgroup == 'comment':
+                data.append(wrap_source(escape_source(m.group()), 'comment'))
+                pos = m.end()
+            elif m.lastgroup == 'block':
+                pos = self.__block_comment(line, m.start(), data)
+            elif m.lastgroup == 'text':
+                pos = self.__text(line, m.start(), m.group(), data)
+            elif m.lastgroup == 'number':
+                data.append(wrap_source(m.group(), 'number'))
+                pos = m.end()
+            else:
+                word = m.group()
+                if word in self.key1_words:
+                    word = wrap_source(word, 'key1')
+                elif word in self.key2_words:
+                    word = wrap_source(word, 'key2')
+                data.append(word)
+                pos = m.end()
+        return ''.join(data)
+
+    def __block_comment(self, line, start, data):
+        m = self.block_end.search(line, start + 2 if not self._is_comment else start)
+        self._is_comment = m is None
+        end = len(line) if m is None else m.end()
+        data.append(wrap_source(escape_source(line[start:end]), 'comment'))
+        return end
+
+    def __text(self, line, start, quote, data):
+        m = self.text_end[quote].match(line, start if self._text_quote is not None else start + 1)
+        self._text_quote = quote if m is None else None
+        end = len(line) if m is None else m.end()
+        data.append(wrap_source(escape_source(line[start:end]), 'text'))
+        return end
+
+
+def highlight_source(lines):
+    # Returns HTML of source lines, tabs should be already replaced
+    highlighter = SourceHighlighter()
+    return list(highlighter.highlight(line) for line in lines)
 
-    def __extract_file_content(self):
-        with getattr(self._report, '_meta').model.objects.get(id=self._report.id).__getattribute__(
-                self._field) as fp:
-            if os.path.splitext(fp.name)[-1] != '.zip':
-                raise ValueError('Archive type is not supported')
-            with zipfile.ZipFile(fp, 'r') as zfp:
-                return zfp.read(self._name)
+
+def escape_source(text):
+    return text.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+
+
+def wrap_source(text, text_type, text_id=None):
+    if text_id is not None:
+        return '<span id="%s" class="%s">%s</span>' % (text_id, SOURCE_CLASSES[text_type], text)
+    return '<span class="%s">%s</span>' % (SOURCE_CLASSES[text_type], text)
 
 
 class GetSource:
@@ -1075,156 +1304,90 @@ class GetSource:
             self.report = report
         else:
             self.report = None
-        self.is_comment = False
-        self.is_text = False
-        self.text_quote = None
         self.__lines = lines
         self.edges = edges
         self.data = self.__get_source(file_name)
 
     def __get_source(self, file_name):
-        data = ''
+        if self.report and self.report.source_id is not None and len(self.edges) == 0:
+            # Highlighted files are shared by all reports with the same sources archive
+            source_lines = None
+            highlighted = self.__get_highlighted_source(file_name)
+        else:
+            source_lines = list(line.replace('\t', ' ' * TAB_LENGTH)
+                                for line in self.__read_source(file_name).split('\n'))
+            highlighted = highlight_source(source_lines)
+        line_num_len = len(str(len(highlighted)))
+        edges = self.__get_edges_by_lines()
+        data = []
+        for cnt in range(1, len(highlighted) + 1):
+            parsed_line = highlighted[cnt - 1]
+            if cnt in self.__lines:
+                parsed_line = self.__mark_line(
+                    source_lines[cnt - 1] if source_lines is not None else None,
+                    parsed_line, self.__lines[cnt], edges.get(cnt, [])
+                )
+            data.append('<span>%s %s</span><br>' % (
+                wrap_source(str(cnt).rjust(line_num_len), 'line', 'ETVSrcL_%s' % cnt), parsed_line
+            ))
+        return ''.join(data)
+
+    def __read_source(self, file_name):
         if self.report:
             if file_name.startswith('/'):
                 file_name = file_name[1:]
             try:
-                source_content = ArchiveFileContent(self.report.source, 'archive',
-                                                    file_name).content.decode('utf8',
-                                                                              errors="ignore")
+                return ArchiveFileContent(self.report.source, 'archive',
+                                          file_name).content.decode('utf8', errors="ignore")
             except Exception as e:
                 raise Exception(
                     "Error while extracting source from archive: %(error)s" % {'error': str(e)})
-        else:
-            if os.path.exists(file_name):
-                with open(file_name, encoding="utf8", errors='ignore') as fd:
-                    source_content = fd.read()
-            else:
-                source_content = ""
-        cnt = 1
-        lines = source_content.split('\n')
-        for line in lines:
-            line = line.replace('\t', ' ' * TAB_LENGTH).replace('&', '&amp;').replace('<', '&lt;'). \
-                replace('>', '&gt;')
-            line_num = ' ' * (len(str(len(lines))) - len(str(cnt))) + str(cnt)
-            parsed_line = self.__parse_line(line)
-            cur_edges = list(filter(
-                lambda edge: (edge['start line'] == int(line_num) or
-                              'end line' in edge and edge['end line'] == int(line_num)) and
-                             not edge['condition'], self.edges))
-            if cnt in self.__lines:
-                val = self.__lines[cnt]
-                if len(val) == 1:
-                    color = '#adebadaa'
-                    parsed_line = "<span style=\"background-color: {}\">{}</span>".format(color, parsed_line)
-                else:
-                    # color = '#adffadaa'
-                    color = '#70dc70'
-                    if cur_edges:
-                        for cur_edge in cur_edges:
-                            src = cur_edge['source']
-                            if src[0] == '!':
-                                src = self.__parse_line(src)
-                                src = src[2:-1]
-                            elif ' == 0' in src and line.find(src) == -1:
-                                src = src.replace(' == 0', '')
-                                src = self.__parse_line(src)
-                            else:
-                                src = self.__parse_line(src)
-                            parsed_line = parsed_line.replace(src,
-                                                              "<span style=\"background-color: {}\">{}</span>".format(
-                                                                  '#dc7070', src))
-                    parsed_line = "<span style=\"background-color: {}\">{}</span>".format(color,
-                                                                                          parsed_line)
-            src_line = '%s %s' % (
-                self.__wrap_line(line_num, 'line', 'ETVSrcL_%s' % cnt), parsed_line)
-            data += '<span>%s</span><br>' % src_line
-            cnt += 1
-        return data
-
-    def __parse_line(self, line):
-        if self.is_comment:
-            m = re.match('(.*?)\*/(.*)', line)
-            if m is None:
-                return self.__wrap_line(line, 'comment')
-            self.is_comment = False
-            new_line = self.__wrap_line(m.group(1) + '*/', 'comment')
-            return new_line + self.__parse_line(m.group(2))
-
-        if self.is_text:
-            before, after = self.__parse_text(line)
-            if after is None:
-                return self.__wrap_line(before, 'text')
-            self.is_text = False
-            return self.__wrap_line(before, 'text') + self.__parse_line(after)
-
-        m = re.match('(.*?)//(.*)', line)
-        if m is not None and m.group(1).find('"') == -1 and m.group(1).find("'") == -1:
-            new_line = self.__parse_line(m.group(1))
-            new_line += self.__wrap_line('//' + m.group(2), 'comment')
-            return new_line
-        m = re.match('(.*?)/\*(.*)', line)
-        if m is not None and m.group(1).find('"') == -1 and m.group(1).find("'") == -1:
-            new_line = self.__parse_line(m.group(1))
-            self.is_comment = True
-            new_line += self.__parse_line('/*' + m.group(2))
-            return new_line
-
-        m = re.match('(.*?)([\'\"])(.*)', line)
-        if m is not None:
-            new_line = self.__parse_line(m.group(1))
-            self.text_quote = m.group(2)
-            before, after = self.__parse_text(m.group(3))
-            new_line += self.__wrap_line(self.text_quote + before, 'text')
-            if after is None:
-                self.is_text = True
-                return new_line
-            self.is_text = False
-            return new_line + self.__parse_line(after)
-
-        m = re.match("(.*\W)(\d+)(\W.*)", line)
-        if m is not None:
-            new_line = self.__parse_line(m.group(1))
-            new_line += self.__wrap_line(m.group(2), 'number')
-            new_line += self.__parse_line(m.group(3))
-            return new_line
-        words = re.split('([^a-zA-Z0-9-_#])', line)
-        new_words = []
-        for word in words:
-            if word in KEY1_WORDS:
-                new_words.append(self.__wrap_line(word, 'key1'))
-            elif word in KEY2_WORDS:
-                new_words.append(self.__wrap_line(word, 'key2'))
-            else:
-                new_words.append(word)
-        return ''.join(new_words)
-
-    def __parse_text(self, text):
-        escaped = False
-        before = ''
-        after = ''
-        end_found = False
-        for c in text:
-            if end_found:
-                after += c
+        if os.path.exists(file_name):
+            with open(file_name, encoding="utf8", errors='ignore') as fd:
+                return fd.read()
+        return ""
+
+    def __get_highlighted_source(self, file_name):
+        cache_name = os.path.join(
+            settings.MEDIA_ROOT, SOURCES_CACHE_DIR, str(self.report.source_id), '{0}-{1}.json'.format(
+                hashlib.sha256(file_name.encode('utf8')).hexdigest(), SOURCES_CACHE_VERSION
+            )
+        )
+        try:
+            with open(cache_name, encoding='utf8') as fp:
+                return json.load(fp)
+        except (OSError, ValueError):
+            # The file was not highlighted yet or the cache is corrupted
+            pass
+        highlighted = highlight_source(list(line.replace('\t', ' ' * TAB_LENGTH)
+                                            for line in self.__read_source(file_name).split('\n')))
+        save_cache_file(cache_name, json.dumps(highlighted, ensure_ascii=False).encode('utf8'))
+        return highlighted
+
+    def __get_edges_by_lines(self):
+        # Not condition edges by their start and end lines
+        edges = {}
+        for edge in self.edges:
+            if edge.get('condition'):
                 continue
-            if not escaped and c == self.text_quote:
-                end_found = True
-            elif escaped:
-                escaped = False
-            elif c == '\\':
-                escaped = True
-            before += c
-        if end_found:
-            return before, after
-        return before, None
-
-    def __wrap_line(self, line, text_type, line_id=None):
+            edges.setdefault(edge['start line'], []).append(edge)
+            if 'end line' in edge and edge['end line'] != edge['start line']:
+                edges.setdefault(edge['end line'], []).append(edge)
+        return edges
+
+    def __mark_line(self, line, parsed_line, line_data, edges):
         self.__is_not_used()
-        if text_type not in SOURCE_CLASSES:
-            return line
-        if line_id is not None:
-            return '<span id="%s" class="%s">%s</span>' % (line_id, SOURCE_CLASSES[text_type], line)
-        return '<span class="%s">%s</span>' % (SOURCE_CLASSES[text_type], line)
+        if len(line_data) == 1:
+            return '<span style="background-color: #adebadaa">{}</span>'.format(parsed_line)
+        for edge in edges:
+            src = edge['source']
+            if src[0] == '!':
+                src = src[2:-1]
+            elif ' == 0' in src and line.find(src) == -1:
+                src = src.replace(' == 0', '')
+            src = SourceHighlighter().highlight(src)
+            parsed_line = parsed_line.replace(src, '<span style="background-color: #dc7070">{}</span>'.format(src))
+        return '<span style="background-color: #70dc70">{}</span>'.format(parsed_line)
 
     def __is_not_used(self):
         pass
@@ -0,0 +1,52 @@
+#
+# CVV is a continuous verification visualizer.
+# Copyright (c) 2023 ISP RAS (http://www.ispras.ru)
+# Ivannikov Institute for System Programming of the Russian Academy of Sciences
+#
+# Copyright (c) 2018 ISP RAS (http://www.ispras.ru)
+# Ivannikov Institute for System Programming of the Russian Academy of Sciences
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count, Min
+
+from reports.models import Attr
+
+
+class Command(BaseCommand):
+    help = 'Merges duplicate report attributes. It should be executed before migrations ' \
+           'which make attributes unique by name and value.'
+
+    def handle(self, *args, **options):
+        merged = self.__merge()
+        self.stdout.write('{} duplicate attributes were merged'.format(merged))
+
+    @transaction.atomic
+    def __merge(self):
+        # Duplicates are replaced with the attribute with the smallest identifier in all referencing models
+        replaced = {}
+        for name_id, value, min_id in Attr.objects.values('name_id', 'value')\
+                .annotate(number=Count('id'), min_id=Min('id')).filter(number__gt=1)\
+                .values_list('name_id', 'value', 'min_id'):
+            replaced[min_id] = list(Attr.objects.filter(name_id=name_id, value=value).exclude(id=min_id)
+                                    .values_list('id', flat=True))
+        relations = list(rel for rel in Attr._meta.get_fields() if rel.one_to_many and rel.auto_created)
+        for attr_id, duplicates in replaced.items():
+            for rel in relations:
+                rel.related_model.objects.filter(**{'{}__in'.format(rel.field.attname): duplicates})\
+                    .update(**{rel.field.attname: attr_id})
+            Attr.objects.filter(id__in=duplicates).delete()
+        return sum(len(duplicates) for duplicates in replaced.values())
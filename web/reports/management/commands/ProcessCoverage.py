@@ -0,0 +1,48 @@
+#
+# CVV is a continuous verification visualizer.
+# Copyright (c) 2023 ISP RAS (http://www.ispras.ru)
+# Ivannikov Institute for System Programming of the Russian Academy of Sciences
+#
+# Copyright (c) 2018 ISP RAS (http://www.ispras.ru)
+# Ivannikov Institute for System Programming of the Russian Academy of Sciences
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import time
+
+from django.core.management.base import BaseCommand
+
+from reports.coverage import ProcessCoverageTasks, retry_coverage_tasks
+
+
+class Command(BaseCommand):
+    help = 'Builds coverage caches of uploaded reports in background.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help='Process pending tasks and exit.')
+        parser.add_argument('--limit', type=int, default=10, help='Maximum number of archives processed at a time.')
+        parser.add_argument('--sleep', type=float, default=5, help='Seconds to wait if there are no pending tasks.')
+        parser.add_argument('--retry', action='store_true', help='Queue failed tasks again before processing.')
+
+    def handle(self, *args, **options):
+        if options['retry']:
+            self.stdout.write('{} failed tasks were queued again'.format(retry_coverage_tasks()))
+        while True:
+            res = ProcessCoverageTasks(options['limit'])
+            if res.processed > 0:
+                self.stdout.write('Coverage caches were built for {} archives'.format(res.processed))
+            elif options['once']:
+                break
+            else:
+                time.sleep(options['sleep'])
@@ -23,6 +23,7 @@ This library presents core functions for MEA, such as conversion and comparison
 
 import operator
 import re
+import zlib
 
 # Conversion functions.
 CONVERSION_FUNCTION_CALL_TREE = "call tree"
@@ -46,6 +47,17 @@ COMPARISON_FUNCTION_INCLUDE_PARTIAL_ORDERED = "partial include ordered"
 COMPARISON_FUNCTION_SKIP = "skip"
 DEFAULT_COMPARISON_FUNCTION = COMPARISON_FUNCTION_EQUAL
 
+# Interned element, which is added to the end of threads by "include with error" comparison function.
+__WARN_ELEMENT = 0
+
+# Comparison functions, which do not take into account all elements of compared error trace.
+__COMPARISON_FUNCTIONS_BY_ELEMENTS = [
+    COMPARISON_FUNCTION_INCLUDE,
+    COMPARISON_FUNCTION_INCLUDE_WITH_ERROR,
+    COMPARISON_FUNCTION_INCLUDE_PARTIAL,
+    COMPARISON_FUNCTION_INCLUDE_PARTIAL_ORDERED
+]
+
 # Tags for configurations.
 TAG_CONVERSION_FUNCTION = "conversion_function"
 TAG_COMPARISON_FUNCTION = "comparison_function"
@@ -127,6 +139,7 @@ def compare_error_traces(edited_error_trace: list, compared_error_trace: list,
         # Return true for empty converted error traces (so they will be applied to all
         # reports with the same attributes)
         return 1.0
+    et1_threaded, et2_threaded = __intern_elements(et1_threaded, et2_threaded)
     functions = {
         COMPARISON_FUNCTION_EQUAL: __compare_equal,
         COMPARISON_FUNCTION_INCLUDE: __compare_include,
@@ -142,6 +155,47 @@ def compare_error_traces(edited_error_trace: list, compared_error_trace: list,
     return __get_similarity_coefficient(et1_threaded, et2_threaded, equal_threads)
 
 
+def get_error_trace_fingerprint(converted_error_trace: list) -> list:
+    """
+    Returns fingerprint of converted error trace: length and hashes of elements for each thread.
+    Hashes do not depend on the process, so fingerprints can be stored.
+    """
+    threads = __transform_to_threads(converted_error_trace, [])[0]
+    return list([len(trace), sorted(set(__get_element_hash(elem) for elem in trace))] for trace in threads.values())
+
+
+def may_be_equivalent(edited_fingerprint: list, compared_fingerprint: list, comparison_function: str,
+                      similarity_threshold: int) -> bool:
+    """
+    Quick check by fingerprints whether compared error traces can be equivalent.
+    If False is returned, the full comparison can be skipped.
+    """
+    if comparison_function == COMPARISON_FUNCTION_SKIP or not edited_fingerprint and not compared_fingerprint:
+        return True
+    warn_hash = __get_element_hash((CET_OP_WARN, ''))
+    compared = list((length, set(hashes)) for length, hashes in compared_fingerprint)
+    matched_edited = 0
+    matched_compared = set()
+    for length, hashes in edited_fingerprint:
+        hashes = set(hashes)
+        if comparison_function == COMPARISON_FUNCTION_INCLUDE_WITH_ERROR:
+            hashes.discard(warn_hash)
+        candidates = set()
+        for i, (c_length, c_hashes) in enumerate(compared):
+            if comparison_function == COMPARISON_FUNCTION_EQUAL or \
+                    comparison_function not in __COMPARISON_FUNCTIONS_BY_ELEMENTS:
+                if length == c_length and hashes == c_hashes:
+                    candidates.add(i)
+            elif hashes <= c_hashes:
+                candidates.add(i)
+        if candidates:
+            matched_edited += 1
+            matched_compared |= candidates
+    equal_threads = min(matched_edited, len(matched_compared))
+    return is_equivalent(__get_similarity_coefficient(edited_fingerprint, compared_fingerprint, equal_threads),
+                         similarity_threshold)
+
+
 # noinspection PyUnusedLocal
 def __convert_call_tree_filter(error_trace: dict, args: dict = None) -> list:
     # pylint: disable=unused-argument
@@ -446,13 +500,67 @@ def __transform_to_threads(edited_error_trace: list, compared_error_trace: list)
     return et1_threaded, et2_threaded
 
 
-def __sublist(sublist: tuple, big_list: tuple) -> bool:
+def __get_element_hash(elem: tuple) -> int:
+    return zlib.crc32(str(elem).encode('utf8'))
+
+
+def __intern_elements(et1_threaded: dict, et2_threaded: dict) -> (dict, dict):
     """
-    Check that list sublist is included into the list big_list.
+    Replace elements of threads by integers, so equal elements are replaced by the same integer.
     """
-    sublist = ",".join(str(v) for v in sublist)
-    big_list = ",".join(str(v) for v in big_list)
-    return sublist in big_list
+    elements = {(CET_OP_WARN, ''): __WARN_ELEMENT}
+    result = []
+    for et_threaded in (et1_threaded, et2_threaded):
+        result.append(dict(
+            (thread, tuple(elements.setdefault(elem, len(elements)) for elem in trace))
+            for thread, trace in et_threaded.items()
+        ))
+    return tuple(result)
+
+
+def __get_prefix_function(sublist: tuple) -> list:
+    prefix = [0] * len(sublist)
+    k = 0
+    for i in range(1, len(sublist)):
+        while k and sublist[i] != sublist[k]:
+            k = prefix[k - 1]
+        if sublist[i] == sublist[k]:
+            k += 1
+        prefix[i] = k
+    return prefix
+
+
+def __sublist(sublist: tuple, big_list: tuple, prefix: list = None) -> bool:
+    """
+    Check that list sublist is included into the list big_list (Knuth-Morris-Pratt algorithm).
+    """
+    if not sublist:
+        return True
+    if prefix is None:
+        prefix = __get_prefix_function(sublist)
+    k = 0
+    for elem in big_list:
+        while k and elem != sublist[k]:
+            k = prefix[k - 1]
+        if elem == sublist[k]:
+            k += 1
+            if k == len(sublist):
+                return True
+    return False
+
+
+def __ordered_sublist(sublist: tuple, big_list: tuple) -> bool:
+    """
+    Check that elements of list sublist are contained in the list big_list in the same order.
+    Consecutive equal elements of sublist may correspond to the same element of big_list.
+    """
+    index = 0
+    for elem in sublist:
+        while index < len(big_list) and big_list[index] != elem:
+            index += 1
+        if index == len(big_list):
+            return False
+    return True
 
 
 def __compare_skip(edited_error_trace: dict, compared_error_trace: dict) -> int:
@@ -473,8 +581,9 @@ def __compare_equal(edited_error_trace: dict, compared_error_trace: dict) -> int
 def __compare_include(edited_error_trace: dict, compared_error_trace: dict) -> int:
     result = {}
     for id_1, thread_1 in edited_error_trace.items():
+        prefix = __get_prefix_function(thread_1)
         for id_2, thread_2 in compared_error_trace.items():
-            if __sublist(thread_1, thread_2):
+            if __sublist(thread_1, thread_2, prefix):
                 if id_1 not in result:
                     result[id_1] = []
                 result[id_1].append(id_2)
@@ -484,37 +593,67 @@ def __compare_include(edited_error_trace: dict, compared_error_trace: dict) -> i
 def __compare_include_with_error(edited_error_trace: dict, compared_error_trace: dict) -> int:
     for cet in [edited_error_trace, compared_error_trace]:
         for thread, trace in cet.items():
-            cet[thread] = trace + (('WARN', ''), )
+            cet[thread] = trace + (__WARN_ELEMENT, )
     return __compare_include(edited_error_trace, compared_error_trace)
 
 
-def __convert_to_number_of_compared_threads(result: dict) -> int:
-    used_transitions = set()
-    max_number_of_threads = 0
-    while True:
-        used_ids_2 = set()
-        number_of_threads = 0
-        for id_1, ids_2 in result.items():
-            for id_2 in ids_2:
-                id_str = f"{id_1}_{id_2}"
-                if id_2 not in used_ids_2 and id_str not in used_transitions:
-                    used_ids_2.add(id_2)
-                    used_transitions.add(id_str)
-                    number_of_threads += 1
-                    break
-        if number_of_threads > max_number_of_threads:
-            max_number_of_threads = number_of_threads
+def get_maximum_matching(graph: dict) -> dict:
+    """
+    Find maximum matching in bipartite graph by Hopcroft-Karp algorithm.
+    Graph is represented as dictionary of left vertexes and lists of their adjacent right vertexes.
+    Returns dictionary of matched left vertexes and corresponding right vertexes.
+    """
+    left_match = {}
+    right_match = {}
+    infinity = len(graph) + 1
+
+    def bfs() -> bool:
+        distance.clear()
+        queue = []
+        for u in graph:
+            if u not in left_match:
+                distance[u] = 0
+                queue.append(u)
+        found = False
+        for u in queue:
+            for v in graph[u]:
+                w = right_match.get(v)
+                if w is None:
+                    found = True
+                elif w not in distance:
+                    distance[w] = distance[u] + 1
+                    queue.append(w)
+        return found
+
+    def dfs(u) -> bool:
+        for v in graph[u]:
+            w = right_match.get(v)
+            if w is None or distance.get(w) == distance[u] + 1 and dfs(w):
+                left_match[u] = v
+                right_match[v] = u
+                return True
+        distance[u] = infinity
+        return False
+
+    distance = {}
+    while bfs():
+        for u in graph:
+            if u not in left_match:
+                dfs(u)
+    return left_match
+
 
-        if number_of_threads == 0:
-            break
-    return max_number_of_threads
+def __convert_to_number_of_compared_threads(result: dict) -> int:
+    return len(get_maximum_matching(result))
 
 
 def __compare_include_partial(edited_error_trace: dict, compared_error_trace: dict) -> int:
     result = {}
+    compared_elements = dict((id_2, set(thread_2)) for id_2, thread_2 in compared_error_trace.items())
     for id_1, thread_1 in edited_error_trace.items():
+        elements_1 = set(thread_1)
         for id_2, thread_2 in compared_error_trace.items():
-            if all(elem in thread_2 for elem in thread_1):
+            if elements_1 <= compared_elements[id_2]:
                 if id_1 not in result:
                     result[id_1] = []
                 result[id_1].append(id_2)
@@ -525,15 +664,7 @@ def __compare_include_partial_ordered(edited_error_trace: dict, compared_error_t
     result = {}
     for id_1, thread_1 in edited_error_trace.items():
         for id_2, thread_2 in compared_error_trace.items():
-            last_index = 0
-            is_eq = True
-            for elem in thread_1:
-                if elem in thread_2[last_index:]:
-                    last_index = thread_2.index(elem)
-                else:
-                    is_eq = False
-                    break
-            if is_eq:
+            if __ordered_sublist(thread_1, thread_2):
                 if id_1 not in result:
                     result[id_1] = []
                 result[id_1].append(id_2)
@@ -20,14 +20,15 @@
 
 
 import json
+import zipfile
 from io import BytesIO
 
 import reports
 from marks.models import ErrorTraceConvertionCache, ConvertedTraces, MarkUnsafe, MarkUnsafeReport
 from reports.mea.core import *
 from reports.models import ReportUnsafe
-from web.utils import ArchiveFileContent, BridgeException, file_get_or_create
-from web.vars import ERROR_TRACE_FILE
+from web.utils import ArchiveFileContent, BridgeException, file_get_or_create, logger
+from web.vars import ERROR_TRACE_FILE, UNKNOWN_ERROR
 
 CONVERSION_FUNCTIONS = [
     {'name': CONVERSION_FUNCTION_MODEL_FUNCTIONS, 'id': 0},
@@ -201,7 +202,13 @@ def get_or_convert_error_trace_auto(unsafe_id: int, conversion_function: str, ar
 
 
 def is_trace_equal(edited_error_trace: list, compared_error_trace: list, comparison_function: str,
-                   similarity_threshold: int) -> (bool, float):
+                   similarity_threshold: int, edited_fingerprint: list = None,
+                   compared_fingerprint: list = None) -> (bool, float):
+    if edited_fingerprint is not None and compared_fingerprint is not None and \
+            not may_be_equivalent(edited_fingerprint, compared_fingerprint, comparison_function,
+                                  similarity_threshold):
+        # Error traces cannot be equivalent, so similarity is not calculated
+        return False, 0.0
     edited_error_trace = __load_json(edited_error_trace)
     compared_error_trace = error_trace_pretty_parse(error_trace_pretty_print(__load_json(compared_error_trace)))
     if DEBUG_ERROR_TRACE_COMPARISON:
@@ -218,6 +225,84 @@ def is_trace_equal(edited_error_trace: list, compared_error_trace: list, compari
     return is_equal, similarity
 
 
+def get_edited_fingerprint(edited_error_trace: list):
+    try:
+        return get_error_trace_fingerprint(__load_json(edited_error_trace))
+    except Exception as e:
+        logger.warning("Cannot get fingerprint of edited error trace: {}".format(e))
+        return None
+
+
+def get_compared_fingerprint(compared_error_trace: list) -> list:
+    # Compared error traces are printed and parsed before comparison (see is_trace_equal)
+    compared_error_trace = list(dict(elem) for elem in __load_json(compared_error_trace))
+    return get_error_trace_fingerprint(error_trace_pretty_parse(error_trace_pretty_print(compared_error_trace)))
+
+
+# Marks which are compared with error traces in the current (worker) process
+_comparison_marks = {}
+
+
+def init_traces_comparison(marks: dict, similarity_threshold: int, args: dict):
+    # Executed once in each worker process, so patterns of marks are not sent with every task
+    _comparison_marks.clear()
+    _comparison_marks.update({
+        'marks': marks, 'similarity_threshold': similarity_threshold, 'args': args
+    })
+
+
+def compare_unsafes_with_marks(tasks: list) -> list:
+    # Executed in the worker process, so DB must not be used here
+    marks = _comparison_marks['marks']
+    results = []
+    for unsafe_id, trace_path, cached, mark_ids in tasks:
+        converted = {}
+        new_converted = {}
+        new_fingerprints = {}
+        unsafe_results = []
+        for mark_id in mark_ids:
+            pattern, pattern_fingerprint, conversion_function, comparison_function = marks[mark_id]
+            try:
+                if conversion_function not in converted:
+                    converted[conversion_function] = __get_compared_error_trace(
+                        trace_path, conversion_function, cached.get(conversion_function), new_converted,
+                        new_fingerprints
+                    )
+                is_equal, compare_result = is_trace_equal(pattern, converted[conversion_function][0],
+                                                          comparison_function,
+                                                          _comparison_marks['similarity_threshold'],
+                                                          pattern_fingerprint, converted[conversion_function][1])
+                unsafe_results.append((mark_id, is_equal, compare_result, None))
+            except BridgeException as e:
+                unsafe_results.append((mark_id, False, 0, str(e)))
+            except Exception as e:
+                logger.exception("Error traces comparison failed: %s" % e, exc_info=e)
+                unsafe_results.append((mark_id, False, 0, str(UNKNOWN_ERROR)))
+        results.append((unsafe_id, unsafe_results, new_converted, new_fingerprints))
+    return results
+
+
+def __get_compared_error_trace(trace_path, conversion_function, cache, new_converted, new_fingerprints):
+    if cache:
+        converted_id, converted_path, fingerprint = cache
+        with open(converted_path, mode='rb') as fp:
+            converted_error_trace = json.loads(fp.read().decode('utf8'))
+        if fingerprint is None:
+            fingerprint = get_compared_fingerprint(converted_error_trace)
+            new_fingerprints[converted_id] = fingerprint
+        else:
+            fingerprint = json.loads(fingerprint)
+        return converted_error_trace, fingerprint
+
+    with zipfile.ZipFile(trace_path, 'r') as zfp:
+        parsed_trace = json.loads(zfp.read(ERROR_TRACE_FILE).decode('utf8'))
+    converted_error_trace = convert_error_trace(parsed_trace, conversion_function, _comparison_marks['args'])
+    fingerprint = get_compared_fingerprint(converted_error_trace)
+    # Comparison changes elements of the trace, so the copy is saved
+    new_converted[conversion_function] = (list(dict(elem) for elem in converted_error_trace), fingerprint)
+    return converted_error_trace, fingerprint
+
+
 def __load_json(et):
     if isinstance(et, str):
         et = json.loads(et)
@@ -400,11 +485,15 @@ def error_trace_pretty_parse(pretty_error_trace: str) -> list:
     return converted_error_trace
 
 
-def dump_converted_error_trace(converted_error_trace):
+def dump_converted_error_trace(converted_error_trace, fingerprint: list = None):
     """
     Print converted error trace into file.
     """
-    return file_get_or_create(
+    converted = file_get_or_create(
         BytesIO(
             json.dumps(converted_error_trace, ensure_ascii=False, sort_keys=True, indent=4).encode('utf8')),
         ET_FILE_NAME, ConvertedTraces)[0]
+    if fingerprint is not None and converted.fingerprint is None:
+        converted.fingerprint = json.dumps(fingerprint)
+        converted.save()
+    return converted
@@ -20,8 +20,10 @@
 #
 
 import os
+import shutil
 import time
 
+from django.conf import settings
 from django.contrib.auth.models import User
 from django.core.files import File
 from django.db import models
@@ -31,7 +33,12 @@ from django.utils.timezone import now
 
 from jobs.models import Job
 from web.utils import RemoveFilesBeforeDelete, logger
-from web.vars import UNSAFE_VERDICTS, SAFE_VERDICTS
+from web.vars import UNSAFE_VERDICTS, SAFE_VERDICTS, TASK_STATUS
+
+# Highlighted files of error traces sources archives are cached in this directory of MEDIA_ROOT
+SOURCES_CACHE_DIR = 'SourcesCache'
+# Rendered error traces are cached in this directory of MEDIA_ROOT, in subdirectories of report roots
+ETV_CACHE_DIR = 'ErrorTracesCache'
 
 
 def get_component_path(instance, filename):
@@ -64,6 +71,7 @@ class ReportRoot(models.Model):
 def reportroot_delete_signal(**kwargs):
     t1 = time.time()
     RemoveFilesBeforeDelete(kwargs['instance'])
+    shutil.rmtree(os.path.join(settings.MEDIA_ROOT, ETV_CACHE_DIR, str(kwargs['instance'].id)), ignore_errors=True)
     logger.info('Deleting ReportRoot files took %s seconds.' % (time.time() - t1))
 
 
@@ -80,7 +88,7 @@ class Attr(models.Model):
 
     class Meta:
         db_table = 'attr'
-        index_together = ["name", "value"]
+        unique_together = ["name", "value"]
 
 
 class Report(models.Model):
@@ -192,6 +200,17 @@ def coverage_archive_delete_signal(**kwargs):
     arch.archive.storage.delete(arch.archive.path)
 
 
+class CoverageCacheTask(models.Model):
+    archive = models.OneToOneField(CoverageArchive, models.CASCADE, related_name='cache_task')
+    status = models.CharField(max_length=10, choices=TASK_STATUS, default='PENDING')
+    error = models.CharField(max_length=1024, null=True)
+    date = models.DateTimeField()
+    started = models.DateTimeField(null=True)
+
+    class Meta:
+        db_table = 'cache_report_coverage_task'
+
+
 class ErrorTraceSource(models.Model):
     root = models.ForeignKey(ReportRoot, models.CASCADE)
     archive = models.FileField(upload_to='Unsafes/Sources/%Y/%m')
@@ -207,6 +226,7 @@ class ErrorTraceSource(models.Model):
 def source_delete_signal(**kwargs):
     source = kwargs['instance']
     source.archive.storage.delete(source.archive.path)
+    shutil.rmtree(os.path.join(settings.MEDIA_ROOT, SOURCES_CACHE_DIR, str(source.id)), ignore_errors=True)
 
 
 class ReportUnsafe(Report):
@@ -354,15 +374,18 @@ class CoverageDataValue(models.Model):
 
     class Meta:
         db_table = 'cache_report_coverage_data_values'
+        unique_together = ['name', 'hashsum']
 
 
 class CoverageData(models.Model):
     covfile = models.ForeignKey(CoverageFile, models.CASCADE)
-    line = models.PositiveIntegerField()
+    start_line = models.PositiveIntegerField()
+    end_line = models.PositiveIntegerField()
     data = models.ForeignKey(CoverageDataValue, models.CASCADE)
 
     class Meta:
         db_table = 'cache_report_coverage_data'
+        index_together = ['covfile', 'start_line']
 
 
 class CoverageDataStatistics(models.Model):
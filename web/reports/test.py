@@ -19,25 +19,31 @@
 # limitations under the License.
 #
 
+import hashlib
 import json
 import os
 import random
 import time
+import zipfile
 from io import BytesIO
 
 from django.conf import settings
 from django.core.exceptions import ObjectDoesNotExist
 from django.db.models import Q
-from django.test import Client
+from django.test import Client, SimpleTestCase
 from django.urls import reverse
 
-from jobs.models import Job
+from jobs.models import Job, ReportsUpload
+from reports.mea import core as mea_core
+from reports.mea.core import get_maximum_matching, compare_error_traces, is_equivalent, may_be_equivalent, \
+    get_error_trace_fingerprint
+from reports.etv import CheckErrorTraceStructure
 from reports.models import ReportSafe, ReportUnsafe, ReportUnknown, ReportComponent, CoverageArchive, \
     CoverageFile, ReportAttr
 from users.models import User
 from web.populate import populate_users
 from web.utils import CVTestCase
-from web.vars import JOB_STATUS, FORMAT
+from web.vars import JOB_STATUS, FORMAT, JOB_ROLES
 
 LINUX_ATTR = {'name': 'Linux kernel', 'value': [
     {'name': 'Version', 'value': '3.5.0'},
@@ -431,6 +437,122 @@ class TestReports(CVTestCase):
             self.assertEqual(response['Content-Type'], 'application/json')
             self.assertNotIn('error', json.loads(str(response.content, encoding='utf8')))
 
+    def test_upload_reports_by_chunks(self):
+        self.job = Job.objects.order_by('parent').first()
+        if self.job is None:
+            self.fail('Jobs are not populated')
+        archive = BytesIO()
+        with zipfile.ZipFile(archive, mode='w') as zfp:
+            zfp.writestr('reports.json', json.dumps([{
+                'type': 'component', 'id': '/', 'parent id': None, 'name': 'Core',
+                'attrs': [], 'comp': [], 'resources': resources()
+            }]))
+        content = archive.getvalue()
+        chunk_size = 64
+        chunks = list(content[i:i + chunk_size] for i in range(0, len(content), chunk_size))
+        upload_data = {
+            'size': json.dumps(len(content)), 'chunk_size': json.dumps(chunk_size),
+            'chunks': json.dumps(list(hashlib.sha256(chunk).hexdigest() for chunk in chunks))
+        }
+
+        def start_upload():
+            start_response = self.client.post('/jobs/upload_reports/%s/start/' % self.job.pk, upload_data)
+            self.assertEqual(start_response.status_code, 200)
+            start_res = json.loads(str(start_response.content, encoding='utf8'))
+            self.assertNotIn('error', start_res)
+            return start_res
+
+        def upload_chunk(upload_id, index, chunk):
+            chunk_response = self.client.post('/jobs/upload_reports/chunk/%s/' % upload_id, {
+                'index': index, 'chunk': BytesIO(chunk)
+            })
+            self.assertEqual(chunk_response.status_code, 200)
+            return json.loads(str(chunk_response.content, encoding='utf8'))
+
+        res = start_upload()
+        self.assertEqual(res['missing'], list(range(len(chunks))))
+        upload = ReportsUpload.objects.get(id=res['upload'])
+        for i in range(0, len(chunks), 2):
+            self.assertNotIn('error', upload_chunk(res['upload'], i, chunks[i]))
+
+        # The upload is resumed with not received chunks
+        res = start_upload()
+        self.assertEqual(res['upload'], upload.id)
+        self.assertEqual(res['missing'], list(range(1, len(chunks), 2)))
+
+        # Chunks with wrong content or size are rejected and don't change already written data
+        with open(upload.archive.path, mode='rb') as fp:
+            written = fp.read()
+        self.assertIn('error', upload_chunk(res['upload'], 1, chunks[0]))
+        self.assertIn('error', upload_chunk(res['upload'], 1, chunks[1][:-1]))
+        self.assertIn('error', upload_chunk(res['upload'], 3, bytes(len(chunks[3]))))
+        # Already received chunks are not written again
+        self.assertNotIn('error', upload_chunk(res['upload'], 2, chunks[2]))
+        with open(upload.archive.path, mode='rb') as fp:
+            self.assertEqual(fp.read(), written)
+        self.assertEqual(start_upload()['missing'], list(range(1, len(chunks), 2)))
+
+        for i in res['missing']:
+            self.assertNotIn('error', upload_chunk(res['upload'], i, chunks[i]))
+
+        # If the assembled archive is damaged, just damaged chunks are uploaded again
+        with open(upload.archive.path, mode='r+b') as fp:
+            fp.write(bytes(chunk_size))
+        response = self.client.post('/jobs/upload_reports/finish/%s/' % res['upload'])
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('error', json.loads(str(response.content, encoding='utf8')))
+        self.assertEqual(start_upload()['missing'], [0])
+        self.assertNotIn('error', upload_chunk(res['upload'], 0, chunks[0]))
+
+        response = self.client.post('/jobs/upload_reports/finish/%s/' % res['upload'])
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn('error', json.loads(str(response.content, encoding='utf8')))
+        self.assertFalse(ReportsUpload.objects.filter(id=upload.id).exists())
+        self.assertEqual(ReportComponent.objects.filter(root__job=self.job, parent=None).count(), 1)
+
+    def test_upload_downloaded_reports(self):
+        job_template = Job.objects.order_by('parent').first()
+        if job_template is None:
+            self.fail('Jobs are not populated')
+        response = self.client.post(reverse('jobs:form', args=[job_template.pk, 'copy']), {
+            'name': 'Job with reports', 'description': '', 'parent': job_template.identifier,
+            'global_role': JOB_ROLES[0][0], 'user_roles': '[]',
+            'file_data': json.dumps([{"type": "root", "text": "Files", "children": []}])
+        })
+        job_pk = int(json.loads(str(response.content, encoding='utf8'))['job_id'])
+
+        # Upload the tree of components with several levels, children are listed before their parents
+        components = [('/a/c', '/a', 'C'), ('/b', '/', 'B'), ('/a', '/', 'A'), ('/', None, 'Core')]
+        archive = BytesIO()
+        with zipfile.ZipFile(archive, mode='w') as zfp:
+            zfp.writestr('reports.json', json.dumps(list({
+                'type': 'component', 'id': r_id, 'parent id': parent_id, 'name': name,
+                'attrs': [], 'comp': [], 'resources': resources()
+            } for r_id, parent_id, name in components)))
+        archive.seek(0)
+        archive.name = 'reports.zip'
+        response = self.client.post('/jobs/upload_reports/%s/' % job_pk, {'archive': archive})
+        self.assertNotIn('error', json.loads(str(response.content, encoding='utf8')))
+
+        def get_tree(job_id):
+            return set(ReportComponent.objects.filter(root__job_id=job_id)
+                       .values_list('component__name', 'parent__reportcomponent__component__name'))
+        tree = get_tree(job_pk)
+        self.assertEqual(tree, set((name, dict((c[0], c[2]) for c in components).get(parent_id))
+                                   for r_id, parent_id, name in components))
+
+        # Download the job and upload it again
+        response = self.client.get('/jobs/downloadjob/%s/' % job_pk)
+        self.assertEqual(response.status_code, 200)
+        job_archive = BytesIO(b''.join(response.streaming_content))
+        job_archive.name = 'job.zip'
+        self.client.post('/jobs/remove/', {'jobs': json.dumps([job_pk])})
+        response = self.client.post('/jobs/upload_jobs/%s/' % job_template.identifier, {'file': job_archive})
+        self.assertJSONEqual(str(response.content, encoding='utf8'), '{}')
+        uploaded_job = Job.objects.get(parent=job_template, name='Job with reports')
+        self.assertEqual(get_tree(uploaded_job.id), tree)
+        self.assertEqual(ReportComponent.objects.filter(root__job=uploaded_job, parent=None).count(), 1)
+
     def test_upload_decided_job(self):
         job = Job.objects.first()
         self.assertIsNotNone(job)
@@ -869,6 +991,163 @@ class TestReports(CVTestCase):
         super().tearDown()
 
 
+class TestErrorTracesComparison(SimpleTestCase):
+    def test_maximum_matching(self):
+        def brute_force_matching(left, graph, used):
+            if not left:
+                return 0
+            # The first left vertex is either not matched or matched with some free adjacent vertex
+            best = brute_force_matching(left[1:], graph, used)
+            for v in graph[left[0]]:
+                if v not in used:
+                    best = max(best, 1 + brute_force_matching(left[1:], graph, used | {v}))
+            return best
+
+        rnd = random.Random(0)
+        graphs = [{}, {1: []}, {1: ['a'], 2: ['a'], 3: ['a']}, {1: ['a', 'b', 'c', 'd']}]
+        for _ in range(500):
+            right = list(range(100, 100 + rnd.randint(0, 6)))
+            graphs.append(dict(
+                (u, rnd.sample(right, rnd.randint(0, len(right)))) for u in range(rnd.randint(0, 6))
+            ))
+        for graph in graphs:
+            matching = get_maximum_matching(graph)
+            self.assertEqual(len(matching), brute_force_matching(list(graph), graph, frozenset()), graph)
+            # The result is a matching of the graph
+            self.assertEqual(len(set(matching.values())), len(matching))
+            for u, v in matching.items():
+                self.assertIn(v, graph[u])
+
+
+    def test_sublists(self):
+        sublist = getattr(mea_core, '__sublist')
+        ordered_sublist = getattr(mea_core, '__ordered_sublist')
+
+        def old_sublist(small, big):
+            # Previous implementation, it is exact for one-digit elements
+            return ','.join(str(v) for v in small) in ','.join(str(v) for v in big)
+
+        def old_ordered_sublist(small, big):
+            # Previous implementation, it also returns whether it went back to the first occurrence of an element
+            last_index = 0
+            went_back = False
+            for elem in small:
+                if elem not in big[last_index:]:
+                    return False, went_back
+                went_back = went_back or big.index(elem) < last_index
+                last_index = big.index(elem)
+            return True, went_back
+
+        rnd = random.Random(0)
+        for _ in range(3000):
+            small = tuple(rnd.randint(1, 3) for _ in range(rnd.randint(0, 4)))
+            big = tuple(rnd.randint(1, 3) for _ in range(rnd.randint(0, 8)))
+            self.assertEqual(sublist(small, big), old_sublist(small, big), (small, big))
+            old_result, went_back = old_ordered_sublist(small, big)
+            if not went_back:
+                self.assertEqual(ordered_sublist(small, big), old_result, (small, big))
+
+        # Consecutive equal elements may correspond to the same element like before
+        self.assertTrue(ordered_sublist((1, 1), (1,)))
+        self.assertTrue(ordered_sublist((1, 2, 2), (1, 2)))
+        # Elements out of order were accepted before, but not anymore
+        self.assertEqual(old_ordered_sublist((1, 2, 1, 2), (1, 2, 1)), (True, True))
+        self.assertFalse(ordered_sublist((1, 2, 1, 2), (1, 2, 1)))
+        # Multi-digit elements are not confused anymore
+        self.assertTrue(old_sublist((1, 2), (11, 2)))
+        self.assertFalse(sublist((1, 2), (11, 2)))
+
+    def test_fingerprints(self):
+        rnd = random.Random(0)
+
+        def converted_trace():
+            trace = []
+            for i in range(rnd.randint(0, 6)):
+                op = rnd.choice([mea_core.CET_OP_CALL, mea_core.CET_OP_RETURN, mea_core.CET_OP_ASSUME,
+                                 mea_core.CET_OP_NOTE, mea_core.CET_OP_WARN])
+                trace.append({
+                    mea_core.CET_OP: op, mea_core.CET_THREAD: rnd.randint(1, 2), mea_core.CET_ID: i,
+                    mea_core.CET_DISPLAY_NAME: rnd.choice(['f', 'g', 'h', '']), mea_core.CET_SOURCE: 'x = 1'
+                })
+            return trace
+
+        functions = [
+            mea_core.COMPARISON_FUNCTION_EQUAL, mea_core.COMPARISON_FUNCTION_INCLUDE,
+            mea_core.COMPARISON_FUNCTION_INCLUDE_WITH_ERROR, mea_core.COMPARISON_FUNCTION_INCLUDE_PARTIAL,
+            mea_core.COMPARISON_FUNCTION_INCLUDE_PARTIAL_ORDERED, mea_core.COMPARISON_FUNCTION_SKIP
+        ]
+        equivalent = 0
+        for _ in range(3000):
+            edited = converted_trace()
+            compared = rnd.choice([edited + converted_trace(), converted_trace() + edited, converted_trace()])
+            # Fingerprints are stored in JSON
+            edited_fingerprint = json.loads(json.dumps(get_error_trace_fingerprint(edited)))
+            compared_fingerprint = json.loads(json.dumps(get_error_trace_fingerprint(compared)))
+            for function in functions:
+                result = compare_error_traces(edited, compared, function)
+                for threshold in (1, 50, 100):
+                    if is_equivalent(result, threshold):
+                        equivalent += 1
+                        # Equivalent traces must never be rejected by fingerprints
+                        self.assertTrue(may_be_equivalent(edited_fingerprint, compared_fingerprint, function,
+                                                          threshold), (edited, compared, function, threshold))
+        self.assertGreater(equivalent, 0)
+
+class TestErrorTraceStructure(SimpleTestCase):
+    def __check(self, edges, trace_type=None):
+        data = {'files': ['main.c'], 'funcs': ['main', 'f', 'g'], 'actions': ['Action'], 'edges': edges}
+        if trace_type is not None:
+            data['type'] = trace_type
+        CheckErrorTraceStructure(data)
+
+    def __edge(self, thread=1, **kwargs):
+        edge = {'thread': thread, 'file': 0, 'start line': 1, 'source': 'x = 1;'}
+        edge.update(kwargs)
+        return edge
+
+    def test_valid(self):
+        self.__check([])
+        self.__check([
+            self.__edge(enter=0), self.__edge(action=0), self.__edge(enter=1, action=0), self.__edge(),
+            self.__edge(**{'return': 1}), self.__edge(enter=2, **{'return': 0})
+        ])
+        # Edges of the first thread without enter are global initialization, returns are not checked there
+        self.__check([self.__edge(**{'return': 2}), self.__edge(2, enter=0), self.__edge(2, **{'return': 0})])
+        # The trace may end inside functions and returns from other functions are ignored
+        self.__check([self.__edge(enter=0), self.__edge(enter=1), self.__edge(**{'return': 2})])
+        self.__check([self.__edge(file=0)], trace_type='correctness')
+
+    def test_missing_thread(self):
+        with self.assertRaisesRegex(ValueError, 'should have thread'):
+            self.__check([self.__edge(enter=0), {'file': 0, 'start line': 2}])
+        with self.assertRaisesRegex(ValueError, 'should have thread'):
+            self.__check([{'file': 0, 'start line': 2}], trace_type='correctness')
+        with self.assertRaisesRegex(ValueError, 'should have start line'):
+            self.__check([{'thread': 1, 'file': 0}], trace_type='correctness')
+
+    def test_enter_in_global_edge(self):
+        # The first thread with enter is not global, so its scopes are checked
+        with self.assertRaisesRegex(ValueError, 'Double return'):
+            self.__check([self.__edge(), self.__edge(enter=0), self.__edge(enter=1, **{'return': 2})])
+
+    def test_double_return(self):
+        with self.assertRaisesRegex(ValueError, 'Double return'):
+            self.__check([self.__edge(enter=1, **{'return': 0})])
+        with self.assertRaisesRegex(ValueError, 'Double return'):
+            self.__check([self.__edge(enter=0), self.__edge(enter=1), self.__edge(enter=2, **{'return': 0})])
+        # The caller is found behind the action scope
+        self.__check([self.__edge(enter=0), self.__edge(enter=1, action=0, **{'return': 0})])
+
+    def test_indexes(self):
+        for edge in [{'file': 1}, {'original file': 2}, {'enter': 3}, {'enter': '0'}, {'action': 1},
+                     {'return': -1}, {'file': None}]:
+            with self.assertRaisesRegex(ValueError, 'Wrong .* index'):
+                self.__check([self.__edge(enter=0), self.__edge(**edge)])
+        with self.assertRaisesRegex(ValueError, 'Wrong file index'):
+            self.__check([self.__edge(file=1)])
+        with self.assertRaisesRegex(ValueError, 'Wrong file index'):
+            self.__check([self.__edge(file=1)], trace_type='correctness')
+
 class DecideJobs:
     def __init__(self, username, password, reports_data, with_full_coverage=False, with_progress=False):
         self.service = Client()
@@ -871,6 +871,12 @@ class AttrData:
         if archive is not None:
             self.__get_files(archive)
 
+    def set_archive(self, archive):
+        # Data files of the next added attributes will be searched in the new archive
+        self._files = {}
+        if archive is not None:
+            self.__get_files(archive)
+
     def __get_files(self, archive):
         archive.seek(0)
         try:
@@ -900,11 +906,15 @@ class AttrData:
         ReportAttr.objects.bulk_create(list(ReportAttr(
             report_id=d[0], attr_id=self._attrs[(d[1], d[2])], compare=d[3], associate=d[4], data_id=d[5]
         ) for d in self._data))
-        self.__init__(self._root_id, None)
+        # Data files are kept, so the next attributes can be added with them
+        self._data = []
+        self._name = {}
+        self._attrs = {}
 
     def __upload_names(self):
         names_to_create = set(self._name) - set(n.name for n in AttrName.objects.filter(name__in=self._name))
-        AttrName.objects.bulk_create(list(AttrName(name=name) for name in names_to_create))
+        # Names can be created by the upload of reports of other job at the same time
+        AttrName.objects.bulk_create(list(AttrName(name=name) for name in names_to_create), ignore_conflicts=True)
         for n in AttrName.objects.filter(name__in=self._name):
             self._name[n.name] = n.id
 
@@ -916,7 +926,7 @@ class AttrData:
         for attr in self._attrs:
             if self._attrs[attr] is None and attr[0] in self._name:
                 attrs_to_create.append(Attr(name_id=self._name[attr[0]], value=attr[1]))
-        Attr.objects.bulk_create(attrs_to_create)
+        Attr.objects.bulk_create(attrs_to_create, ignore_conflicts=True)
         for a in Attr.objects.filter(value__in=list(attr[1] for attr in self._attrs)).select_related('name'):
             if (a.name.name, a.value) in self._attrs:
                 self._attrs[(a.name.name, a.value)] = a.id
@@ -42,12 +42,12 @@ from jobs.ViewJobData import ViewJobData
 from jobs.models import Job
 from jobs.utils import JobAccess, get_job_children
 from marks.tables import ReportMarkTable
-from reports.UploadReport import UploadReport
+from reports.UploadReport import UploadReport, UploadReportsBatch
 from reports.comparison import JobsComparison
 from reports.coverage import GetCoverage, GetCoverageSrcHTML
-from reports.etv import GetSource, GetETV
+from reports.etv import GetSource, GetETV, remove_etv_cache
 from reports.models import ReportRoot, Report, ReportComponent, ReportSafe, ReportUnknown, ReportUnsafe, \
-    AttrName, ReportAttr, CoverageArchive
+    ReportAttr, CoverageArchive
 from reports.utils import get_edited_error_trace, get_error_trace_content, modify_error_trace, get_html_error_trace, \
     get_root_report_by_job
 from service.models import Task
@@ -166,6 +166,7 @@ def calculate_validation_stats(validation_results):
 @method_decorator(login_required, name='dispatch')
 class ReportComponentView(LoggedCallMixin, Bview.DataViewMixin, DetailView):
     model = ReportComponent
+    unparallel_shared = ['ReportRoot']
     template_name = 'reports/ReportMain.html'
 
     def get_context_data(self, **kwargs):
@@ -281,6 +282,7 @@ class DownloadVerifierFiles(LoggedCallMixin, SingleObjectMixin, Bview.StreamingR
 @method_decorator(login_required, name='dispatch')
 class SafesListView(LoggedCallMixin, Bview.DataViewMixin, DetailView):
     model = ReportComponent
+    unparallel_shared = ['ReportRoot']
     pk_url_kwarg = 'report_id'
     template_name = 'reports/report_list.html'
 
@@ -309,6 +311,7 @@ class SafesListView(LoggedCallMixin, Bview.DataViewMixin, DetailView):
 @method_decorator(login_required, name='dispatch')
 class UnsafesListView(LoggedCallMixin, Bview.DataViewMixin, DetailView):
     model = ReportComponent
+    unparallel_shared = ['ReportRoot']
     pk_url_kwarg = 'report_id'
     template_name = 'reports/report_list.html'
 
@@ -337,6 +340,7 @@ class UnsafesListView(LoggedCallMixin, Bview.DataViewMixin, DetailView):
 @method_decorator(login_required, name='dispatch')
 class UnknownsListView(LoggedCallMixin, Bview.DataViewMixin, DetailView):
     model = ReportComponent
+    unparallel_shared = ['ReportRoot']
     pk_url_kwarg = 'report_id'
     template_name = 'reports/report_list.html'
 
@@ -367,6 +371,7 @@ class UnknownsListView(LoggedCallMixin, Bview.DataViewMixin, DetailView):
 class ReportSafeView(LoggedCallMixin, Bview.DataViewMixin, DetailView):
     template_name = 'reports/reportLeaf.html'
     model = ReportSafe
+    unparallel_shared = ['ReportRoot']
 
     def get_context_data(self, **kwargs):
         if not JobAccess(self.request.user, self.object.root.job).can_view():
@@ -376,7 +381,7 @@ class ReportSafeView(LoggedCallMixin, Bview.DataViewMixin, DetailView):
         is_modifiable = False
         if self.object.proof:
             try:
-                proof = GetETV(get_error_trace_content(self.object), self.request.user)
+                proof = GetETV(get_error_trace_content(self.object), self.request.user, cache_root=self.object.root_id)
                 if not proof.data.get('edges'):
                     proof = None
                 if proof:
@@ -399,6 +404,7 @@ class ReportSafeView(LoggedCallMixin, Bview.DataViewMixin, DetailView):
 class ReportUnknownView(LoggedCallMixin, Bview.DataViewMixin, DetailView):
     template_name = 'reports/reportLeaf.html'
     model = ReportUnknown
+    unparallel_shared = ['ReportRoot']
 
     def get_context_data(self, **kwargs):
         if not JobAccess(self.request.user, self.object.root.job).can_view():
@@ -419,12 +425,13 @@ class ReportUnknownView(LoggedCallMixin, Bview.DataViewMixin, DetailView):
 class ReportUnsafeViewById(LoggedCallMixin, Bview.DataViewMixin, DetailView):
     template_name = 'reports/reportLeaf.html'
     model = ReportUnsafe
+    unparallel_shared = ['ReportRoot']
 
     def get_context_data(self, **kwargs):
         if not JobAccess(self.request.user, self.object.root.job).can_view():
             raise BridgeException(code=400)
         try:
-            etv = GetETV(get_error_trace_content(self.object), self.request.user)
+            etv = GetETV(get_error_trace_content(self.object), self.request.user, cache_root=self.object.root_id)
             is_manager = self.request.user.extended.role == '2'
             is_modifiable = bool(is_manager or bool(etv.data.get('is_modifiable', True)))
         except Exception as e:
@@ -445,6 +452,7 @@ class ReportUnsafeViewById(LoggedCallMixin, Bview.DataViewMixin, DetailView):
 class ReportUnsafeView(LoggedCallMixin, Bview.DataViewMixin, DetailView):
     template_name = 'reports/reportLeaf.html'
     model = ReportUnsafe
+    unparallel_shared = ['ReportRoot']
     slug_url_kwarg = 'trace_id'
     slug_field = 'trace_id'
 
@@ -452,7 +460,7 @@ class ReportUnsafeView(LoggedCallMixin, Bview.DataViewMixin, DetailView):
         if not JobAccess(self.request.user, self.object.root.job).can_view():
             raise BridgeException(code=400)
         try:
-            etv = GetETV(get_error_trace_content(self.object), self.request.user)
+            etv = GetETV(get_error_trace_content(self.object), self.request.user, cache_root=self.object.root_id)
             is_manager = self.request.user.extended.role == '2'
             is_modifiable = bool(is_manager or bool(etv.data.get('is_modifiable', True)))
         except Exception as e:
@@ -479,7 +487,7 @@ class FullscreenReportUnsafe(LoggedCallMixin, DetailView):
     def get_context_data(self, **kwargs):
         if not JobAccess(self.request.user, self.object.root.job).can_view():
             raise BridgeException(code=400)
-        etv = GetETV(get_error_trace_content(self.object), self.request.user)
+        etv = GetETV(get_error_trace_content(self.object), self.request.user, cache_root=self.object.root_id)
         is_manager = self.request.user.extended.role == '2'
         is_modifiable = bool(is_manager or bool(etv.data.get('is_modifiable', True)))
         return {
@@ -503,7 +511,7 @@ class EditReportUnsafe(LoggedCallMixin, DetailView):
         return {
             'report': self.object,
             'include_assumptions': self.request.user.extended.assumptions,
-            'etv': GetETV(get_error_trace_content(self.object), self.request.user),
+            'etv': GetETV(get_error_trace_content(self.object), self.request.user, cache_root=self.object.root_id),
             'is_edited_exist': os.path.exists(get_edited_error_trace(self.object))
         }
 
@@ -523,6 +531,7 @@ class UnsafeApplyView(LoggedCallMixin, Bview.JsonDetailPostView):
             if not notes[common_key] and warns[common_key]:
                 del notes[common_key]
         if notes or warns:
+            remove_etv_cache(get_error_trace_content(self.object), self.object.root_id)
             modify_error_trace(self.object, notes, warns, is_modifiable)
         return {}
 
@@ -533,6 +542,7 @@ class UnsafeCancelView(LoggedCallMixin, Bview.JsonDetailPostView):
     def get_context_data(self, **kwargs):
         edited_error_trace = get_edited_error_trace(self.object)
         if os.path.exists(edited_error_trace):
+            remove_etv_cache(get_error_trace_content(self.object), self.object.root_id)
             os.remove(edited_error_trace)
         return {}
 
@@ -545,7 +555,7 @@ class SourceCodeView(LoggedCallMixin, Bview.JsonView):
         try:
             if witness_type == 'correctness':
                 report = ReportSafe.objects.get(id=report_id)
-                proof = GetETV(get_error_trace_content(report), self.request.user)
+                proof = GetETV(get_error_trace_content(report), self.request.user, cache_root=report.root_id)
                 lines = proof.lines
             else:
                 # Violation
@@ -581,7 +591,7 @@ class DownloadErrorTraceHtml(LoggedCallMixin, SingleObjectMixin, Bview.Streaming
     def get_generator(self):
         self.object = self.get_object()
         src = dict()
-        etv = GetETV(get_error_trace_content(self.object), self.request.user)
+        etv = GetETV(get_error_trace_content(self.object), self.request.user, cache_root=self.object.root_id)
         for file in etv.data['files']:
             file_prep = re.sub(r'[^A-Za-z0-9_]+', '', str(file))
             cnt = GetSource(self.object, file).data
@@ -611,7 +621,7 @@ class DownloadProofHtml(LoggedCallMixin, SingleObjectMixin, Bview.StreamingRespo
     def get_generator(self):
         self.object = self.get_object()
         src = dict()
-        etv = GetETV(get_error_trace_content(self.object), self.request.user)
+        etv = GetETV(get_error_trace_content(self.object), self.request.user, cache_root=self.object.root_id)
         for file in etv.data['files']:
             file_prep = re.sub(r'[^A-Za-z0-9_]+', '', str(file))
             cnt = GetSource(self.object, file, etv.lines).data
@@ -629,6 +639,8 @@ class UnsafeUploadView(LoggedCallMixin, Bview.JsonDetailPostView):
         except Exception as e:
             logger.exception("Error while parsing error trace: %s" % e, stack_info=True)
             raise BridgeException(_("Cannot parse edited error trace"))
+        # Rendered previous error trace is not needed anymore
+        remove_etv_cache(get_error_trace_content(self.object), self.object.root_id)
         edited_error_trace_file_name = get_edited_error_trace(self.object)
         with open(edited_error_trace_file_name, "w") as fd:
             json.dump(edited_error_trace, fd, ensure_ascii=False, sort_keys=True, indent=4)
@@ -786,12 +798,17 @@ class DownloadCoverageView(LoggedCallMixin, SingleObjectMixin, Bview.StreamingRe
 
 class UploadReportView(LoggedCallMixin, Bview.JsonDetailPostView):
     model = Job
-    unparallel = [ReportRoot, AttrName, Task]
+    # Attribute names and attributes are created with conflict-safe upserts
+    unparallel = [ReportRoot, Task]
 
     def dispatch(self, request, *args, **kwargs):
         with override(settings.DEFAULT_LANGUAGE):
             return super().dispatch(request, *args, **kwargs)
 
+    def get_lock_key(self):
+        # Reports of different jobs are uploaded in parallel
+        return 'job {}'.format(self.request.session.get('job id'))
+
     def get_object(self, queryset=None):
         if queryset is None:
             queryset = self.get_queryset()
@@ -820,10 +837,9 @@ class UploadReportView(LoggedCallMixin, Bview.JsonDetailPostView):
             data = json.loads(self.request.POST['reports'])
             if not isinstance(data, list):
                 raise BridgeException('Wrong format of reports data')
-            for d in data:
-                err = UploadReport(self.object, d, archives).error
-                if err is not None:
-                    raise BridgeException(err)
+            err = UploadReportsBatch(self.object, data, archives).error
+            if err is not None:
+                raise BridgeException(err)
         else:
             raise BridgeException('Report json data is required')
         return {}
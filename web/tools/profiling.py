@@ -19,23 +19,27 @@
 # limitations under the License.
 #
 
-import os
+import hashlib
+import threading
 import time
 from datetime import datetime
 
 from django.conf import settings
+from django.db import connection, DatabaseError
 from django.db.models.base import ModelBase
 
 from tools.models import LockTable, CallLogs
-from web.utils import BridgeException
+from web.utils import BridgeException, logger
 
-# Waiting while other function try to lock with DB table + try to lock with DB table
-# So maximum waiting time is (MAX_WAITING * 2) in seconds.
+# Maximum waiting time for locks in seconds.
 if settings.UNLOCK_FAILED_REQUESTS:
     MAX_WAITING = 30
 else:
     MAX_WAITING = 300
 
+# Names of affected models for each group of models
+_affected_models = {}
+
 
 def get_time():
     while True:
@@ -45,50 +49,191 @@ def get_time():
             pass
 
 
-class ExecLocker:
-    lockfile = os.path.join(settings.BASE_DIR, 'media', '.lock')
+def get_affected_models(groups):
+    groups = tuple(groups)
+    if groups not in _affected_models:
+        block = set()
+        for group in groups:
+            if isinstance(group, ModelBase):
+                block |= __affected_models(group, [])
+            else:
+                block.add(str(group))
+        _affected_models[groups] = frozenset(block)
+    return _affected_models[groups]
+
+
+def __affected_models(model, parents):
+    curr_name = getattr(model, '_meta').object_name
+    related_models = {curr_name}
+    parents.append(curr_name)
+    for rel in [f for f in getattr(model, '_meta').get_fields()
+                if (f.one_to_one or f.one_to_many) and f.auto_created and not f.concrete]:
+        rel_model_name = getattr(rel.field.model, '_meta').object_name
+        if rel_model_name not in related_models and rel_model_name != curr_name and rel_model_name not in parents:
+            related_models.add(rel_model_name)
+            related_models |= __affected_models(rel.field.model, parents)
+    parents.pop()
+    return related_models
+
+
+class LockTimeout(Exception):
+    pass
+
+
+class PostgresLocks:
+    # Session level advisory locks, they are released automatically if the connection is closed
+    has_shared = True
 
-    def __init__(self, name, groups):
+    def acquire(self, name, exclusive):
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT set_config('lock_timeout', %s, false)", ['%ss' % MAX_WAITING])
+            try:
+                cursor.execute('SELECT pg_advisory_lock{}(%s)'.format('' if exclusive else '_shared'),
+                               [self.__get_key(name)])
+            except DatabaseError as e:
+                raise LockTimeout(str(e))
+            finally:
+                cursor.execute('RESET lock_timeout')
+
+    def release(self, name, exclusive):
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT pg_advisory_unlock{}(%s)'.format('' if exclusive else '_shared'),
+                           [self.__get_key(name)])
+
+    def __get_key(self, name):
+        self.__is_not_used()
+        return int.from_bytes(hashlib.md5(name.encode('utf8')).digest()[:8], 'big', signed=True)
+
+    def __is_not_used(self):
+        pass
+
+
+class MySQLLocks:
+    # MySQL named locks do not have shared mode, so all locks are exclusive
+    has_shared = False
+
+    def acquire(self, name, exclusive):
+        self.__is_not_used(exclusive)
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT GET_LOCK(%s, %s)', [self.__get_key(name), MAX_WAITING])
+            if cursor.fetchone()[0] != 1:
+                raise LockTimeout(name)
+
+    def release(self, name, exclusive):
+        self.__is_not_used(exclusive)
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT RELEASE_LOCK(%s)', [self.__get_key(name)])
+
+    def __get_key(self, name):
+        self.__is_not_used()
+        # Names of locks are limited by 64 symbols
+        return 'cvv_' + hashlib.md5(name.encode('utf8')).hexdigest()
+
+    def __is_not_used(self, *args):
+        pass
+
+
+class ProcessLocks:
+    # Locks of the current process for other DB backends (e.g. for tests)
+    has_shared = True
+    _condition = threading.Condition()
+    _shared = {}
+    _exclusive = set()
+
+    def acquire(self, name, exclusive):
+        with self._condition:
+            if exclusive:
+                is_free = self._condition.wait_for(
+                    lambda: name not in self._exclusive and not self._shared.get(name), MAX_WAITING
+                )
+            else:
+                is_free = self._condition.wait_for(lambda: name not in self._exclusive, MAX_WAITING)
+            if not is_free:
+                raise LockTimeout(name)
+            if exclusive:
+                self._exclusive.add(name)
+            else:
+                self._shared[name] = self._shared.get(name, 0) + 1
+
+    def release(self, name, exclusive):
+        with self._condition:
+            if exclusive:
+                self._exclusive.discard(name)
+            elif self._shared.get(name):
+                self._shared[name] -= 1
+            self._condition.notify_all()
+
+
+def get_locks_backend():
+    if connection.vendor == 'postgresql':
+        return PostgresLocks()
+    elif connection.vendor == 'mysql':
+        return MySQLLocks()
+    return ProcessLocks()
+
+
+class ExecLocker:
+    def __init__(self, name, groups, shared_groups=(), key=None):
         self.call_log = CallLogs.objects.create(name=name, enter_time=get_time())
-        self.names = self.__get_affected_models(groups)
-        self.lock_ids = set()
+        self._locks = get_locks_backend()
+        if not self._locks.has_shared:
+            # Read-only views would wait for each other with exclusive locks, so they aren't locked
+            shared_groups = ()
+        self.names = get_affected_models(groups)
+        self.shared_names = get_affected_models(shared_groups) - self.names
+        if key is not None:
+            # Models are locked just for the key (e.g. for the job), so whole models are locked in shared mode
+            # and only views without key or with the same key wait for each other.
+            keyed_names = set('{}:{}'.format(name, key) for name in self.names)
+            if self._locks.has_shared:
+                self.shared_names = self.names | self.shared_names | \
+                    set('{}:{}'.format(name, key) for name in self.shared_names)
+            else:
+                # Whole models can't be locked in shared mode by the backend, so they are not locked at all.
+                # Otherwise views with different keys would wait for each other.
+                self.shared_names = set()
+            self.names = keyed_names
+        self._locked = []
         # wait1 and wait2
         self.waiting_time = [0, 0]
 
     def lock(self):
-        if len(self.names) == 0:
+        if len(self.names) == 0 and len(self.shared_names) == 0:
             return
-        # Lock with file while we locking with DB table
-        while True:
-            try:
-                with open(self.lockfile, mode='x'):
-                    break
-            except FileExistsError:
-                time.sleep(0.1)
-                self.waiting_time[0] += 0.1
-                if self.waiting_time[0] > MAX_WAITING:
-                    if settings.UNLOCK_FAILED_REQUESTS:
-                        try:
-                            os.remove(self.lockfile)
-                        except FileNotFoundError:
-                            pass
-                    else:
-                        raise RuntimeError('Not enough time to lock execution of view')
-
+        locked_after_fail = list(LockTable.objects.filter(
+            name__in=self.names | self.shared_names, locked=True
+        ).values_list('name', flat=True))
+        if locked_after_fail:
+            raise RuntimeError('Execution of view is locked after failed request: {}'.format(locked_after_fail))
+
+        start_time = get_time()
+        # Locks are always acquired in the same order to avoid deadlocks
         try:
-            self.__lock_names()
+            for name in sorted(self.names | self.shared_names):
+                exclusive = name in self.names
+                try:
+                    self._locks.acquire(name, exclusive)
+                except LockTimeout as e:
+                    if not settings.UNLOCK_FAILED_REQUESTS:
+                        raise RuntimeError('Not enough time to lock execution of view')
+                    logger.warning('Lock {} was not acquired: {}'.format(name, e))
+                    continue
+                self._locked.append((name, exclusive))
+        except Exception:
+            self.__release()
+            raise
         finally:
-            try:
-                os.remove(self.lockfile)
-            except FileNotFoundError:
-                pass
+            self.waiting_time[0] = get_time() - start_time
 
     def unlock(self, is_failed):
         self.call_log.execution_delta = get_time() - self.call_log.execution_time
         self.call_log.is_failed = is_failed
 
-        if (not is_failed or settings.UNLOCK_FAILED_REQUESTS) and len(self.lock_ids) > 0:
-            LockTable.objects.filter(id__in=self.lock_ids).update(locked=False)
+        if is_failed and not settings.UNLOCK_FAILED_REQUESTS and len(self.names) > 0:
+            # Other requests with these models are not executed until manual unlock
+            for name in self.names:
+                LockTable.objects.update_or_create(name=name, defaults={'locked': True})
+        self.__release()
         self.call_log.return_time = get_time()
         self.call_log.save()
 
@@ -98,54 +243,9 @@ class ExecLocker:
         self.call_log.wait2 = self.waiting_time[1]
         self.call_log.save()
 
-    def __lock_names(self):
-        can_lock = True
-        names_in_db = set()
-        # Get all created models in table with names in self.block
-        for l in LockTable.objects.filter(name__in=self.names):
-            names_in_db.add(l.name)
-            self.lock_ids.add(l.id)
-            if l.locked:
-                can_lock = False
-
-        # Are there models which aren't created yet?
-        if len(names_in_db) < len(self.names):
-            # Will be executed maximum 1 time per view function
-            for l_name in set(self.names) - set(names_in_db):
-                self.lock_ids.add(LockTable.objects.create(name=l_name).id)
-
-        if not can_lock:
-            while LockTable.objects.filter(id__in=self.lock_ids, locked=True).count() > 0:
-                time.sleep(0.2)
-                self.waiting_time[1] += 0.2
-                if self.waiting_time[1] > MAX_WAITING:
-                    if settings.UNLOCK_FAILED_REQUESTS:
-                        break
-                    raise RuntimeError('Not enough time to lock execution of view')
-        # Lock
-        LockTable.objects.filter(id__in=self.lock_ids).update(locked=True)
-
-    def __get_affected_models(self, groups):
-        block = set()
-        for group in groups:
-            if isinstance(group, ModelBase):
-                block |= self.__affected_models(group, [])
-            else:
-                block.add(str(group))
-        return block
-
-    def __affected_models(self, model, parents):
-        curr_name = getattr(model, '_meta').object_name
-        related_models = {curr_name}
-        parents.append(curr_name)
-        for rel in [f for f in getattr(model, '_meta').get_fields()
-                    if (f.one_to_one or f.one_to_many) and f.auto_created and not f.concrete]:
-            rel_model_name = getattr(rel.field.model, '_meta').object_name
-            if rel_model_name not in related_models and rel_model_name != curr_name and rel_model_name not in parents:
-                related_models.add(rel_model_name)
-                related_models |= self.__affected_models(rel.field.model, parents)
-        parents.pop()
-        return related_models
+    def __release(self):
+        while self._locked:
+            self._locks.release(*self._locked.pop())
 
 
 def unparallel_group(groups):
@@ -173,7 +273,10 @@ def unparallel_group(groups):
 
 
 class LoggedCallMixin:
+    # Models which are changed by the view
     unparallel = []
+    # Models which are just read by the view, views with the same shared models are executed in parallel
+    unparallel_shared = []
 
     def dispatch(self, request, *args, **kwargs):
         if not hasattr(super(), 'dispatch'):
@@ -184,7 +287,7 @@ class LoggedCallMixin:
         if callable(get_unparallel):
             self.unparallel = get_unparallel()
 
-        locker = ExecLocker(type(self).__name__, self.unparallel)
+        locker = ExecLocker(type(self).__name__, self.unparallel, self.unparallel_shared, self.get_lock_key())
         locker.lock()
         try:
             locker.save_exec_time()
@@ -199,6 +302,10 @@ class LoggedCallMixin:
             locker.unlock(False)
         return response
 
+    def get_lock_key(self):
+        # Returns key (e.g. job identifier), models are locked just for it. None means that whole models are locked.
+        return None
+
     def is_not_used(self, *args, **kwargs):
         pass
 
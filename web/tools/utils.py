@@ -32,7 +32,7 @@ from jobs.models import JOBFILE_DIR, JobFile
 from marks.models import CONVERTED_DIR, ConvertedTraces
 from reports.coverage import FillCoverageCache
 from reports.models import ReportRoot, ReportComponent, ReportSafe, ReportUnsafe, ReportUnknown, ReportComponentLeaf, \
-    ComponentResource, ComponentInstances, CoverageFile, CoverageDataStatistics
+    ComponentResource, ComponentInstances, CoverageArchive, CoverageFile, CoverageDataStatistics
 from service.models import FILE_DIR, Solution, Task
 from web.utils import BridgeException, logger
 from web.vars import JOB_WEIGHT
@@ -140,10 +140,12 @@ class RecalculateCoverageCache:
         self.__recalc()
 
     def __recalc(self):
-        CoverageFile.objects.filter(archive__report__root__in=self.roots).delete()
-        CoverageDataStatistics.objects.filter(archive__report__root__in=self.roots).delete()
-        for report in ReportComponent.objects.filter(root__in=self.roots, covnum__gt=0):
-            FillCoverageCache(report)
+        # Roots are recalculated one by one, and FillCoverageCache saves archives by chunks,
+        # so caches of all archives are not kept in memory at once
+        for root in self.roots:
+            CoverageFile.objects.filter(archive__report__root=root).delete()
+            CoverageDataStatistics.objects.filter(archive__report__root=root).delete()
+            FillCoverageCache(archives=list(CoverageArchive.objects.filter(report__root=root, report__covnum__gt=0)))
 
 
 class Recalculation:
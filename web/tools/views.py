@@ -20,7 +20,6 @@
 #
 
 import json
-import os
 
 from django.contrib.auth.decorators import login_required
 from django.core.exceptions import ObjectDoesNotExist, PermissionDenied
@@ -37,7 +36,7 @@ from reports.mea.core import CACHED_CONVERSION_FUNCTIONS
 from reports.models import Component, Computer, JobViewAttrs
 from service.models import Task
 from tools.models import LockTable
-from tools.profiling import unparallel_group, ProfileData, clear_old_logs, ExecLocker
+from tools.profiling import unparallel_group, ProfileData, clear_old_logs
 from tools.utils import objects_without_relations, ClearFiles, Recalculation
 from web.utils import BridgeException, logger
 from web.vars import USER_ROLES, JOB_STATUS, UNKNOWN_ERROR
@@ -301,8 +300,4 @@ def manual_unlock(request):
     if not request.user.is_staff:
         raise PermissionDenied()
     LockTable.objects.all().delete()
-    try:
-        os.remove(ExecLocker.lockfile)
-    except FileNotFoundError:
-        pass
     return HttpResponse('<h1>Success!</h1>')
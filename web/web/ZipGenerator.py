@@ -23,10 +23,21 @@ import os
 import struct
 import time
 import zlib
-from zipfile import ZipInfo, ZIP_DEFLATED, ZIP64_LIMIT, ZIP_FILECOUNT_LIMIT
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from zipfile import ZipInfo, ZIP_STORED, ZIP_DEFLATED, ZIP64_LIMIT, ZIP_FILECOUNT_LIMIT
 
 CHUNK_SIZE = 1024 * 64
 
+# Files with these extensions are already compressed, so they are stored without compression
+STORED_EXTENSIONS = {'.zip', '.gz', '.tgz', '.bz2', '.xz', '.7z', '.png', '.jpg', '.jpeg', '.gif'}
+
+# Files which beginning can't be compressed better than with this ratio are stored without compression
+MIN_COMPRESSION_RATIO = 0.9
+
+# Files that are compressed in parallel are kept in memory, so bigger files are compressed by the streaming way
+MAX_PARALLEL_FILE_SIZE = 1024 * 1024 * 8
+
 
 class LargeZipFile(Exception):
     pass
@@ -46,6 +57,44 @@ stringEndArchive64 = b"PK\x06\x06"
 stringDataDescriptor = b"PK\x07\x08"  # magic number for data descriptor
 
 
+def get_compress_type(filename, buf):
+    if os.path.splitext(filename)[-1].lower() in STORED_EXTENSIONS:
+        return ZIP_STORED
+    # Quick probe of the first chunk with the fastest compression level
+    if len(buf) > 0 and len(zlib.compress(buf, 1)) > len(buf) * MIN_COMPRESSION_RATIO:
+        return ZIP_STORED
+    return ZIP_DEFLATED
+
+
+def compress_member(filename, arcname):
+    # Compresses the whole file in memory, it is executed in the thread pool as zlib releases GIL
+    st = os.stat(filename)
+    zinfo = ZipInfo(arcname, time.localtime(time.time())[:6])
+    zinfo.external_attr = (st[0] & 0xFFFF) << 16
+    zinfo.CRC = crc = 0
+    zinfo.file_size = 0
+    zinfo.compress_size = 0
+    chunks = []
+    with open(filename, "rb") as fp:
+        buf = fp.read(CHUNK_SIZE)
+        zinfo.compress_type = get_compress_type(filename, buf)
+        cmpr = None
+        if zinfo.compress_type == ZIP_DEFLATED:
+            cmpr = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+        while buf:
+            zinfo.file_size += len(buf)
+            crc = zlib.crc32(buf, crc) & 0xffffffff
+            if cmpr:
+                buf = cmpr.compress(buf)
+            chunks.append(buf)
+            buf = fp.read(CHUNK_SIZE)
+    if cmpr:
+        chunks.append(cmpr.flush())
+    zinfo.CRC = crc
+    zinfo.compress_size = sum(len(buf) for buf in chunks)
+    return zinfo, chunks
+
+
 class ZipStream:
     def __init__(self):
         self._filelist = []
@@ -55,31 +104,36 @@ class ZipStream:
         self._data_p += len(data)
         return data
 
-    def compress_file(self, filename, arcname):
+    def compress_file(self, filename, arcname, compress_type=None):
+        # If compress_type is not specified, it is chosen by the file extension and content
         st = os.stat(filename)
         zinfo = ZipInfo(arcname, time.localtime(time.time())[:6])
         zinfo.external_attr = (st[0] & 0xFFFF) << 16
-        zinfo.compress_type = ZIP_DEFLATED
         zinfo.flag_bits = 0x08
         zinfo.header_offset = self._data_p
 
-        cmpr = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
         with open(filename, "rb") as fp:
+            buf = fp.read(CHUNK_SIZE)
+            if compress_type is None:
+                compress_type = get_compress_type(filename, buf)
+            zinfo.compress_type = compress_type
+            cmpr = None
+            if compress_type == ZIP_DEFLATED:
+                cmpr = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+
             zinfo.CRC = crc = 0
             zinfo.compress_size = 0
             zinfo.file_size = 0
             yield self.__get_data(zinfo.FileHeader())
 
-            while 1:
-                buf = fp.read(CHUNK_SIZE)
-                if not buf:
-                    break
+            while buf:
                 zinfo.file_size += len(buf)
                 crc = zlib.crc32(buf, crc) & 0xffffffff
                 if cmpr:
                     buf = cmpr.compress(buf)
                     zinfo.compress_size += len(buf)
                 yield self.__get_data(buf)
+                buf = fp.read(CHUNK_SIZE)
         if cmpr:
             buf = cmpr.flush()
             zinfo.compress_size += len(buf)
@@ -94,6 +148,39 @@ class ZipStream:
         yield self.__get_data(data_descriptor)
         self._filelist.append(zinfo)
 
+    def compress_files(self, files, threads=1):
+        # Files (pairs of file path and archive name) are compressed in the thread pool and written in the given order.
+        # The number of files which are compressed ahead is limited, so the memory usage is limited too.
+        if threads <= 1:
+            for filename, arcname in files:
+                yield from self.compress_file(filename, arcname)
+            return
+        pending = deque()
+        with ThreadPoolExecutor(max_workers=threads) as pool:
+            try:
+                for filename, arcname in files:
+                    if os.path.getsize(filename) > MAX_PARALLEL_FILE_SIZE:
+                        while len(pending) > 0:
+                            yield from self.__write_member(*pending.popleft().result())
+                        yield from self.compress_file(filename, arcname)
+                        continue
+                    pending.append(pool.submit(compress_member, filename, arcname))
+                    if len(pending) >= 2 * threads:
+                        yield from self.__write_member(*pending.popleft().result())
+                while len(pending) > 0:
+                    yield from self.__write_member(*pending.popleft().result())
+            finally:
+                # The response can be closed before the end of the archive
+                for future in pending:
+                    future.cancel()
+
+    def __write_member(self, zinfo, chunks):
+        zinfo.header_offset = self._data_p
+        yield self.__get_data(zinfo.FileHeader(zinfo.file_size > ZIP64_LIMIT or zinfo.compress_size > ZIP64_LIMIT))
+        for buf in chunks:
+            yield self.__get_data(buf)
+        self._filelist.append(zinfo)
+
     def compress_buffer(self, arcname, buffer):
         zinfo = ZipInfo(filename=arcname, date_time=time.localtime(time.time())[:6])
         zinfo.compress_type = ZIP_DEFLATED
@@ -156,14 +243,16 @@ class ZipStream:
         yield self.__get_data(data)
         self._filelist.append(zinfo)
 
-    def compress_stream(self, arcname, datagen):
+    def compress_stream(self, arcname, datagen, compress_type=ZIP_DEFLATED):
         zinfo = ZipInfo(arcname, time.localtime(time.time())[:6])
         zinfo.external_attr = 0o600 << 16
-        zinfo.compress_type = ZIP_DEFLATED
+        zinfo.compress_type = compress_type
         zinfo.flag_bits = 0x08
         zinfo.header_offset = self._data_p
 
-        cmpr = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+        cmpr = None
+        if compress_type == ZIP_DEFLATED:
+            cmpr = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
         zinfo.CRC = crc = 0
         zinfo.compress_size = 0
         zinfo.file_size = 0
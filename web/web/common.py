@@ -176,3 +176,37 @@ LOGGING = {
 }
 
 MAX_FILE_SIZE = 104857600  # 100MB
+
+# Maximum number of processes which build coverage caches of archives in parallel
+COVERAGE_CACHE_PROCESSES = 4
+
+# Maximum number of processes which compare error traces with unsafe marks in parallel
+MARKS_COMPARISON_PROCESSES = 4
+
+# Number of days after which not finished chunked uploads of reports archives are removed
+REPORTS_UPLOAD_LIFETIME = 7
+
+# Maximum number of threads which compress files of downloaded archives in parallel
+ARCHIVE_COMPRESSION_THREADS = 4
+
+# Maximum number of threads which store files of uploaded job reports in parallel
+REPORTS_UPLOAD_THREADS = 4
+
+# If True coverage caches are built by "manage.py ProcessCoverage" worker instead of the report upload request
+COVERAGE_CACHE_IN_BACKGROUND = False
+
+# Number of minutes without progress after which coverage cache tasks in processing are failed as abandoned
+# by a crashed worker
+COVERAGE_CACHE_TASK_TIMEOUT = 60
+
+# If True jobs and reports are uploaded by "manage.py ProcessJobsTasks" worker instead of the upload request
+JOBS_TASKS_IN_BACKGROUND = False
+
+# Number of days after which processed jobs tasks and archives of downloaded jobs are removed
+JOBS_TASKS_LIFETIME = 7
+
+# Number of minutes without progress after which jobs tasks in processing are considered abandoned by a crashed worker
+JOBS_TASKS_TIMEOUT = 1440
+
+# Maximum number of opened zip archives of reports which are kept by each process to read their files faster
+OPENED_ARCHIVES_CACHE_SIZE = 32
@@ -21,14 +21,19 @@
 
 import json
 import os
+import tempfile
+from unittest import mock
 
 from django.conf import settings
+from django.test import SimpleTestCase
 from django.urls import reverse
 
+from jobs.models import Job
 from marks.models import MarkUnknown, SafeTag, UnsafeTag
 from users.models import User, Extended
+from tools.profiling import ExecLocker, ProcessLocks
 from web.populate import populate_users
-from web.utils import CVTestCase
+from web.utils import CVTestCase, iter_json_items
 from web.vars import USER_ROLES
 
 
@@ -147,3 +152,75 @@ class TestPopulation(CVTestCase):
         # Population after service and manager were created by function call
         response = self.client.post(reverse('population'))
         self.assertEqual(response.status_code, 200)
+
+
+class ExclusiveProcessLocks(ProcessLocks):
+    # Locks of the backend without shared mode (like MySQL named locks)
+    has_shared = False
+
+    def acquire(self, name, exclusive):
+        super().acquire(name, True)
+
+    def release(self, name, exclusive):
+        super().release(name, True)
+
+
+class TestLocks(CVTestCase):
+    @mock.patch('tools.profiling.MAX_WAITING', 1)
+    @mock.patch('tools.profiling.get_locks_backend', ExclusiveProcessLocks)
+    def test_keyed_locks_without_shared_mode(self):
+        locker1 = ExecLocker('upload1', [Job], ['ReportRoot'], key=1)
+        locker2 = ExecLocker('upload2', [Job], ['ReportRoot'], key=2)
+        self.assertEqual(locker1.shared_names, set())
+        self.assertTrue(all(name.endswith(':1') for name in locker1.names))
+
+        # Views with different keys don't wait for each other
+        locker1.lock()
+        locker2.lock()
+        self.assertEqual(len(locker1._locked), len(locker1.names))
+        self.assertEqual(len(locker2._locked), len(locker2.names))
+
+        # Views with the same key are still locked
+        self.assertEqual(ExecLocker('upload3', [Job], key=1).names, locker1.names)
+
+        for locker in (locker1, locker2):
+            locker.save_exec_time()
+            locker.unlock(False)
+        self.assertEqual(ExclusiveProcessLocks._exclusive, set())
+
+
+class TestJsonItems(SimpleTestCase):
+    items = [
+        {'id': '/', 'parent id': None, 'attrs': [{'name': 'a', 'value': '[1, 2], {"b": 3}'}]},
+        {'id': '/x', 'name': 'Компонент', 'resources': {'cpu time': 1234567, 'memory size': 0.5}},
+        12345, 'string with \\ and \" and ]', [1, [2, []]], {}, True, None
+    ]
+
+    def __parse(self, content, chunk_size):
+        with tempfile.NamedTemporaryFile(mode='w', encoding='utf8', suffix='.json', delete=False) as fp:
+            fp.write(content)
+        try:
+            return list(iter_json_items(fp.name, chunk_size=chunk_size))
+        finally:
+            os.remove(fp.name)
+
+    def test_formats(self):
+        contents = [
+            json.dumps(self.items), json.dumps(self.items, indent=4, ensure_ascii=False),
+            '\n'.join(json.dumps(item, ensure_ascii=False) for item in self.items) + '\n',
+            '\n'.join(json.dumps(item) for item in self.items)
+        ]
+        for content in contents:
+            # Small chunks split tokens (numbers, strings, escapes and separators) between reads
+            for chunk_size in list(range(1, 12)) + [64 * 1024]:
+                self.assertEqual(self.__parse(content, chunk_size), self.items, (content, chunk_size))
+        for content in ['[]', ' [ \n ] ', '', '\n\n']:
+            for chunk_size in (1, 2, 64 * 1024):
+                self.assertEqual(self.__parse(content, chunk_size), [])
+
+    def test_wrong_format(self):
+        for content in ['[{"a": 1}, {"b": ', '[1, 2', '{"a": 1} {"b"}', '[1, 2]x', '[1, 2] \n ]', '{"a": tru}',
+                        '[1 2]', '[1,, 2]', '[1, 2,]', '[,]', '1, 2']:
+            for chunk_size in (1, 3, 64 * 1024):
+                with self.assertRaises(ValueError):
+                    self.__parse(content, chunk_size)
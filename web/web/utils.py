@@ -20,12 +20,15 @@
 #
 
 import hashlib
+import json
 import logging
 import os
 import shutil
 import tempfile
+import threading
 import time
 import zipfile
+from collections import OrderedDict
 
 from django.conf import settings
 from django.core.exceptions import ObjectDoesNotExist
@@ -83,6 +86,66 @@ def file_checksum(f):
     return md5.hexdigest()
 
 
+def iter_json_items(file_path, chunk_size=64 * 1024):
+    # Yields items of JSON array or JSON Lines file one by one, so the whole file is not loaded into memory.
+    # The file which starts with '[' is considered as JSON array.
+    decoder = json.JSONDecoder()
+    wrong_format = ValueError('Wrong format of JSON file "{}"'.format(os.path.basename(file_path)))
+    with open(file_path, encoding='utf8') as fp:
+        buf = fp.read(chunk_size)
+        pos = 0
+        is_array = None
+        # What is expected in JSON array: 'item' after ',', 'separator' after item or 'first' after '['
+        expected = None
+        while True:
+            while pos < len(buf) and buf[pos].isspace():
+                pos += 1
+            if pos == len(buf):
+                buf = fp.read(chunk_size)
+                pos = 0
+                if buf:
+                    continue
+                if is_array:
+                    raise ValueError('Unexpected end of JSON array')
+                return
+            if is_array is None:
+                is_array = (buf[pos] == '[')
+                if is_array:
+                    pos += 1
+                    expected = 'first'
+                    continue
+            if is_array and buf[pos] == ']' and expected != 'item':
+                # Only whitespaces can follow the array
+                if buf[pos + 1:].strip() or any(data.strip() for data in iter(lambda: fp.read(chunk_size), '')):
+                    raise wrong_format
+                return
+            if expected == 'separator':
+                if buf[pos] != ',':
+                    raise wrong_format
+                pos += 1
+                expected = 'item'
+                continue
+
+            try:
+                item, end = decoder.raw_decode(buf, pos)
+            except json.JSONDecodeError:
+                end = None
+            if end is None or end == len(buf) or not (buf[end].isspace() or buf[end] in ',]'):
+                # The item can be incomplete (e.g. the number can be continued), so read more data and try again.
+                # The read size grows with the buffer, so big items are not parsed too many times.
+                data = fp.read(max(chunk_size, len(buf) - pos))
+                if data:
+                    buf = buf[pos:] + data
+                    pos = 0
+                    continue
+                if end is None:
+                    raise wrong_format
+            yield item
+            pos = end
+            if is_array:
+                expected = 'separator'
+
+
 def file_get_or_create(fp, filename, table, check_size=False):
     if check_size:
         file_size = fp.seek(0, os.SEEK_END)
@@ -165,19 +228,67 @@ def has_references(obj):
     return False
 
 
+class OpenedArchives:
+    # Zip archives with parsed central directories, the least recently used archives are removed first.
+    # Removed archives are closed by the last thread which reads them.
+    # Archives are identified by the path and the modification time, so changed archives are opened again.
+    def __init__(self):
+        self._archives = OrderedDict()
+        self._lock = threading.Lock()
+
+    def read(self, path, name):
+        stat = os.stat(path)
+        key = (path, stat.st_mtime_ns, stat.st_size)
+        with self._lock:
+            archive = self._archives.pop(path, None)
+            if archive is not None and archive['key'] != key:
+                self.__remove(archive)
+                archive = None
+            if archive is None:
+                archive = {
+                    'key': key, 'zip': zipfile.ZipFile(path, 'r'), 'lock': threading.Lock(),
+                    'readers': 0, 'removed': False
+                }
+            archive['readers'] += 1
+            self._archives[path] = archive
+            while len(self._archives) > settings.OPENED_ARCHIVES_CACHE_SIZE:
+                self.__remove(self._archives.popitem(last=False)[1])
+        try:
+            # Files of the archive are read by one thread at a time
+            with archive['lock']:
+                return archive['zip'].read(name)
+        finally:
+            with self._lock:
+                archive['readers'] -= 1
+                if archive['removed'] and archive['readers'] == 0:
+                    archive['zip'].close()
+
+    def __remove(self, archive):
+        self.__is_not_used()
+        archive['removed'] = True
+        if archive['readers'] == 0:
+            archive['zip'].close()
+
+    def __is_not_used(self):
+        pass
+
+
+opened_archives = OpenedArchives()
+
+
+def read_archive_file(field_file, name):
+    # Returns content of the file of the zip archive (FileField value)
+    if os.path.splitext(field_file.name)[-1] != '.zip':
+        raise ValueError('Archive type is not supported')
+    return opened_archives.read(field_file.path, name)
+
+
 class ArchiveFileContent:
     def __init__(self, report, field_name, file_name):
         self._report = report
         self._field = field_name
         self._name = file_name
-        self.content = self.__extract_file_content()
-
-    def __extract_file_content(self):
-        with getattr(self._report, '_meta').model.objects.get(id=self._report.id).__getattribute__(self._field) as fp:
-            if os.path.splitext(fp.name)[-1] != '.zip':
-                raise ValueError('Archive type is not supported')
-            with zipfile.ZipFile(fp, 'r') as zfp:
-                return zfp.read(self._name)
+        self.content = read_archive_file(getattr(self._report, self._field), self._name)
 
 
 class OpenFiles:
@@ -169,6 +169,13 @@ TASK_STATUS = (
     ('CANCELLED', _('Cancelled'))
 )
 
+JOBS_TASK_TYPE = (
+    ('UPLOAD_JOB', _('Job upload')),
+    ('UPLOAD_TREE', _('Jobs tree upload')),
+    ('UPLOAD_REPORTS', _('Reports upload')),
+    ('DOWNLOAD_JOB', _('Job download'))
+)
+
 REPORT_ARCHIVE = {
     'log': 'log.zip',
     'coverage': 'coverage.zip',